@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+'''
+Micro-benchmarks of the point cloud and image encode/decode hot paths.
+
+Every stage runs in isolation on synthetic data: point clouds from 1k to 1M
+points and bgr8 images at several resolutions. The stages mirror the path
+of a message from the device forwarders to the host processors:
+
+    conversion     ROS Point32 messages to an (N, 3) array
+    pack           binary frame with each point cloud codec
+    hex            legacy hexadecimal payload, encode and decode
+    split          chunks of a frame, packets of an image
+    reassemble     FrameAssembler and ImageAssembler
+    decode         binary frame back to points, compressed image back to pixels
+    write          binary PLY file and recording append
+
+The results are written as JSON. The whole suite runs --runs times, and
+each stage keeps the run with the lowest median, as well as the median of
+the runs as its typical time. Each run also times a fixed reference
+workload, unrelated to the code under test. With --compare, the best run of
+each stage is checked against the typical run of a stored baseline, so one
+lucky run of the baseline does not set the bar. The best runs are first
+scaled by how much slower the reference ran than for the baseline, so a
+machine busier than when the baseline was saved does not look like a
+regression. A stage slower than the tolerance and the noise floor allow
+is only a suspect: the suite is measured again --confirm times, each with
+the best of --runs runs, and the stage is a regression only when it is
+slower in each of them. The script then exits with status 1. Compare with
+the options the baseline was saved with, a subset of the suite allocates
+and caches differently and is not comparable.
+
+    python benchmarks/bench_codecs.py --output results.json
+    python benchmarks/bench_codecs.py --compare benchmarks/baseline.json
+    python benchmarks/bench_codecs.py --save-baseline
+
+The baseline is machine specific, save a new one on the machine the
+comparisons run on.
+'''
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+from collections import namedtuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The shared codec modules are identical in both folders, the host folder adds the writers
+sys.path[:0] = [os.path.join(ROOT, "device"), os.path.join(ROOT, "host")]
+
+import numpy as np
+
+import image_codec
+import point_cloud_codec as pc_codec
+from point_cloud_writer import write_ply
+from recording import RecordingWriter
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_POINT_COUNTS = (1000, 10000, 100000, 1000000)
+DEFAULT_RESOLUTIONS = ("320x240", "640x480", "1280x720", "1920x1080")
+DEFAULT_CODECS = ("raw", "int16", "int16+zlib", "raw+zlib")
+DEFAULT_TOLERANCE = 0.25
+# Stages faster than this are dominated by timer noise and are not compared, and a slowdown
+# smaller than this is not a regression
+DEFAULT_NOISE_FLOOR_MS = 0.5
+# Runs of the whole suite, each stage keeps its best run
+DEFAULT_RUNS = 3
+# Measurements of a suspected regression, it must show up in each of them
+DEFAULT_CONFIRM = 2
+MAX_CHUNK_SIZE = 256 * 1024
+IMAGE_PACKET_SIZE = 1024
+# Name of the fixed workload measured with every run, it scales out a machine busier than for the baseline
+REFERENCE = "reference"
+
+# Stand-in for geometry_msgs/Point32, points_to_array only reads x, y and z
+Point32 = namedtuple("Point32", ["x", "y", "z"])
+
+
+def synthetic_points(num_points, rng):
+    """
+    A room-sized scan: points on the walls and floor of a 10 m box with sensor noise
+    """
+    points = rng.uniform(-5.0, 5.0, size=(num_points, 3)).astype(np.float32)
+    axis = rng.integers(0, 3, size=num_points)
+    points[np.arange(num_points), axis] = np.where(rng.random(num_points) < 0.5, -5.0, 5.0)
+    points += rng.normal(0.0, 0.01, size=points.shape).astype(np.float32)
+    return points
+
+
+def synthetic_image(width, height, rng):
+    """
+    A bgr8 image with smooth gradients and some noise, so PNG and JPEG do real work
+    """
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:, :, 0] = (x + y) / 2
+    image[:, :, 1] = x
+    image[:, :, 2] = y
+    image += rng.integers(0, 8, size=image.shape, dtype=np.uint8)
+    return image
+
+
+def measure(func, min_time=0.2, min_repeats=3, max_repeats=1000):
+    """
+    Run func until it ran min_repeats times and for min_time seconds
+    :return: A dictionary with the median and minimum time in milliseconds and the number of repeats
+    """
+    times = []
+    total = 0.0
+    # Like timeit, a garbage collection pass triggered by earlier stages is not timed
+    gc.collect()
+    gc.disable()
+    try:
+        while len(times) < min_repeats or (total < min_time and len(times) < max_repeats):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            times.append(elapsed)
+            total += elapsed
+    finally:
+        gc.enable()
+    return {"median_ms": statistics.median(times) * 1000, "min_ms": min(times) * 1000, "repeats": len(times)}
+
+
+def record(results, name, func, num_bytes, **kwargs):
+    result = measure(func, **kwargs)
+    result["bytes"] = num_bytes
+    result["mb_per_s"] = num_bytes / 1e6 / (result["median_ms"] / 1000) if result["median_ms"] else 0.0
+    results[name] = result
+    print(f"{name:<48} {result['median_ms']:>10.3f} ms {result['mb_per_s']:>10.1f} MB/s", flush=True)
+
+
+def bench_point_clouds(results, point_counts, codecs, folder, rng, **kwargs):
+    for num_points in point_counts:
+        points = synthetic_points(num_points, rng)
+        size = points.nbytes
+        prefix = f"point_cloud/{num_points}"
+
+        messages = [Point32(float(x), float(y), float(z)) for x, y, z in points]
+        record(results, f"{prefix}/conversion", lambda: pc_codec.points_to_array(messages), size, **kwargs)
+        del messages
+
+        for name in codecs:
+            codec = pc_codec.create_codec(name)
+            frame = pc_codec.encode_frame(points, codec=codec)
+            record(results, f"{prefix}/pack/{name}", lambda: pc_codec.encode_frame(points, codec=codec), size, **kwargs)
+            record(results, f"{prefix}/decode/{name}", lambda: pc_codec.decode_points(frame, codec), size, **kwargs)
+
+        # The host receives the hexadecimal text as the bytes of the MQTT payload
+        payload = pc_codec.encode_legacy_hex(points).encode()
+        record(results, f"{prefix}/hex/encode", lambda: pc_codec.encode_legacy_hex(points), size, **kwargs)
+        record(results, f"{prefix}/hex/decode", lambda: pc_codec.decode_points(payload), size, **kwargs)
+
+        frame = pc_codec.encode_frame(points)
+        chunks = pc_codec.split_frame(frame, 0, MAX_CHUNK_SIZE)
+        record(results, f"{prefix}/split", lambda: pc_codec.split_frame(frame, 0, MAX_CHUNK_SIZE), len(frame), **kwargs)
+
+        def reassemble():
+            assembler = pc_codec.FrameAssembler()
+            for chunk in chunks:
+                assembler.add(chunk)
+        if len(chunks) > 1:
+            record(results, f"{prefix}/reassemble", reassemble, len(frame), **kwargs)
+
+        path = os.path.join(folder, "bench.ply")
+        record(results, f"{prefix}/write/ply", lambda: write_ply(path, points), size, **kwargs)
+
+        recorder = RecordingWriter(os.path.join(folder, f"recording_{num_points}"))
+
+        def append():
+            recorder.append(frame, num_points)
+            recorder.flush()
+        record(results, f"{prefix}/write/recording", append, len(frame), **kwargs)
+        recorder.close()
+
+
+def bench_images(results, resolutions, rng, **kwargs):
+    for resolution in resolutions:
+        width, height = (int(value) for value in resolution.split("x"))
+        image = synthetic_image(width, height, rng)
+        data = image.tobytes()
+        step = width * 3
+        prefix = f"image/{resolution}"
+
+        for compression in image_codec.COMPRESSIONS:
+            _, compressed = image_codec.compress_image(data, width, height, "bgr8", step, compression)
+            if compression != "none":
+                record(results, f"{prefix}/compress/{compression}", lambda: image_codec.compress_image(
+                    data, width, height, "bgr8", step, compression), len(data), **kwargs)
+
+            def split():
+                return image_codec.split_image(
+                    compressed, 0, IMAGE_PACKET_SIZE, width, height, "bgr8", step, compression=compression
+                )
+            packets = split()
+            record(results, f"{prefix}/split/{compression}", split, len(compressed), **kwargs)
+
+            def reassemble():
+                assembler = image_codec.ImageAssembler()
+                for packet in packets:
+                    completed = assembler.add(packet)
+                return completed
+            completed = reassemble()
+            record(results, f"{prefix}/reassemble/{compression}", reassemble, len(compressed), **kwargs)
+            record(results, f"{prefix}/decode/{compression}", completed.to_array, len(data), **kwargs)
+
+
+def best_of(runs):
+    """
+    Merge the results of repeated runs, each stage keeps the run with the lowest median,
+    and the median of the runs as its typical time
+    """
+    results = {}
+    medians = {}
+    for run in runs:
+        for name, result in run.items():
+            medians.setdefault(name, []).append(result["median_ms"])
+            if name not in results or result["median_ms"] < results[name]["median_ms"]:
+                results[name] = result
+    for name, result in results.items():
+        result["typical_ms"] = statistics.median(medians[name])
+        result["runs"] = len(runs)
+    return results
+
+
+def measure_reference(min_time):
+    """
+    Time a fixed sort, compression and large copy, unrelated to the code under test.
+    They load the CPU and the memory bandwidth like the stages do.
+    :return: The median time in milliseconds
+    """
+    values = np.random.default_rng(0).random(100000)
+    data = values.tobytes()
+    block = np.ones(16 * 1024 * 1024, dtype=np.uint8)
+
+    def work():
+        np.sort(values)
+        zlib.compress(data, 1)
+        block.copy()
+    return measure(work, min_time=min_time)["median_ms"]
+
+
+def run_suite(point_counts, resolutions, codecs, seed, min_time):
+    """
+    :return: The results of one run of the stages of the given sizes
+    """
+    # Every run measures the same synthetic data
+    rng = np.random.default_rng(seed)
+    results = {}
+    before = measure_reference(min_time)
+    with tempfile.TemporaryDirectory() as folder:
+        bench_point_clouds(results, point_counts, codecs, folder, rng, min_time=min_time)
+    bench_images(results, resolutions, rng, min_time=min_time)
+    # Measured on both ends, the load of the machine can change during the run
+    results[REFERENCE] = {"median_ms": (before + measure_reference(min_time)) / 2}
+    return results
+
+
+def machine_scale(results, baseline):
+    """
+    :return: How much slower the reference workload typically ran than for the baseline, 1.0 without a reference
+    """
+    reference = results.get(REFERENCE)
+    base = baseline.get("results", {}).get(REFERENCE)
+    if reference is None or base is None or "typical_ms" not in base:
+        return 1.0
+    return reference["typical_ms"] / base["typical_ms"]
+
+
+def typical_ms(result):
+    # Baselines saved before the typical time was kept only have the best run
+    return result.get("typical_ms", result["median_ms"])
+
+
+def slower(results, baseline, tolerance, noise_floor_ms, names=None):
+    """
+    :param names: The stages to check. Optional, defaults to every stage of the baseline.
+    :return: The names of the stages whose best run, once scaled by machine_scale, is slower than the typical
+    run of the baseline by more than the tolerance and the noise floor
+    """
+    scale = machine_scale(results, baseline)
+    found = []
+    for name, base in baseline.get("results", {}).items():
+        result = results.get(name)
+        base_ms = typical_ms(base)
+        if (name == REFERENCE or (names is not None and name not in names) or result is None
+                or base_ms < noise_floor_ms):
+            continue
+        median_ms = result["median_ms"] / scale
+        if median_ms > base_ms * (1 + tolerance) and median_ms - base_ms > noise_floor_ms:
+            found.append(name)
+    return found
+
+
+def measure_suite(runs, point_counts, resolutions, codecs, seed, min_time):
+    """
+    :return: The results of the given number of runs, merged by best_of
+    """
+    results = []
+    for run in range(runs):
+        print(f"Run {run + 1} of {runs}", flush=True)
+        results.append(run_suite(point_counts, resolutions, codecs, seed, min_time))
+    return best_of(results)
+
+
+def compare(results, baseline, tolerance, noise_floor_ms, confirm, measure_again):
+    """
+    Check the results against the baseline, and measure the suspects again before flagging them
+    :param results: The results merged by best_of
+    :param confirm: The number of times the suspects are measured again
+    :param measure_again: The function measuring the suite again, with the options of the results
+    :return: The names of the stages slower than the baseline in the results and in every confirmation
+    """
+    scale = machine_scale(results, baseline)
+    print(f"The reference workload ran {scale:.2f}x the time it took for the baseline", flush=True)
+    suspects = slower(results, baseline, tolerance, noise_floor_ms)
+    for attempt in range(confirm):
+        if not suspects:
+            break
+        # The whole suite runs again, a stage measured on its own finds the allocator and caches in another state
+        print(f"Measuring {len(suspects)} suspected regressions again, {attempt + 1} of {confirm}", flush=True)
+        suspects = slower(measure_again(), baseline, tolerance, noise_floor_ms, set(suspects))
+
+    for name in suspects:
+        base_ms, result_ms = typical_ms(baseline["results"][name]), results[name]["median_ms"]
+        print(f"REGRESSION {name}: {base_ms:.3f} ms -> {result_ms:.3f} ms "
+              f"({result_ms / base_ms / scale:.2f}x once scaled)")
+    return suspects
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the point cloud and image encode/decode stages")
+    parser.add_argument("--points", type=int, nargs="+", default=list(DEFAULT_POINT_COUNTS))
+    parser.add_argument("--resolutions", nargs="+", default=list(DEFAULT_RESOLUTIONS), help="e.g. 640x480")
+    parser.add_argument("--codecs", nargs="+", default=list(DEFAULT_CODECS))
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds spent on each stage")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help="Runs of the whole suite")
+    parser.add_argument("--confirm", type=int, default=DEFAULT_CONFIRM,
+                        help="Measurements of a suspected regression before it is reported")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, help="Compare against a baseline JSON file")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE, help="Save the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed slowdown, 0.25 is 25%%")
+    parser.add_argument("--noise-floor", type=float, default=DEFAULT_NOISE_FLOOR_MS, help="Milliseconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.runs <= 0:
+        parser.error("--runs must be a positive integer")
+
+    if args.confirm < 0:
+        parser.error("--confirm cannot be negative")
+
+    def measure_again():
+        return measure_suite(args.runs, args.points, args.resolutions, args.codecs, args.seed, args.min_time)
+
+    results = measure_again()
+    options = {
+        "points": args.points, "resolutions": args.resolutions, "codecs": args.codecs,
+        "min_time": args.min_time, "runs": args.runs, "seed": args.seed,
+    }
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "options": options,
+        },
+        "results": results,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("meta", {}).get("options", options) != options:
+            print(f"WARNING: {args.compare} was saved with {baseline['meta']['options']}, "
+                  f"not comparable with {options}")
+        regressions = compare(results, baseline, args.tolerance, args.noise_floor, args.confirm, measure_again)
+        print(f"{len(regressions)} regressions against {args.compare}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+'''
+End-to-end latency and throughput of the device to host data path.
+
+The harness starts the local broker stand-in (or uses the broker given with
+--broker), then for every QoS level runs a number of concurrent streams
+through the real classes. On the device side, each stream is a
+PointCloudForwarder (or ImageForwarder) with its sender queue, all of them
+on one shared Connection and RateLimiter like on the device. A feeder
+thread calls the ROS subscriber callback of each forwarder at a fixed rate
+with synthetic sensor_msgs. On the host side, each stream is a
+PointCloudProcessor (or ImageProcessor) on one shared Connection, so the
+reassembly, the decoding and the PointCloudWriter recording run as
+deployed.
+
+When ROS is not installed, the stand-ins of ros_stubs.py take the place of
+rospy and sensor_msgs.
+
+The messages carry their send time in the stamp of their header, so the
+host measures the device to host latency of every frame without clock
+skew, both sides run in this process. The report holds, per QoS level,
+the latency percentiles, the sustained frames/sec, messages/sec and
+bytes/sec at the host, the fraction of frames lost, the frames dropped by
+the sender queues and the point cloud writer, and the stage timings the
+forwarders and processors recorded in the metrics registry.
+
+    python benchmarks/bench_e2e.py --qos 0 1 2 --points 20000 --packet-size 65536
+    python benchmarks/bench_e2e.py --kind image --resolution 640x480 --packet-size 1024 --streams 2
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "device"), os.path.join(ROOT, "host")]
+
+import numpy as np
+
+import ros_stubs
+
+ros_stubs.install()
+
+import rospy
+from sensor_msgs.msg import Header, Image, PointCloud
+
+import metrics
+from connection import Connection
+from image_forwarder import ImageForwarder
+from local_broker import LocalBroker
+from message_processor import ImageProcessor, PointCloudProcessor
+from point_cloud_forwarder import PointCloudForwarder
+from rate_limiter import RateLimiter
+
+DEFAULT_TOPIC = "/bench/data"
+DEFAULT_DURATION = 5.0
+DEFAULT_RATE = 10.0
+DEFAULT_POINTS = 20000
+DEFAULT_RESOLUTION = "640x480"
+DEFAULT_PACKET_SIZE = 256 * 1024
+DEFAULT_DRAIN_TIMEOUT = 5.0
+# Maximum number of messages the forwarders hand to paho before waiting for one to be sent
+MAX_IN_FLIGHT = 100
+# The forwarders stop after this many image packets, far more than a run sends
+MAX_PACKETS = 2 ** 62
+
+# Stand-in for geometry_msgs/Point32, points_to_array only reads x, y and z
+Point32 = namedtuple("Point32", ["x", "y", "z"])
+
+# The forwarders and processors log every frame, only their warnings and errors are shown
+LOGGER = logging.getLogger("bench_e2e")
+LOGGER.setLevel(logging.WARNING)
+
+
+class Feeder:
+    """
+    The ROS side of one stream: call the subscriber callback of a forwarder at a fixed rate
+    """
+
+    def __init__(self, forwarder, message, rate, name):
+        """
+        :param message: The function building the message of a stamp, called with (secs, nsecs)
+        :param rate: Messages per second, None feeds as fast as possible
+        """
+        self.forwarder = forwarder
+        self.message = message
+        self.rate = rate
+        self.num_frames = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def _run(self):
+        start = time.monotonic()
+        while not self._stop.is_set():
+            if self.rate is not None:
+                delay = start + self.num_frames / self.rate - time.monotonic()
+                if delay > 0:
+                    self._stop.wait(delay)
+                    continue
+            secs, nsecs = divmod(time.time_ns(), 1000000000)
+            self.forwarder.sub.callback(self.message(secs, nsecs))
+            self.num_frames += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class LatencyProbe:
+    """
+    Collect the latency of the frames completed by the processors of one QoS level
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.num_frames = 0
+        self.first_message = None
+        self.last_frame = None
+        # Message ids of the acknowledged subscriptions, the connection fans each SUBACK out to every bridge
+        self.subscriptions = set()
+
+    def message(self):
+        if self.first_message is None:
+            self.first_message = time.monotonic()
+
+    def frame(self, stamp_secs, stamp_nsecs):
+        self.latencies.append(time.time_ns() - (stamp_secs * 1000000000 + stamp_nsecs))
+        self.num_frames += 1
+        self.last_frame = time.monotonic()
+
+
+class PointCloudSink(PointCloudProcessor):
+    """
+    A PointCloudProcessor reporting the completed frames to the probe before they are recorded
+    """
+
+    def __init__(self, mqtt_topic, client_id, probe, **kwargs):
+        self.probe = probe
+        self.logger = LOGGER
+        super().__init__(mqtt_topic, client_id, enable_logging=False, **kwargs)
+
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+        self.probe.subscriptions.add(mid)
+
+    def on_message(self, client, userdata, msg):
+        self.probe.message()
+        super().on_message(client, userdata, msg)
+
+    def save_point_cloud(self, point_clouds, header=None):
+        self.probe.frame(header.stamp_secs, header.stamp_nsecs)
+        super().save_point_cloud(point_clouds, header)
+
+
+class ImageSink(ImageProcessor):
+    """
+    An ImageProcessor reporting the completed images to the probe
+    """
+
+    def __init__(self, mqtt_topic, client_id, probe, **kwargs):
+        self.probe = probe
+        self.logger = LOGGER
+        super().__init__(mqtt_topic, client_id, enable_logging=False, **kwargs)
+
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+        self.probe.subscriptions.add(mid)
+
+    def on_message(self, client, userdata, msg):
+        self.probe.message()
+        super().on_message(client, userdata, msg)
+
+    def image_process(self, image_msg, image_array):
+        self.probe.frame(image_msg.header.stamp.secs, image_msg.header.stamp.nsecs)
+
+
+def point_cloud_message(points):
+    """
+    :param points: An (N, 3) array, converted once to the Point32 list of the messages
+    """
+    point_list = [Point32(float(x), float(y), float(z)) for x, y, z in points]
+
+    def message(secs, nsecs):
+        return PointCloud(header=Header(stamp=rospy.Time(secs, nsecs)), points=point_list)
+    return message
+
+
+def image_message(image):
+    """
+    :param image: A (height, width, 3) bgr8 array
+    """
+    height, width, _ = image.shape
+    data = image.tobytes()
+
+    def message(secs, nsecs):
+        return Image(header=Header(stamp=rospy.Time(secs, nsecs)), height=height, width=width,
+                     encoding="bgr8", is_bigendian=0, step=width * 3, data=data)
+    return message
+
+
+def stage_timings(prefixes):
+    """
+    :return: The mean and p95 in milliseconds of the histograms of the given clients
+    """
+    summary = metrics.summarize(metrics.REGISTRY.snapshot())
+    return {
+        name: {"count": value["count"], "mean_ms": value["mean_ms"], "p95_ms": value["p95_ms"]}
+        for name, value in summary["histograms"].items() if name.startswith(prefixes)
+    }
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def run_qos(qos, args, payload, host, port, folder):
+    # Every QoS level has its own topics and client ids, so the metrics and the frame ids start over
+    topics = [f"{args.topic}/{qos}/{index}" for index in range(args.streams)]
+    probe = LatencyProbe()
+
+    host_connection = Connection(f"bench_host_{qos}", host=host, port=port)
+    sinks = []
+    for index, topic in enumerate(topics):
+        client_id = f"bench_processor_{qos}_{index}"
+        if args.kind == "point_cloud":
+            sink = PointCloudSink(topic, client_id, probe, port=port, qos=qos, connection=host_connection,
+                                  recording_folder=os.path.join(folder, client_id))
+            sink.set_codec(args.codec)
+        else:
+            sink = ImageSink(topic, client_id, probe, packet_size=args.packet_size, port=port, qos=qos,
+                             connection=host_connection)
+        sink.start_processing()
+        sinks.append(sink)
+    host_connection.loop_start()
+    if not wait_for(lambda: len(probe.subscriptions) >= len(topics), 5):
+        LOGGER.warning("Not every subscription was acknowledged")
+
+    device_connection = Connection(f"bench_device_{qos}", host=host, port=port)
+    rate_limiter = RateLimiter(bytes_per_sec=args.bytes_per_sec, max_in_flight=MAX_IN_FLIGHT)
+    forwarders = []
+    feeders = []
+    for index, topic in enumerate(topics):
+        client_id = f"bench_forwarder_{qos}_{index}"
+        if args.kind == "point_cloud":
+            forwarder = PointCloudForwarder(
+                topic, client_id, num_point_clouds=None, port=port, qos=qos, enable_logging=False,
+                codec=args.codec, max_chunk_size=args.packet_size, rate_limiter=rate_limiter,
+                queue_size=args.queue_size, connection=device_connection
+            )
+            message = point_cloud_message(payload)
+        else:
+            forwarder = ImageForwarder(
+                topic, client_id, packet_size=args.packet_size, port=port, qos=qos, enable_logging=False,
+                compression=args.compression, rate_limiter=rate_limiter, queue_size=args.queue_size,
+                connection=device_connection
+            )
+            message = image_message(payload)
+        forwarder.logger = LOGGER
+        forwarders.append(forwarder)
+        feeders.append(Feeder(forwarder, message, args.rate, name=client_id))
+    device_connection.loop_start()
+    if not wait_for(lambda: device_connection.online, 5):
+        LOGGER.warning("The device connection is not online")
+
+    for forwarder in forwarders:
+        if args.kind == "point_cloud":
+            forwarder.start_forwarding()
+        else:
+            forwarder.start_forwarding(MAX_PACKETS)
+    for feeder in feeders:
+        feeder.start()
+    time.sleep(args.duration)
+
+    # Stop feeding, then let the sender queues and the in-flight messages drain
+    for feeder in feeders:
+        feeder.stop()
+    for forwarder in forwarders:
+        forwarder.sender.stop()
+    wait_for(lambda: rate_limiter.in_flight == 0, args.drain_timeout)
+    for forwarder in forwarders:
+        forwarder.stop_forwarding()
+
+    # Let the last frames arrive
+    if args.kind == "point_cloud":
+        sent = sum(forwarder.num_point_clouds_forwarded for forwarder in forwarders)
+    else:
+        sent = sum(forwarder.num_image_forwarded for forwarder in forwarders)
+    wait_for(lambda: probe.num_frames >= sent, args.drain_timeout)
+
+    for forwarder in forwarders:
+        forwarder.disconnect()
+    device_connection.loop_stop()
+    for sink in sinks:
+        sink.stop_processing()
+        if args.kind == "point_cloud":
+            sink.writer.stop()
+        sink.disconnect()
+    host_connection.loop_stop()
+
+    fed = sum(feeder.num_frames for feeder in feeders)
+    messages = sum(sink.messages_received.value for sink in sinks)
+    num_bytes = sum(sink.bytes_received.value for sink in sinks)
+    latencies = np.array(probe.latencies, dtype=np.float64) / 1e6
+    elapsed = (probe.last_frame - probe.first_message) if probe.num_frames else 0.0
+    result = {
+        "qos": qos,
+        "frames_fed": fed,
+        "frames_dropped_by_sender": sum(forwarder.sender.num_dropped for forwarder in forwarders),
+        "frames_sent": sent,
+        "messages_sent": sum(forwarder.messages_published.value for forwarder in forwarders),
+        "frames_received": probe.num_frames,
+        "messages_received": messages,
+        "loss": 1 - probe.num_frames / fed if fed else 0.0,
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p95": float(np.percentile(latencies, 95)) if len(latencies) else None,
+            "p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "max": float(latencies.max()) if len(latencies) else None,
+        },
+        "frames_per_sec": probe.num_frames / elapsed if elapsed > 0 else 0.0,
+        "messages_per_sec": messages / elapsed if elapsed > 0 else 0.0,
+        "bytes_per_sec": num_bytes / elapsed if elapsed > 0 else 0.0,
+        "stages": stage_timings((f"bench_forwarder_{qos}_", f"bench_processor_{qos}_")),
+    }
+    if args.kind == "point_cloud":
+        writers = [sink.writer.stats() for sink in sinks]
+        result["writer"] = {
+            "written": sum(stats["written"] for stats in writers),
+            "dropped": sum(stats["dropped"] for stats in writers),
+            "max_flush_ms": max(stats["max_flush_ms"] for stats in writers),
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the device to host latency and throughput over MQTT")
+    parser.add_argument("--broker", help="host:port of an existing broker, defaults to the local stand-in")
+    parser.add_argument("--kind", choices=["point_cloud", "image"], default="point_cloud")
+    parser.add_argument("--points", type=int, default=DEFAULT_POINTS, help="Points per point cloud")
+    parser.add_argument("--codec", default=PointCloudForwarder.DEFAULT_CODEC, help="Point cloud codec, e.g. int16+zlib")
+    parser.add_argument("--resolution", default=DEFAULT_RESOLUTION, help="Image size, e.g. 640x480")
+    parser.add_argument("--compression", default="none", help="Image compression, e.g. png or jpeg")
+    parser.add_argument("--packet-size", type=int, default=DEFAULT_PACKET_SIZE,
+                        help="Chunk size of the point clouds or packet size of the images in bytes")
+    parser.add_argument("--qos", type=int, nargs="+", default=[0, 1, 2], choices=[0, 1, 2])
+    parser.add_argument("--streams", type=int, default=1, help="Number of concurrent streams")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="Frames per second of each stream, 0 for max")
+    parser.add_argument("--queue-size", type=int, help="Sender queue size of each forwarder, defaults to theirs")
+    parser.add_argument("--bytes-per-sec", type=float, help="Rate limit of the device, defaults to none")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="Seconds of publishing per QoS level")
+    parser.add_argument("--drain-timeout", type=float, default=DEFAULT_DRAIN_TIMEOUT)
+    parser.add_argument("--topic", default=DEFAULT_TOPIC, help="Prefix of the stream topics")
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    args = parser.parse_args()
+    if args.rate <= 0:
+        args.rate = None
+    if args.queue_size is None:
+        forwarder = PointCloudForwarder if args.kind == "point_cloud" else ImageForwarder
+        args.queue_size = forwarder.DEFAULT_QUEUE_SIZE
+
+    rng = np.random.default_rng(0)
+    if args.kind == "point_cloud":
+        payload = rng.uniform(-5.0, 5.0, size=(args.points, 3)).astype(np.float32)
+    else:
+        width, height = (int(value) for value in args.resolution.split("x"))
+        payload = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+
+    broker = None
+    if args.broker:
+        host, port = args.broker.rsplit(":", 1)
+        port = int(port)
+    else:
+        broker = LocalBroker()
+        host, port = "127.0.0.1", broker.start()
+
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            results = [run_qos(qos, args, payload, host, port, folder) for qos in args.qos]
+    finally:
+        if broker is not None:
+            broker.stop()
+
+    report = {
+        "config": {
+            "kind": args.kind,
+            "payload_bytes": payload.nbytes,
+            "codec": args.codec if args.kind == "point_cloud" else args.compression,
+            "packet_size": args.packet_size,
+            "streams": args.streams,
+            "rate": args.rate,
+            "queue_size": args.queue_size,
+            "bytes_per_sec": args.bytes_per_sec,
+            "duration": args.duration,
+            "broker": args.broker or "local",
+        },
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
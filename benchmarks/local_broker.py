@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+'''
+A minimal MQTT 3.1.1 broker for local benchmarks and replays.
+
+It stands in for mosquitto on a development machine: CONNECT, PUBLISH at
+QoS 0, 1 and 2, SUBSCRIBE and UNSUBSCRIBE with the + and # wildcards,
+PINGREQ and DISCONNECT. It keeps no sessions, retained messages or wills
+and never retransmits, which is fine over the loopback interface but not
+for anything else.
+
+    python benchmarks/local_broker.py --port 1883
+
+LocalBroker runs the same broker on a background thread, e.g. for
+bench_e2e.py.
+'''
+
+import argparse
+import asyncio
+import logging
+import struct
+import threading
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    data = value.encode()
+    return struct.pack("!H", len(data)) + data
+
+
+def topic_matches(topic_filter, topic):
+    """
+    Check if a topic matches a subscription filter with the + and # wildcards
+    """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class _Session:
+    """
+    A connected client: its stream writer, subscriptions and packet ids
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.client_id = ""
+        self.subscriptions = {}
+        self.next_packet_id = 0
+        # QoS 2 packet ids received and not released yet, a duplicate PUBLISH is not delivered twice
+        self.incoming_qos2 = set()
+
+    def packet_id(self):
+        self.next_packet_id = self.next_packet_id % 0xFFFF + 1
+        return self.next_packet_id
+
+    def send(self, packet_type, flags, body):
+        self.writer.write(bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body)
+
+
+class Broker:
+    """
+    The broker state and the asyncio connection handler
+    """
+
+    def __init__(self):
+        self.sessions = set()
+        self.num_published = 0
+        self.num_delivered = 0
+
+    async def handle(self, reader, writer):
+        session = _Session(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                first = await reader.readexactly(1)
+                length = 0
+                multiplier = 1
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length) if length else b""
+                packet_type, flags = first[0] >> 4, first[0] & 0x0F
+                if packet_type == DISCONNECT:
+                    break
+                await self.dispatch(session, packet_type, flags, body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    async def dispatch(self, session, packet_type, flags, body):
+        if packet_type == CONNECT:
+            (name_length,) = struct.unpack_from("!H", body, 0)
+            offset = 2 + name_length + 4
+            (id_length,) = struct.unpack_from("!H", body, offset)
+            session.client_id = body[offset + 2:offset + 2 + id_length].decode()
+            session.send(CONNACK, 0, b"\x00\x00")
+        elif packet_type == PUBLISH:
+            await self.on_publish(session, flags, body)
+        elif packet_type == PUBREL:
+            session.incoming_qos2.discard(struct.unpack("!H", body[:2])[0])
+            session.send(PUBCOMP, 0, body[:2])
+        elif packet_type == PUBREC:
+            # Outgoing QoS 2, release the message the client has received
+            session.send(PUBREL, 2, body[:2])
+        elif packet_type in (PUBACK, PUBCOMP):
+            pass
+        elif packet_type == SUBSCRIBE:
+            packet_id = body[:2]
+            offset = 2
+            granted = bytearray()
+            while offset < len(body):
+                (filter_length,) = struct.unpack_from("!H", body, offset)
+                topic_filter = body[offset + 2:offset + 2 + filter_length].decode()
+                qos = body[offset + 2 + filter_length] & 0x03
+                session.subscriptions[topic_filter] = qos
+                granted.append(qos)
+                offset += 3 + filter_length
+            session.send(SUBACK, 0, packet_id + bytes(granted))
+        elif packet_type == UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                (filter_length,) = struct.unpack_from("!H", body, offset)
+                session.subscriptions.pop(body[offset + 2:offset + 2 + filter_length].decode(), None)
+                offset += 2 + filter_length
+            session.send(UNSUBACK, 0, body[:2])
+        elif packet_type == PINGREQ:
+            session.send(PINGRESP, 0, b"")
+        await session.writer.drain()
+
+    async def on_publish(self, session, flags, body):
+        qos = (flags >> 1) & 0x03
+        (topic_length,) = struct.unpack_from("!H", body, 0)
+        topic = body[2:2 + topic_length].decode()
+        offset = 2 + topic_length
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+        payload = body[offset:]
+
+        if qos == 1:
+            session.send(PUBACK, 0, packet_id)
+        elif qos == 2:
+            session.send(PUBREC, 0, packet_id)
+            key = struct.unpack("!H", packet_id)[0]
+            if key in session.incoming_qos2:
+                return
+            session.incoming_qos2.add(key)
+
+        self.num_published += 1
+        encoded_topic = encode_string(topic)
+        for subscriber in list(self.sessions):
+            granted = [value for topic_filter, value in subscriber.subscriptions.items()
+                       if topic_matches(topic_filter, topic)]
+            if not granted:
+                continue
+            out_qos = min(qos, max(granted))
+            if out_qos:
+                variable = encoded_topic + struct.pack("!H", subscriber.packet_id())
+            else:
+                variable = encoded_topic
+            subscriber.send(PUBLISH, out_qos << 1, variable + payload)
+            self.num_delivered += 1
+            if subscriber is not session:
+                # Slow subscribers push back on the publisher through TCP flow control
+                await subscriber.writer.drain()
+
+
+class LocalBroker:
+    """
+    Run a Broker on a background thread
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        """
+        :param host: The interface to listen on
+        :param port: The port to listen on, 0 picks a free port
+        """
+        self.host = host
+        self.port = port
+        self.broker = Broker()
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._thread = threading.Thread(target=self._loop.run_forever, name="local_broker", daemon=True)
+
+    def start(self):
+        """
+        Start listening
+        :return: The port the broker listens on
+        """
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self.broker.handle, self.host, self.port)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        async def close():
+            self._server.close()
+            await self._server.wait_closed()
+            for session in list(self.broker.sessions):
+                session.writer.close()
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result(5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a minimal local MQTT broker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    async def serve():
+        server = await asyncio.start_server(Broker().handle, args.host, args.port)
+        logging.info(f"Local broker listening on {args.host}:{args.port}")
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+'''
+Minimal stand-ins for rospy and sensor_msgs, so the benchmarks can drive the
+real forwarders and processors on a machine without ROS.
+
+install() registers them in sys.modules, only when rospy cannot be imported,
+so a machine with ROS keeps the real modules. The stand-ins cover what the
+forwarders and processors use: rospy.Time, a rospy.Subscriber that keeps
+its callback for the benchmark to call, the logging and shutdown functions,
+and the Header, PointCloud and Image messages.
+'''
+
+import logging
+import sys
+import types
+
+
+class Time:
+    """
+    rospy.Time, seconds and nanoseconds
+    """
+
+    def __init__(self, secs=0, nsecs=0):
+        self.secs = secs
+        self.nsecs = nsecs
+
+    def to_nsec(self):
+        return self.secs * 1000000000 + self.nsecs
+
+
+class Subscriber:
+    """
+    rospy.Subscriber, it does not receive anything, the benchmark calls the callback with its messages
+    """
+
+    def __init__(self, name, data_class, callback=None, *args, **kwargs):
+        self.name = name
+        self.data_class = data_class
+        self.callback = callback
+
+    def unregister(self):
+        self.callback = None
+
+
+class Header:
+    def __init__(self, seq=0, stamp=None, frame_id=""):
+        self.seq = seq
+        self.stamp = stamp if stamp is not None else Time()
+        self.frame_id = frame_id
+
+
+class PointCloud:
+    def __init__(self, header=None, points=None, channels=None):
+        self.header = header if header is not None else Header()
+        self.points = points if points is not None else []
+        self.channels = channels if channels is not None else []
+
+
+class Image:
+    def __init__(self, header=None, height=0, width=0, encoding="", is_bigendian=0, step=0, data=b""):
+        self.header = header if header is not None else Header()
+        self.height = height
+        self.width = width
+        self.encoding = encoding
+        self.is_bigendian = is_bigendian
+        self.step = step
+        self.data = data
+
+
+def install():
+    """
+    Register the stand-ins as rospy and sensor_msgs.msg, unless ROS is installed
+    :return: True if the stand-ins were registered
+    """
+    try:
+        import rospy  # noqa: F401
+        return False
+    except ImportError:
+        pass
+
+    logger = logging.getLogger("rospy")
+    rospy = types.ModuleType("rospy")
+    rospy.Time = Time
+    rospy.Subscriber = Subscriber
+    rospy.loginfo = logger.info
+    rospy.logdebug = logger.debug
+    rospy.logwarn = logger.warning
+    rospy.logerr = logger.error
+    rospy.signal_shutdown = lambda reason: logger.info(f"Shutdown requested: {reason}")
+    rospy.is_shutdown = lambda: False
+
+    sensor_msgs = types.ModuleType("sensor_msgs")
+    msg = types.ModuleType("sensor_msgs.msg")
+    msg.Header = Header
+    msg.PointCloud = PointCloud
+    msg.Image = Image
+    sensor_msgs.msg = msg
+
+    sys.modules["rospy"] = rospy
+    sys.modules["sensor_msgs"] = sensor_msgs
+    sys.modules["sensor_msgs.msg"] = msg
+    return True
@@ -9,4 +9,46 @@ class MQTT_BROKER:
     PORT = 1883
 
 
-    
\ No newline at end of file
+class DEVICE:
+    # Set a unique id, e.g. "vibot-07", to namespace the topics of this Vibot when a host manages a fleet.
+    # None keeps the global topics of a single Vibot.
+    ID = None
+
+
+class RATE_LIMIT:
+    # Shared by the point cloud and image forwarders. Set a value to None to disable that limit.
+    BYTES_PER_SEC = 1024 * 1024
+    BURST_BYTES = 512 * 1024
+    MESSAGES_PER_SEC = 500
+    BURST_MESSAGES = 100
+    # Publishes not yet completed by the broker, paces the forwarders on the acknowledgements
+    MAX_IN_FLIGHT = 20
+
+
+class METRICS:
+    # Seconds between two snapshots published on /iot_device/metrics
+    INTERVAL = 10.0
+
+
+class RECONNECT:
+    # Seconds before the first reconnect attempt, doubled after each failure up to MAX_BACKOFF, with jitter
+    MIN_BACKOFF = 1.0
+    MAX_BACKOFF = 60.0
+    # Messages published while offline, sent in order on reconnect. "drop_oldest" or "drop_newest" when full.
+    BUFFER_SIZE = 1000
+    BUFFER_BYTES = 8 * 1024 * 1024
+    BUFFER_POLICY = "drop_oldest"
+
+
+class SPOOL:
+    # Keep the point clouds and images published while offline on disk, and send them once reconnected
+    ENABLED = False
+    FOLDER = "spool"
+    # Each priority keeps at most MAX_SEGMENTS files of SEGMENT_BYTES, the oldest one is dropped beyond it
+    SEGMENT_BYTES = 16 * 1024 * 1024
+    MAX_SEGMENTS = 64
+    # Seconds and bytes between two fsyncs of the spooled messages
+    FSYNC_INTERVAL = 1.0
+    FSYNC_BYTES = 4 * 1024 * 1024
+    # Pace of the drain after a reconnect, leaves the rest of the RATE_LIMIT budget to the live traffic
+    DRAIN_BYTES_PER_SEC = 256 * 1024
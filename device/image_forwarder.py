@@ -1,8 +1,11 @@
 import logging
+import time
 import rospy
 from sensor_msgs.msg import Image
 from bridge import Bridge
-import time
+from sender import SenderQueue
+import image_codec
+import metrics
 
 class ImageForwarder(Bridge):
     # Define class constants for magic numbers
@@ -11,6 +14,14 @@ class ImageForwarder(Bridge):
     DEFAULT_KEEPALIVE = 60
     DEFAULT_EXIT_ON_COMPLETE = False
     DEFAULT_ENABLE_LOGGING = True
+    # "png" is lossless, "jpeg" is lossy with the given quality, "none" sends the raw image data
+    DEFAULT_COMPRESSION = "png"
+    DEFAULT_QUALITY = None
+    # Images waiting for the publisher thread, see sender.SenderQueue for the overflow policies
+    DEFAULT_QUEUE_SIZE = 2
+    DEFAULT_OVERFLOW_POLICY = "drop_oldest"
+    # Drain order of the images spooled while offline, lower goes first
+    DEFAULT_SPOOL_PRIORITY = 1
 
     def __init__(
         self,
@@ -25,13 +36,36 @@ class ImageForwarder(Bridge):
         qos=DEFAULT_QOS,
         exit_on_complete=DEFAULT_EXIT_ON_COMPLETE,
         enable_logging=DEFAULT_ENABLE_LOGGING,
+        compression=DEFAULT_COMPRESSION,
+        quality=DEFAULT_QUALITY,
+        rate_limiter=None,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        overflow_policy=DEFAULT_OVERFLOW_POLICY,
+        connection=None,
+        spool=None,
+        spool_priority=DEFAULT_SPOOL_PRIORITY,
     ):
+        # Validate user inputs
+        if compression not in image_codec.COMPRESSIONS:
+            raise ValueError(f"Compression must be one of {tuple(image_codec.COMPRESSIONS)}")
+
         self.sub = None
         self.is_forwarding = False
         self.packet_size = packet_size
+        self.compression = compression
+        self.quality = quality
         self.num_packets_forwarded = 0
         self.num_image_forwarded = 0
         self.exit_on_complete = exit_on_complete
+        # The ROS callback only queues the message, compression and publishing run on the sender thread
+        self.sender = SenderQueue(
+            self.forward_image, queue_size, overflow_policy, name="image_sender"
+        )
+        # Stage timings and queue state, published with the device metrics
+        self.callback_time = metrics.REGISTRY.histogram(f"{client_id}.callback_seconds")
+        self.encode_time = metrics.REGISTRY.histogram(f"{client_id}.encode_seconds")
+        self.queue_depth = metrics.REGISTRY.gauge(f"{client_id}.queue_depth")
+        self.queue_dropped = metrics.REGISTRY.gauge(f"{client_id}.queue_dropped")
 
         if enable_logging:
             # Configure logging to both console and file
@@ -51,24 +85,65 @@ class ImageForwarder(Bridge):
             file_handler.setFormatter(formatter)
             self.logger.addHandler(file_handler)
 
-        super().__init__(mqtt_topic, client_id, user_id, password, host, port, keepalive, qos)
+        # The rate limiter paces the publishes, it can be shared with the other forwarders,
+        # and so can the connection to the broker
+        super().__init__(mqtt_topic, client_id, user_id, password, host, port, keepalive, qos, rate_limiter,
+                         connection=connection)
+        # Optional disk-backed queue of the messages published while offline, drained on reconnect
+        self.spool = spool
+        self.spool_priority = spool_priority
+        if spool is not None:
+            spool.register(mqtt_topic, self)
+
+    def on_connect(self, client, userdata, flags, rc):
+        # A publisher only, subscribing to its own topic would receive every message back
+        self.timeout = 0
+
+    def send_message(self, message):
+        # While offline, the spool keeps the message on disk instead of the bounded buffer of the connection
+        if self.spool is not None and not self.connection.online:
+            self.spool.append(self.mqtt_topic, message, self.qos, priority=self.spool_priority)
+        else:
+            self.publish(self.mqtt_topic, message, self.qos)
 
     def image_callback(self, msg):
+        if self.is_forwarding:
+            start = time.perf_counter()
+            if not self.sender.put(msg):
+                self.logger.debug("Sender queue is full, dropped an image")
+            self.queue_depth.set(self.sender.depth)
+            self.queue_dropped.set(self.sender.num_dropped)
+            self.callback_time.observe(time.perf_counter() - start)
+
+    def forward_image(self, msg):
+        """
+        Compress, split and publish an image, called on the sender thread
+        """
         if self.is_forwarding:
             try:
-                
-                # 1. Convert the ROS message to a bytearray
-                byte_array = bytearray(msg.data)
-
-                # 2. Split the byte array into smaller packets
-                num_packets = (len(byte_array) + self.packet_size - 1) // self.packet_size
-
-                for i in range(num_packets):
-                    start = i * self.packet_size
-                    end = (i + 1) * self.packet_size
-                    packet = byte_array[start:end]
-                    self.publish(self.mqtt_topic, message=packet)
-                    time.sleep(0.01)
+                # 1. Compress the image data, the original metadata travels in the packet headers
+                start = time.perf_counter()
+                compression, data = image_codec.compress_image(
+                    msg.data, msg.width, msg.height, msg.encoding, msg.step, self.compression, self.quality
+                )
+                self.logger.debug(
+                    "Compressed image {} from {} to {} bytes as {}".format(
+                        self.num_image_forwarded, len(msg.data), len(data), compression
+                    )
+                )
+
+                # 2. Split the image data into packets, each carrying the image id, its index and the image metadata
+                stamp = msg.header.stamp
+                packets = image_codec.split_image(
+                    data, self.num_image_forwarded, self.packet_size,
+                    msg.width, msg.height, msg.encoding, msg.step,
+                    msg.is_bigendian, stamp.secs, stamp.nsecs, compression
+                )
+                num_packets = len(packets)
+                self.encode_time.observe(time.perf_counter() - start)
+
+                for i, packet in enumerate(packets):
+                    self.send_message(packet)
                     self.logger.info(
                         "Forwarded packet {} of {} with payload size {}".format(
                             self.num_packets_forwarded + i + 1, num_packets, len(packet)
@@ -76,6 +151,7 @@ class ImageForwarder(Bridge):
                     )
 
                 self.logger.info("Forwarded image {} successfully".format(self.num_image_forwarded))
+                self.num_image_forwarded += 1
 
                 # Increment the number of packets forwarded
                 self.num_packets_forwarded += num_packets
@@ -83,7 +159,8 @@ class ImageForwarder(Bridge):
                 # Unsubscribe from the ROS topic if we've forwarded the desired number of packets
                 if self.num_packets_forwarded >= self.num_packets:
                     # Unsubscribe from the ROS topic
-                    self.sub.unregister()
+                    if self.sub is not None:
+                        self.sub.unregister()
                     rospy.loginfo("Forwarded {} packets, unsubscribing from topic".format(self.num_packets))
                     
                     if self.exit_on_complete:
@@ -0,0 +1,536 @@
+'''
+Wire format of the point cloud frames transferred from the device to the host.
+
+A frame is a fixed-size little-endian header followed by the point body
+produced by one of the registered codecs:
+
+    magic | version | layout | codec | point count | sequence | stamp secs | stamp nsecs | body ...
+
+The "raw" codec body is one contiguous buffer of little-endian float32
+coordinates (x0 y0 z0 x1 y1 z1 ...). The other codecs quantize it to int16
+fixed point and optionally compress it with zlib or lzma. The codec name is
+announced in the start_pc response, and its id is repeated in every header.
+
+Frames larger than the broker message size limit are split into chunks,
+each carrying its own chunk header in front of a slice of the frame:
+
+    chunk magic | frame id | chunk index | chunk count | frame size | offset | slice ...
+
+FrameAssembler puts the slices back together on the host.
+
+The legacy format, used before the header was introduced, is the bare
+float32 buffer converted to a hexadecimal string. decode_points() accepts
+both and tells them apart by the frame magic.
+
+This module is shared by the device and the host, keep both copies identical.
+'''
+
+import binascii
+import lzma
+import struct
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+from itertools import chain
+
+import numpy as np
+
+FRAME_MAGIC = b"VPCF"
+FRAME_VERSION = 1
+
+# Field layouts of the point buffer, mapped to the number of float32 per point
+LAYOUT_XYZ_F32 = 0
+LAYOUT_FIELDS = {LAYOUT_XYZ_F32: 3}
+
+# magic, version, layout, codec id, pad, point count, sequence, stamp secs, stamp nsecs
+FRAME_HEADER = struct.Struct("<4sBBBxIIII")
+POINT_DTYPE = np.dtype("<f4")
+
+CHUNK_MAGIC = b"VPCC"
+# chunk magic, frame id, chunk index, chunk count, frame size, offset of the slice in the frame
+CHUNK_HEADER = struct.Struct("<4sIIIII")
+
+FrameHeader = namedtuple(
+    "FrameHeader", ["version", "layout", "codec_id", "point_count", "seq", "stamp_secs", "stamp_nsecs"]
+)
+ChunkHeader = namedtuple(
+    "ChunkHeader", ["frame_id", "chunk_index", "chunk_count", "frame_size", "offset"]
+)
+
+
+class CodecStats(namedtuple("CodecStats", ["raw_bytes", "encoded_bytes", "seconds"])):
+    """
+    Size and timing of the last frame encoded or decoded by a codec
+    """
+
+    @property
+    def bytes_saved(self):
+        return self.raw_bytes - self.encoded_bytes
+
+    @property
+    def ratio(self):
+        return self.raw_bytes / self.encoded_bytes if self.encoded_bytes else 0.0
+
+
+class PointCloudCodec:
+    """
+    Base class of the point cloud codecs. Subclasses implement _encode and _decode.
+    """
+    NAME = None
+
+    def __init__(self):
+        self.name = self.NAME
+        # Set from the registry when the codec is created by name or id
+        self.codec_id = None
+        self.encode_stats = CodecStats(0, 0, 0.0)
+        self.decode_stats = CodecStats(0, 0, 0.0)
+
+    def encode(self, points):
+        """
+        Encode an (N, 3) float32 array into the body of a frame
+        :return: A bytes-like object
+        """
+        start = time.perf_counter()
+        body = self._encode(points)
+        self.encode_stats = CodecStats(points.nbytes, len(body), time.perf_counter() - start)
+        return body
+
+    def decode(self, body, point_count):
+        """
+        Decode the body of a frame into an (N, 3) float32 array
+        """
+        start = time.perf_counter()
+        points = self._decode(body, point_count)
+        self.decode_stats = CodecStats(points.nbytes, len(body), time.perf_counter() - start)
+        return points
+
+    def _encode(self, points):
+        raise NotImplementedError
+
+    def _decode(self, body, point_count):
+        raise NotImplementedError
+
+
+class RawCodec(PointCloudCodec):
+    """
+    Little-endian float32 xyz, the body is a view of the points and decodes without copying
+    """
+    NAME = "raw"
+
+    def _encode(self, points):
+        return memoryview(np.ascontiguousarray(points, dtype=POINT_DTYPE)).cast("B")
+
+    def _decode(self, body, point_count):
+        if len(body) < point_count * 3 * POINT_DTYPE.itemsize:
+            raise ValueError("Point cloud frame is truncated")
+        return np.frombuffer(body, dtype=POINT_DTYPE, count=point_count * 3).reshape(point_count, 3)
+
+
+class Int16Codec(PointCloudCodec):
+    """
+    int16 fixed point with a per-frame scale and offset for each axis.
+    The quantization step is (max - min) / 65535 of the frame extent on that axis.
+    """
+    NAME = "int16"
+    # scale xyz, offset xyz
+    QUANT_HEADER = struct.Struct("<6f")
+    QUANT_DTYPE = np.dtype("<i2")
+
+    def _encode(self, points):
+        points = np.asarray(points, dtype=POINT_DTYPE)
+        if len(points):
+            offset = points.min(axis=0)
+            scale = (points.max(axis=0) - offset) / 65535.0
+        else:
+            offset = np.zeros(3, dtype=POINT_DTYPE)
+            scale = np.zeros(3, dtype=POINT_DTYPE)
+        scale[scale == 0] = 1.0
+
+        body = bytearray(self.QUANT_HEADER.size + points.size * self.QUANT_DTYPE.itemsize)
+        self.QUANT_HEADER.pack_into(body, 0, *scale.tolist(), *offset.tolist())
+        quantized = np.frombuffer(body, dtype=self.QUANT_DTYPE, offset=self.QUANT_HEADER.size).reshape(-1, 3)
+        scaled = (points - offset) / scale
+        scaled -= 32768.0
+        np.clip(scaled, -32768.0, 32767.0, out=scaled)
+        np.rint(scaled, out=quantized, casting="unsafe")
+        return body
+
+    def _decode(self, body, point_count):
+        if len(body) < self.QUANT_HEADER.size + point_count * 3 * self.QUANT_DTYPE.itemsize:
+            raise ValueError("Point cloud frame is truncated")
+        values = self.QUANT_HEADER.unpack_from(body, 0)
+        scale = np.array(values[:3], dtype=POINT_DTYPE)
+        offset = np.array(values[3:], dtype=POINT_DTYPE)
+        quantized = np.frombuffer(
+            body, dtype=self.QUANT_DTYPE, count=point_count * 3, offset=self.QUANT_HEADER.size
+        ).reshape(point_count, 3)
+        points = quantized.astype(POINT_DTYPE)
+        points += 32768.0
+        points *= scale
+        points += offset
+        return points
+
+
+class CompressedCodec(PointCloudCodec):
+    """
+    A general-purpose compressor applied on top of another codec
+    """
+    COMPRESSORS = {
+        "zlib": (zlib.compress, zlib.decompress, 6),
+        "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 1),
+    }
+
+    def __init__(self, inner, compressor, level=None):
+        super().__init__()
+        if compressor not in self.COMPRESSORS:
+            raise ValueError(f"Compressor must be one of {tuple(self.COMPRESSORS)}")
+        self._compress, self._decompress, default_level = self.COMPRESSORS[compressor]
+        self.level = default_level if level is None else level
+        if not 0 <= self.level <= 9:
+            raise ValueError("Compression level must be between 0 and 9")
+        self.inner = inner
+        self.name = f"{inner.NAME}+{compressor}:{self.level}"
+
+    def _encode(self, points):
+        return self._compress(self.inner._encode(points), self.level)
+
+    def _decode(self, body, point_count):
+        return self.inner._decode(self._decompress(body), point_count)
+
+
+# Codec ids written into the frame header, mapped to a factory taking the compression level
+CODECS = {}
+# Codec names mapped to their ids
+CODEC_IDS = {}
+
+
+def register_codec(name, codec_id, factory):
+    """
+    Register a codec so both the forwarder and the processor can create it by name
+    :param name: The name announced in the start_pc response, without the compression level
+    :param codec_id: The id written into the frame header
+    :param factory: A callable taking the compression level (or None) and returning a PointCloudCodec
+    """
+    if codec_id in CODECS or name in CODEC_IDS:
+        raise ValueError(f"Codec {name} ({codec_id}) is already registered")
+    CODECS[codec_id] = factory
+    CODEC_IDS[name] = codec_id
+
+
+register_codec("raw", 0, lambda level: RawCodec())
+register_codec("int16", 1, lambda level: Int16Codec())
+register_codec("int16+zlib", 2, lambda level: CompressedCodec(Int16Codec(), "zlib", level))
+register_codec("int16+lzma", 3, lambda level: CompressedCodec(Int16Codec(), "lzma", level))
+register_codec("raw+zlib", 4, lambda level: CompressedCodec(RawCodec(), "zlib", level))
+register_codec("raw+lzma", 5, lambda level: CompressedCodec(RawCodec(), "lzma", level))
+
+
+def create_codec(name):
+    """
+    Create a codec from its name, e.g. "raw", "int16" or "int16+zlib:9"
+    :param name: The codec name, optionally followed by ":<level>" for the compressed codecs
+    """
+    base, _, level = name.partition(":")
+    if base not in CODEC_IDS:
+        raise ValueError(f"Unknown point cloud codec {name}, must be one of {tuple(CODEC_IDS)}")
+    return create_codec_by_id(CODEC_IDS[base], int(level) if level else None)
+
+
+def create_codec_by_id(codec_id, level=None):
+    """
+    Create a codec from the id found in a frame header
+    :param codec_id: The registered codec id
+    :param level: The compression level. Optional, only used by the compressed codecs.
+    """
+    if codec_id not in CODECS:
+        raise ValueError(f"Unknown point cloud codec id {codec_id}")
+    codec = CODECS[codec_id](level)
+    codec.codec_id = codec_id
+    return codec
+
+
+def points_to_array(points):
+    """
+    Convert a sequence of ROS Point32 messages into an (N, 3) float32 array
+    :param points: The points of a sensor_msgs/PointCloud message
+    """
+    num_points = len(points)
+    flat = np.fromiter(
+        chain.from_iterable((p.x, p.y, p.z) for p in points),
+        dtype=POINT_DTYPE, count=3 * num_points
+    )
+    return flat.reshape(num_points, 3)
+
+
+def encode_frame(points, seq=0, stamp_secs=0, stamp_nsecs=0, codec=None):
+    """
+    Encode the points into a binary frame
+    :param points: An (N, 3) array of xyz coordinates
+    :param seq: The sequence number of the frame
+    :param stamp_secs: The seconds part of the source timestamp
+    :param stamp_nsecs: The nanoseconds part of the source timestamp
+    :param codec: The PointCloudCodec encoding the body. Optional, defaults to raw float32.
+    :return: A bytearray holding the header and the body
+    """
+    if codec is None:
+        codec = create_codec("raw")
+    points = np.ascontiguousarray(points, dtype=POINT_DTYPE).reshape(-1, 3)
+    body = codec.encode(points)
+    frame = bytearray(FRAME_HEADER.size + len(body))
+    FRAME_HEADER.pack_into(
+        frame, 0, FRAME_MAGIC, FRAME_VERSION, LAYOUT_XYZ_F32, codec.codec_id,
+        len(points), seq & 0xFFFFFFFF, stamp_secs, stamp_nsecs
+    )
+    # One copy of the whole body straight behind the header
+    memoryview(frame)[FRAME_HEADER.size:] = body
+    return frame
+
+
+def encode_legacy_hex(points):
+    """
+    Encode the points in the legacy format: hexadecimal text of the bare float32 buffer
+    :param points: An (N, 3) array of xyz coordinates
+    """
+    points = np.ascontiguousarray(points, dtype=POINT_DTYPE)
+    return binascii.hexlify(points).decode()
+
+
+def decode_header(buffer):
+    """
+    Parse the header at the start of a binary frame
+    :param buffer: A bytes-like object holding a binary frame
+    :return: A FrameHeader tuple
+    """
+    if len(buffer) < FRAME_HEADER.size:
+        raise ValueError("Buffer is too short to hold a point cloud frame header")
+    magic, version, layout, codec_id, point_count, seq, secs, nsecs = FRAME_HEADER.unpack_from(buffer, 0)
+    if magic != FRAME_MAGIC:
+        raise ValueError("Buffer does not start with the point cloud frame magic")
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported point cloud frame version {version}")
+    if layout not in LAYOUT_FIELDS:
+        raise ValueError(f"Unsupported point cloud field layout {layout}")
+    return FrameHeader(version, layout, codec_id, point_count, seq, secs, nsecs)
+
+
+def decode_points(payload, codec=None):
+    """
+    Decode an MQTT payload into an (N, 3) float32 array without per-point Python objects.
+    Raw frames are mapped in place, so the returned array is a read-only view of the payload.
+    :param payload: The payload of the MQTT message, a binary frame or legacy hexadecimal text
+    :param codec: The PointCloudCodec announced for the transfer. Optional, defaults to the codec in the header.
+    :return: A (FrameHeader or None, points) tuple, the header is None for legacy payloads
+    """
+    if bytes(payload[:len(FRAME_MAGIC)]) == FRAME_MAGIC:
+        header = decode_header(payload)
+        if codec is None:
+            codec = create_codec_by_id(header.codec_id)
+        elif codec.codec_id != header.codec_id:
+            raise ValueError(
+                f"Frame is encoded with codec id {header.codec_id} but {codec.name} was announced"
+            )
+        points = codec.decode(memoryview(payload)[FRAME_HEADER.size:], header.point_count)
+        return header, points
+
+    # Legacy payload, hexadecimal text of the bare float32 buffer
+    try:
+        binary = binascii.unhexlify(payload)
+    except (binascii.Error, ValueError):
+        raise ValueError("Payload is neither a point cloud frame nor legacy hexadecimal text")
+    if len(binary) % (3 * POINT_DTYPE.itemsize):
+        raise ValueError("Legacy point cloud payload is not a whole number of points")
+    return None, np.frombuffer(binary, dtype=POINT_DTYPE).reshape(-1, 3)
+
+
+def is_chunk(payload):
+    """
+    Check if the payload is a chunk of a split frame
+    """
+    return bytes(payload[:len(CHUNK_MAGIC)]) == CHUNK_MAGIC
+
+
+def split_frame(frame, frame_id, max_chunk_size):
+    """
+    Split a frame into chunks of at most max_chunk_size bytes, chunk header included.
+    A frame that already fits is returned unchanged as the only element.
+    :param frame: A bytes-like object holding a binary frame
+    :param frame_id: The id shared by all the chunks of the frame, usually its sequence number
+    :param max_chunk_size: The upper bound of the chunk size in bytes
+    :return: A list of bytes-like objects to publish in order
+    """
+    if len(frame) <= max_chunk_size:
+        return [frame]
+    slice_size = max_chunk_size - CHUNK_HEADER.size
+    if slice_size <= 0:
+        raise ValueError(f"Chunk size must be larger than the {CHUNK_HEADER.size} byte chunk header")
+
+    view = memoryview(frame)
+    chunk_count = (len(frame) + slice_size - 1) // slice_size
+    chunks = []
+    for index in range(chunk_count):
+        offset = index * slice_size
+        piece = view[offset:offset + slice_size]
+        chunk = bytearray(CHUNK_HEADER.size + len(piece))
+        CHUNK_HEADER.pack_into(
+            chunk, 0, CHUNK_MAGIC, frame_id & 0xFFFFFFFF, index, chunk_count, len(frame), offset
+        )
+        memoryview(chunk)[CHUNK_HEADER.size:] = piece
+        chunks.append(chunk)
+    return chunks
+
+
+def decode_chunk_header(buffer):
+    """
+    Parse the header at the start of a chunk
+    :return: A ChunkHeader tuple
+    """
+    if len(buffer) < CHUNK_HEADER.size:
+        raise ValueError("Buffer is too short to hold a point cloud chunk header")
+    magic, *fields = CHUNK_HEADER.unpack_from(buffer, 0)
+    if magic != CHUNK_MAGIC:
+        raise ValueError("Buffer does not start with the point cloud chunk magic")
+    header = ChunkHeader(*fields)
+    if header.chunk_index >= header.chunk_count:
+        raise ValueError(f"Chunk index {header.chunk_index} is out of range of {header.chunk_count} chunks")
+    # Every chunk carries at least one byte of the frame, a larger count is corrupt or hostile
+    if header.chunk_count > header.frame_size:
+        raise ValueError(f"Chunk count {header.chunk_count} exceeds the {header.frame_size} byte frame size")
+    if header.offset + len(buffer) - CHUNK_HEADER.size > header.frame_size:
+        raise ValueError("Chunk slice runs past the end of the frame")
+    return header
+
+
+class _PartialFrame:
+    """
+    A frame being reassembled: the preallocated frame buffer and the chunks written into it
+    """
+    __slots__ = ("buffer", "chunk_count", "received", "num_received", "deadline")
+
+    def __init__(self, frame_size, chunk_count, deadline):
+        self.buffer = bytearray(frame_size)
+        self.chunk_count = chunk_count
+        self.received = bytearray(chunk_count)
+        self.num_received = 0
+        self.deadline = deadline
+
+    @property
+    def footprint(self):
+        """
+        The bytes held by the frame buffer and the chunk bitmap
+        """
+        return len(self.buffer) + len(self.received)
+
+
+class FrameAssembler:
+    """
+    Reassemble the chunks produced by split_frame into whole frames.
+    Chunks may arrive in any order and duplicates are ignored. Incomplete frames are evicted
+    when their timeout expires or when the partial frames exceed the memory cap, oldest first.
+    A completed frame id is only remembered for the timeout, so the ids restarting at 0 after
+    the device restarted are not taken for duplicates.
+    """
+    DEFAULT_TIMEOUT = 10.0
+    DEFAULT_MAX_PENDING_BYTES = 64 * 1024 * 1024
+    # Number of completed frame ids remembered to drop their late duplicate chunks
+    COMPLETED_HISTORY = 64
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_pending_bytes=DEFAULT_MAX_PENDING_BYTES):
+        """
+        :param timeout: Seconds after its first chunk before an incomplete frame is evicted
+        :param max_pending_bytes: The upper bound of memory held by incomplete frames
+        """
+        if timeout <= 0:
+            raise ValueError("Timeout must be positive")
+        if max_pending_bytes <= 0:
+            raise ValueError("Maximum pending bytes must be positive")
+
+        self.timeout = timeout
+        self.max_pending_bytes = max_pending_bytes
+        self._pending = OrderedDict()
+        self._completed = OrderedDict()
+        self.pending_bytes = 0
+        self.num_frames_completed = 0
+        self.num_frames_evicted = 0
+        self.num_chunks_dropped = 0
+
+    def add(self, chunk, now=None):
+        """
+        Write a chunk into its frame buffer
+        :param chunk: A bytes-like object holding one chunk
+        :param now: The current monotonic time. Optional, defaults to time.monotonic().
+        :return: The completed frame as a bytearray, or None while chunks are missing
+        """
+        if now is None:
+            now = time.monotonic()
+        header = decode_chunk_header(chunk)
+        self.evict_expired(now)
+
+        partial = self._pending.get(header.frame_id)
+        if partial is None and header.frame_id in self._completed:
+            if self._completed[header.frame_id][0] == (header.chunk_count, header.frame_size):
+                self.num_chunks_dropped += 1
+                return None
+            del self._completed[header.frame_id]
+        if partial is not None and (
+            partial.chunk_count != header.chunk_count or len(partial.buffer) != header.frame_size
+        ):
+            # The frame id has been reused, e.g. after the device restarted
+            self._evict(header.frame_id)
+            partial = None
+
+        if partial is None:
+            footprint = header.frame_size + header.chunk_count
+            if footprint > self.max_pending_bytes:
+                self.num_chunks_dropped += 1
+                return None
+            while self._pending and self.pending_bytes + footprint > self.max_pending_bytes:
+                self._evict(next(iter(self._pending)))
+            partial = _PartialFrame(header.frame_size, header.chunk_count, now + self.timeout)
+            self._pending[header.frame_id] = partial
+            self.pending_bytes += footprint
+
+        if partial.received[header.chunk_index]:
+            self.num_chunks_dropped += 1
+            return None
+        piece = memoryview(chunk)[CHUNK_HEADER.size:]
+        partial.buffer[header.offset:header.offset + len(piece)] = piece
+        partial.received[header.chunk_index] = 1
+        partial.num_received += 1
+
+        if partial.num_received < partial.chunk_count:
+            return None
+        del self._pending[header.frame_id]
+        self.pending_bytes -= partial.footprint
+        self.num_frames_completed += 1
+        self._completed[header.frame_id] = ((header.chunk_count, header.frame_size), now + self.timeout)
+        if len(self._completed) > self.COMPLETED_HISTORY:
+            self._completed.popitem(last=False)
+        return partial.buffer
+
+    def evict_expired(self, now=None):
+        """
+        Drop the incomplete frames whose timeout has expired, and forget the completed ids as old
+        """
+        if now is None:
+            now = time.monotonic()
+        # Frames are kept in arrival order of their first chunk, so the oldest deadline comes first
+        while self._pending:
+            frame_id, partial = next(iter(self._pending.items()))
+            if partial.deadline > now:
+                break
+            self._evict(frame_id)
+        while self._completed and next(iter(self._completed.values()))[1] <= now:
+            self._completed.popitem(last=False)
+
+    def reset(self):
+        """
+        Drop the incomplete frames and forget the completed ids, e.g. when a new transfer starts
+        """
+        while self._pending:
+            self._evict(next(iter(self._pending)))
+        self._completed.clear()
+
+    def _evict(self, frame_id):
+        partial = self._pending.pop(frame_id)
+        self.pending_bytes -= partial.footprint
+        self.num_frames_evicted += 1
@@ -0,0 +1,279 @@
+'''
+Point cloud reduction stages run on the device before encoding.
+
+Every stage works on an (N, 3) float32 array with NumPy vectorized
+operations only, no Python loop over the points. The spatial filters build
+a boolean mask of the points to keep and are chained by FilterChain, which
+is configured from the JSON of the set_point_cloud_filters command.
+'''
+
+import time
+from collections import namedtuple
+
+import numpy as np
+
+VOXEL_MODES = ("centroid", "first")
+
+
+def voxel_keys(points, leaf_size):
+    """
+    Compute one integer key per point identifying its voxel
+    :param points: An (N, 3) array of xyz coordinates
+    :param leaf_size: The edge length of a voxel
+    :return: An (N,) int64 array, or an (N, 3) int64 array when the grid is too large for one int64
+    """
+    cells = np.floor(points / leaf_size).astype(np.int64)
+    cells -= cells.min(axis=0)
+    dims = cells.max(axis=0) + 1
+    if np.prod(dims.astype(np.float64)) >= 2 ** 62:
+        return cells
+    return np.ravel_multi_index(cells.T, dims)
+
+
+def voxel_downsample(points, leaf_size, mode="centroid"):
+    """
+    Keep one point per occupied voxel of a regular grid
+    :param points: An (N, 3) array of xyz coordinates
+    :param leaf_size: The edge length of a voxel, in the unit of the coordinates
+    :param mode: "centroid" averages the points of each voxel, "first" keeps the first point of each voxel
+    :return: An (M, 3) float32 array with M <= N
+    """
+    if leaf_size <= 0:
+        raise ValueError("Leaf size must be positive")
+    if mode not in VOXEL_MODES:
+        raise ValueError(f"Voxel mode must be one of {VOXEL_MODES}")
+    if len(points) == 0:
+        return points
+
+    keys = voxel_keys(points, leaf_size)
+    axis = 0 if keys.ndim > 1 else None
+    if mode == "first":
+        _, first = np.unique(keys, axis=axis, return_index=True)
+        # Keep the points in their original order
+        return points[np.sort(first)]
+
+    _, inverse, counts = np.unique(keys, axis=axis, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    centroids = np.empty((len(counts), 3), dtype=np.float32)
+    for dim in range(3):
+        centroids[:, dim] = np.bincount(inverse, weights=points[:, dim], minlength=len(counts)) / counts
+    return centroids
+
+
+def random_sample(points, max_points, rng=None):
+    """
+    Keep at most max_points points chosen uniformly at random, in their original order
+    :param points: An (N, 3) array of xyz coordinates
+    :param max_points: The point budget
+    :param rng: A numpy.random.Generator. Optional, defaults to a new unseeded generator.
+    """
+    if max_points <= 0:
+        raise ValueError("Point budget must be a positive integer")
+    if len(points) <= max_points:
+        return points
+    if rng is None:
+        rng = np.random.default_rng()
+    keep = np.sort(rng.choice(len(points), max_points, replace=False))
+    return points[keep]
+
+
+class Downsampler:
+    """
+    Optional downsampling before encoding: a voxel grid, then a fixed point budget.
+    Both stages are disabled when their parameter is None.
+    """
+
+    def __init__(self, voxel_size=None, voxel_mode="centroid", max_points=None, rng=None):
+        """
+        :param voxel_size: The voxel edge length. Optional, defaults to no voxel grid.
+        :param voxel_mode: "centroid" or "first", see voxel_downsample
+        :param max_points: The point budget enforced by random sampling. Optional, defaults to no budget.
+        :param rng: A numpy.random.Generator used by the random sampling. Optional.
+        """
+        # Validate user inputs
+        if voxel_size is not None and voxel_size <= 0:
+            raise ValueError("Voxel size must be positive")
+        if voxel_mode not in VOXEL_MODES:
+            raise ValueError(f"Voxel mode must be one of {VOXEL_MODES}")
+        if max_points is not None and max_points <= 0:
+            raise ValueError("Point budget must be a positive integer")
+
+        self.voxel_size = voxel_size
+        self.voxel_mode = voxel_mode
+        self.max_points = max_points
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.points_in = 0
+        self.points_out = 0
+
+    @property
+    def enabled(self):
+        return self.voxel_size is not None or self.max_points is not None
+
+    def apply(self, points):
+        """
+        Downsample an (N, 3) array of xyz coordinates
+        """
+        self.points_in = len(points)
+        if self.voxel_size is not None:
+            points = voxel_downsample(points, self.voxel_size, self.voxel_mode)
+        if self.max_points is not None:
+            points = random_sample(points, self.max_points, self.rng)
+        self.points_out = len(points)
+        return points
+
+
+class RangeFilter:
+    """
+    Keep the points whose distance to the sensor origin is within [min_range, max_range]
+    """
+    NAME = "range"
+
+    def __init__(self, min_range=0.0, max_range=None):
+        if max_range is not None and max_range <= min_range:
+            raise ValueError("Maximum range must be larger than the minimum range")
+        self.min_range = min_range
+        self.max_range = max_range
+
+    def mask(self, points):
+        # Compare squared distances to avoid the square root
+        squared = np.einsum("ij,ij->i", points, points)
+        keep = squared >= self.min_range * self.min_range
+        if self.max_range is not None:
+            keep &= squared <= self.max_range * self.max_range
+        return keep
+
+
+class BoxFilter:
+    """
+    Keep the points inside an axis-aligned region of interest
+    """
+    NAME = "box"
+
+    def __init__(self, min_corner, max_corner):
+        self.min_corner = np.asarray(min_corner, dtype=np.float32).reshape(3)
+        self.max_corner = np.asarray(max_corner, dtype=np.float32).reshape(3)
+        if np.any(self.max_corner < self.min_corner):
+            raise ValueError("Box maximum corner must not be below its minimum corner")
+
+    def mask(self, points):
+        return np.all((points >= self.min_corner) & (points <= self.max_corner), axis=1)
+
+
+class HeightFilter:
+    """
+    Keep the points whose z coordinate is within [min_z, max_z]
+    """
+    NAME = "height"
+
+    def __init__(self, min_z=None, max_z=None):
+        if min_z is not None and max_z is not None and max_z < min_z:
+            raise ValueError("Maximum height must not be below the minimum height")
+        self.min_z = min_z
+        self.max_z = max_z
+
+    def mask(self, points):
+        keep = np.ones(len(points), dtype=bool)
+        if self.min_z is not None:
+            keep &= points[:, 2] >= self.min_z
+        if self.max_z is not None:
+            keep &= points[:, 2] <= self.max_z
+        return keep
+
+
+class OutlierFilter:
+    """
+    Grid-based statistical outlier removal: drop the points of sparsely occupied grid cells.
+    A cell is sparse when its point count is below mean - std_ratio * std of the occupied cells,
+    or below min_points.
+    """
+    NAME = "outlier"
+
+    def __init__(self, cell_size, std_ratio=1.0, min_points=2):
+        if cell_size <= 0:
+            raise ValueError("Cell size must be positive")
+        self.cell_size = cell_size
+        self.std_ratio = std_ratio
+        self.min_points = min_points
+
+    def mask(self, points):
+        if len(points) == 0:
+            return np.ones(0, dtype=bool)
+        keys = voxel_keys(points, self.cell_size)
+        axis = 0 if keys.ndim > 1 else None
+        _, inverse, counts = np.unique(keys, axis=axis, return_inverse=True, return_counts=True)
+        threshold = max(self.min_points, counts.mean() - self.std_ratio * counts.std())
+        return counts[inverse.reshape(-1)] >= threshold
+
+
+FILTER_TYPES = {
+    RangeFilter.NAME: lambda config: RangeFilter(config.get("min", 0.0), config.get("max")),
+    BoxFilter.NAME: lambda config: BoxFilter(config["min"], config["max"]),
+    HeightFilter.NAME: lambda config: HeightFilter(config.get("min"), config.get("max")),
+    OutlierFilter.NAME: lambda config: OutlierFilter(
+        config["cell_size"], config.get("std_ratio", 1.0), config.get("min_points", 2)
+    ),
+}
+
+StageStats = namedtuple("StageStats", ["name", "points_in", "points_out", "seconds"])
+
+
+class FilterChain:
+    """
+    Run the spatial filters in order, each on the points kept by the previous ones
+    """
+
+    def __init__(self, stages=()):
+        """
+        :param stages: The filters to run, objects with a NAME and a mask(points) method
+        """
+        self.stages = list(stages)
+        self.stats = []
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the chain from the JSON of the set_point_cloud_filters command, e.g.
+        [{"type": "range", "min": 0.5, "max": 20}, {"type": "box", "min": [-5, -5, -1], "max": [5, 5, 2]},
+         {"type": "height", "min": -0.5, "max": 2.0}, {"type": "outlier", "cell_size": 0.2}]
+        """
+        # Validate user inputs
+        if not isinstance(config, list):
+            raise ValueError("Filters must be a list of filter configurations")
+        stages = []
+        for stage in config:
+            if not isinstance(stage, dict):
+                raise ValueError("Filter configuration must be a dictionary")
+            if stage.get("type") not in FILTER_TYPES:
+                raise ValueError(f"Filter type must be one of {tuple(FILTER_TYPES)}")
+            stages.append(FILTER_TYPES[stage["type"]](stage))
+        return cls(stages)
+
+    @property
+    def enabled(self):
+        return bool(self.stages)
+
+    def apply(self, points):
+        """
+        Filter an (N, 3) array of xyz coordinates and record the keep ratio and time of every stage
+        """
+        stats = []
+        for stage in self.stages:
+            start = time.perf_counter()
+            points_in = len(points)
+            points = points[stage.mask(points)]
+            stats.append(StageStats(stage.NAME, points_in, len(points), time.perf_counter() - start))
+        self.stats = stats
+        return points
+
+    def report(self):
+        """
+        The statistics of the last run as a JSON-serializable list
+        """
+        return [
+            {
+                "name": stage.name,
+                "keep_ratio": stage.points_out / stage.points_in if stage.points_in else 1.0,
+                "ms": stage.seconds * 1000,
+            }
+            for stage in self.stats
+        ]
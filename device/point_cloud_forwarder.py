@@ -1,11 +1,13 @@
 import logging
-import rospy
-import struct
-import numpy as np
-import binascii
 import time
+import rospy
 from sensor_msgs.msg import PointCloud
 from bridge import Bridge
+from sender import SenderQueue, LatestFrameMailbox
+import point_cloud_codec as pc_codec
+from point_cloud_filters import Downsampler, FilterChain
+from point_cloud_delta import DeltaEncoder
+import metrics
 
 
 class PointCloudForwarder(Bridge):
@@ -14,7 +16,23 @@ class PointCloudForwarder(Bridge):
     DEFAULT_KEEPALIVE = 60
     DEFAULT_EXIT_ON_COMPLETE = False
     DEFAULT_ENABLE_LOGGING = True
+    # "binary" publishes framed float32 bytes, "hex" keeps the legacy hexadecimal text for old hosts
+    DEFAULT_WIRE_FORMAT = "binary"
+    WIRE_FORMATS = ("binary", "hex")
+    # Point cloud codec of the binary frames, see point_cloud_codec.CODEC_IDS
+    DEFAULT_CODEC = "raw"
+    # Frames above this size are split into chunks, keep it below the broker message_size_limit
+    DEFAULT_MAX_CHUNK_SIZE = 256 * 1024
+    # Point clouds waiting for the publisher thread, see sender.SenderQueue for the overflow policies
+    DEFAULT_QUEUE_SIZE = 5
+    DEFAULT_OVERFLOW_POLICY = "drop_oldest"
+    # "queued" sends every point cloud through the sender queue, "latest" only sends the freshest one
+    DEFAULT_STREAMING_MODE = "queued"
+    STREAMING_MODES = ("queued", "latest")
     
+    # Drain order of the point clouds spooled while offline, lower goes first
+    DEFAULT_SPOOL_PRIORITY = 0
+
     def __init__(
         self,
         mqtt_topic,
@@ -27,13 +45,63 @@ class PointCloudForwarder(Bridge):
         keepalive=DEFAULT_KEEPALIVE,
         qos=DEFAULT_QOS,
         exit_on_complete=DEFAULT_EXIT_ON_COMPLETE,
-        enable_logging=DEFAULT_ENABLE_LOGGING
+        enable_logging=DEFAULT_ENABLE_LOGGING,
+        wire_format=DEFAULT_WIRE_FORMAT,
+        codec=DEFAULT_CODEC,
+        max_chunk_size=DEFAULT_MAX_CHUNK_SIZE,
+        rate_limiter=None,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        overflow_policy=DEFAULT_OVERFLOW_POLICY,
+        streaming_mode=DEFAULT_STREAMING_MODE,
+        voxel_size=None,
+        voxel_mode="centroid",
+        max_points=None,
+        delta_voxel_size=None,
+        keyframe_interval=DeltaEncoder.DEFAULT_KEYFRAME_INTERVAL,
+        connection=None,
+        spool=None,
+        spool_priority=DEFAULT_SPOOL_PRIORITY
     ):
 
+        # Validate user inputs
+        if wire_format not in self.WIRE_FORMATS:
+            raise ValueError(f"Wire format must be one of {self.WIRE_FORMATS}")
+        if max_chunk_size <= pc_codec.CHUNK_HEADER.size:
+            raise ValueError(f"Chunk size must be larger than {pc_codec.CHUNK_HEADER.size} bytes")
+        if streaming_mode not in self.STREAMING_MODES:
+            raise ValueError(f"Streaming mode must be one of {self.STREAMING_MODES}")
+
+        self.wire_format = wire_format
+        self.codec = pc_codec.create_codec(codec)
+        self.max_chunk_size = max_chunk_size
+        # Spatial filters run first, changed at runtime by the set_point_cloud_filters command
+        self.filter_chain = FilterChain()
+        # Optional downsampling before encoding, disabled unless a voxel size or a point budget is set
+        self.downsampler = Downsampler(voxel_size, voxel_mode, max_points)
+        # Optional temporal compression: keyframes and voxel-level deltas on a grid of delta_voxel_size
+        self.delta_encoder = None
+        if delta_voxel_size is not None:
+            self.delta_encoder = DeltaEncoder(delta_voxel_size, keyframe_interval)
+        self.sequence = 0
         self.is_forwarding = False
         self.num_point_clouds = num_point_clouds
         self.num_point_clouds_forwarded = 0
         self.exit_on_complete = exit_on_complete
+        self.sub = None
+        # The ROS callback only queues the message, encoding and publishing run on the sender thread
+        self.streaming_mode = streaming_mode
+        if streaming_mode == "latest":
+            # Real-time streaming, e.g. teleoperation: a newer point cloud replaces an unsent older one
+            self.sender = LatestFrameMailbox(self.forward_point_cloud, name="pc_sender")
+        else:
+            self.sender = SenderQueue(
+                self.forward_point_cloud, queue_size, overflow_policy, name="pc_sender"
+            )
+        # Stage timings and queue state, published with the device metrics
+        self.callback_time = metrics.REGISTRY.histogram(f"{client_id}.callback_seconds")
+        self.encode_time = metrics.REGISTRY.histogram(f"{client_id}.encode_seconds")
+        self.queue_depth = metrics.REGISTRY.gauge(f"{client_id}.queue_depth")
+        self.queue_dropped = metrics.REGISTRY.gauge(f"{client_id}.queue_dropped")
 
         if enable_logging:
             # Configure logging to both console and file
@@ -53,33 +121,90 @@ class PointCloudForwarder(Bridge):
             file_handler.setFormatter(formatter)
             self.logger.addHandler(file_handler)
 
-        super().__init__(mqtt_topic, client_id, user_id, password, host, port, keepalive, qos)
+        # The rate limiter paces the publishes, it can be shared with the other forwarders,
+        # and so can the connection to the broker
+        super().__init__(mqtt_topic, client_id, user_id, password, host, port, keepalive, qos, rate_limiter,
+                         connection=connection)
+        # Optional disk-backed queue of the messages published while offline, drained on reconnect
+        self.spool = spool
+        self.spool_priority = spool_priority
+        if spool is not None:
+            spool.register(mqtt_topic, self)
 
-    def pc_callback(self, data):
-        if self.is_forwarding:
-            try:
-                time.sleep(0.01)
-                # 1. Convert the PointCloud message to a list of points.
-                point_array = np.array([(p.x, p.y, p.z) for p in data.points])
-                cloud_points = point_array.tolist()
+    def on_connect(self, client, userdata, flags, rc):
+        # A publisher only, subscribing to its own topic would receive every message back
+        self.timeout = 0
 
-                # 2. Convert each tuple in the list of points to a list of floats
-                cloud_points_float = [[float(i) for i in point] for point in cloud_points]
+    def send_message(self, message):
+        # While offline, the spool keeps the message on disk instead of the bounded buffer of the connection
+        if self.spool is not None and not self.connection.online:
+            self.spool.append(self.mqtt_topic, message, self.qos, priority=self.spool_priority)
+        else:
+            self.publish(self.mqtt_topic, message, self.qos)
 
-                # 3. Flatten the list of lists into a single list of floats
-                cloud_points_flat = [coord for point in cloud_points_float for coord in point]
+    def pc_callback(self, data):
+        if self.is_forwarding:
+            start = time.perf_counter()
+            # Every source point cloud takes a sequence number, so the host can count the skipped ones from the gaps
+            if not self.sender.put((self.sequence, data)):
+                self.logger.debug("Sender queue is full, dropped a point cloud")
+            self.sequence += 1
+            self.queue_depth.set(self.sender.depth)
+            self.queue_dropped.set(self.sender.num_dropped)
+            self.callback_time.observe(time.perf_counter() - start)
 
-                # 4. Pack the list of floats into a binary string
-                binary_msg = struct.pack("<%sf" % len(cloud_points_flat), *cloud_points_flat)
+    def forward_point_cloud(self, item):
+        """
+        Encode and publish a point cloud, called on the sender thread
+        :param item: A (sequence number, sensor_msgs/PointCloud) tuple
+        """
+        sequence, data = item
+        if self.is_forwarding:
+            try:
+                # 1. Convert the PointCloud message to an (N, 3) float32 array.
+                start = time.perf_counter()
+                points = pc_codec.points_to_array(data.points)
+                filter_chain = self.filter_chain
+                if filter_chain.enabled:
+                    points = filter_chain.apply(points)
+                    self.logger.debug("Filtered point cloud: {}".format(filter_chain.report()))
+                if self.downsampler.enabled:
+                    points = self.downsampler.apply(points)
+                    self.logger.debug(
+                        "Downsampled point cloud from {} to {} points".format(
+                            self.downsampler.points_in, self.downsampler.points_out
+                        )
+                    )
 
-                # 5. Convert the binary message to hexadecimal format
-                hex_msg = binascii.hexlify(binary_msg).decode()
+                # 2. Encode the array, either as a binary frame or as legacy hexadecimal text
+                stamp = data.header.stamp
+                if self.wire_format == "binary" and self.delta_encoder is not None:
+                    payload = self.delta_encoder.encode(points, sequence, stamp.secs, stamp.nsecs)
+                    # 3. Split large keyframes into bounded chunks, the host reassembles them
+                    messages = pc_codec.split_frame(payload, sequence, self.max_chunk_size)
+                elif self.wire_format == "binary":
+                    payload = pc_codec.encode_frame(
+                        points, sequence, stamp.secs, stamp.nsecs, codec=self.codec
+                    )
+                    stats = self.codec.encode_stats
+                    self.logger.debug(
+                        "Encoded point cloud with codec {} in {:.2f} ms, saved {} bytes".format(
+                            self.codec.name, stats.seconds * 1000, stats.bytes_saved
+                        )
+                    )
+                    # 3. Split large frames into bounded chunks, the host reassembles them
+                    messages = pc_codec.split_frame(payload, sequence, self.max_chunk_size)
+                else:
+                    payload = pc_codec.encode_legacy_hex(points)
+                    messages = [payload]
+                self.encode_time.observe(time.perf_counter() - start)
 
-                # Publish the hexadecimal message to the MQTT topic
-                self.publish(self.mqtt_topic, hex_msg)
+                # Publish the encoded message to the MQTT topic
+                for message in messages:
+                    self.send_message(message)
                 self.logger.info(
-                    "Forwarded point cloud {} with payload size {}".format(
-                        self.num_point_clouds_forwarded, len(hex_msg)
+                    "Forwarded point cloud {} with {} points and payload size {} in {} messages, {} skipped so far".format(
+                        self.num_point_clouds_forwarded, len(points), len(payload), len(messages), self.sender.num_dropped
                     )
                 )
                 
@@ -87,9 +212,11 @@ class PointCloudForwarder(Bridge):
                 self.num_point_clouds_forwarded += 1
 
                 # Unsubscribe from ROS topic if we have forwarded the desired number of point clouds
-                if self.num_point_clouds_forwarded >= self.num_point_clouds:
+                # No limit applies when num_point_clouds is None
+                if self.num_point_clouds is not None and self.num_point_clouds_forwarded >= self.num_point_clouds:
                     # Unsubscribe from the ROS topic
-                    self.sub.unregister()
+                    if self.sub is not None:
+                        self.sub.unregister()
                     rospy.loginfo("Forwarded {} point clouds, unsubscribing from topic".format(self.num_point_clouds))
                     if self.exit_on_complete:
                         rospy.signal_shutdown("Point Cloud forwarding complete")
@@ -97,12 +224,37 @@ class PointCloudForwarder(Bridge):
             except Exception as e:
                 self.logger.error("Error occurs when forwarding point cloud: {}".format(e))
 
+    def set_downsampling(self, voxel_size=None, voxel_mode="centroid", max_points=None):
+        """
+        Configure the downsampling stage, e.g. from the parameters of the start command
+        :param voxel_size: The voxel edge length. Optional, defaults to no voxel grid.
+        :param voxel_mode: "centroid" or "first"
+        :param max_points: The point budget. Optional, defaults to no budget.
+        """
+        self.downsampler = Downsampler(voxel_size, voxel_mode, max_points)
+
+    def set_filters(self, config):
+        """
+        Replace the spatial filter chain
+        :param config: A list of filter configurations, see point_cloud_filters.FilterChain.from_config
+        """
+        self.filter_chain = FilterChain.from_config(config)
+
+    def request_keyframe(self):
+        """
+        Send the next point cloud as a keyframe, called when the host lost the reference of the deltas
+        """
+        if self.delta_encoder is not None:
+            self.delta_encoder.request_keyframe()
+
     def start_forwarding(self):
         # Subscribe to the ROS topic
         
         self.sub = rospy.Subscriber("/PR_BE/point_cloud", PointCloud, self.pc_callback)
         self.is_forwarding = True
         self.num_point_clouds_forwarded = 0
+        # Each transfer starts with a keyframe
+        self.request_keyframe()
         
     def stop_forwarding(self):
         self.is_forwarding = False
@@ -0,0 +1,129 @@
+'''
+Token bucket pacing of the messages published by the forwarders.
+
+One RateLimiter is shared by all the forwarders of the device, so their
+combined traffic stays within the configured link budget. It limits
+bytes/sec and messages/sec with a burst allowance each, and bounds the
+number of messages handed to paho whose publish has not completed yet,
+which adapts the pace to what the broker actually acknowledges.
+'''
+
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at a constant rate up to its burst size.
+    Not thread-safe, RateLimiter serializes the access.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: Tokens added per second
+        :param burst: The maximum number of tokens the bucket holds
+        """
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+        if burst <= 0:
+            raise ValueError("Burst must be positive")
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def wait_time(self, amount):
+        """
+        Seconds until the bucket can pay for amount tokens. Amounts above the burst size
+        only need a full bucket and leave it in debt, so large messages are never blocked forever.
+        """
+        needed = min(amount, self.burst)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self.tokens -= amount
+
+
+class RateLimiter:
+    """
+    Pace publishes on a bytes/sec bucket, a messages/sec bucket and the number of in-flight messages.
+    Any limit set to None is not enforced.
+    """
+
+    def __init__(self, bytes_per_sec=None, messages_per_sec=None, burst_bytes=None,
+                 burst_messages=None, max_in_flight=None):
+        """
+        :param bytes_per_sec: The sustained payload rate in bytes per second
+        :param messages_per_sec: The sustained message rate in messages per second
+        :param burst_bytes: The bytes that can be sent at once after an idle period. Optional, defaults to one second of traffic.
+        :param burst_messages: The messages that can be sent at once after an idle period. Optional, defaults to one second of traffic.
+        :param max_in_flight: The maximum number of published messages not yet completed by paho
+        """
+        if max_in_flight is not None and max_in_flight <= 0:
+            raise ValueError("Maximum in-flight messages must be positive")
+
+        self.byte_bucket = None
+        self.message_bucket = None
+        if bytes_per_sec is not None:
+            self.byte_bucket = TokenBucket(bytes_per_sec, burst_bytes or bytes_per_sec)
+        if messages_per_sec is not None:
+            self.message_bucket = TokenBucket(messages_per_sec, burst_messages or messages_per_sec)
+        self.max_in_flight = max_in_flight
+
+        self.in_flight = 0
+        self.total_wait_time = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self, num_bytes, timeout=None):
+        """
+        Block until a message of num_bytes may be published, then account for it
+        :param num_bytes: The payload size of the message
+        :param timeout: The maximum number of seconds to wait. Optional, defaults to waiting forever.
+        :return: True if the message may be published, False if the timeout expired
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wait = 0.0
+                if self.byte_bucket is not None:
+                    self.byte_bucket.refill(now)
+                    wait = max(wait, self.byte_bucket.wait_time(num_bytes))
+                if self.message_bucket is not None:
+                    self.message_bucket.refill(now)
+                    wait = max(wait, self.message_bucket.wait_time(1))
+                in_flight_full = self.max_in_flight is not None and self.in_flight >= self.max_in_flight
+
+                if wait == 0.0 and not in_flight_full:
+                    break
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    wait = min(wait, deadline - now) if wait else deadline - now
+                # Publish completions notify the condition, the buckets are checked again after wait
+                self._condition.wait(wait or None)
+
+            if self.byte_bucket is not None:
+                self.byte_bucket.consume(num_bytes)
+            if self.message_bucket is not None:
+                self.message_bucket.consume(1)
+            self.in_flight += 1
+            self.total_wait_time += time.monotonic() - start
+        return True
+
+    def release(self):
+        """
+        Mark one in-flight message as completed, called from paho's on_publish callback
+        or when a publish fails before reaching the network.
+        """
+        with self._condition:
+            if self.in_flight > 0:
+                self.in_flight -= 1
+            self._condition.notify()
@@ -0,0 +1,156 @@
+'''
+Sender stage between the ROS subscriber callbacks and the MQTT publishes.
+
+The callbacks only put the ROS message into a bounded queue. A dedicated
+publisher thread takes the messages out in order and runs the encoding and
+publishing, so a slow link no longer stalls the ROS callback thread. The
+host writes the received point clouds to disk through the same queue, see
+point_cloud_writer.py.
+
+This module is shared by the device and the host, keep both copies identical.
+'''
+
+import logging
+import threading
+import time
+from collections import deque
+
+
+class SenderQueue:
+    """
+    A bounded queue drained by a dedicated publisher thread.
+    When the queue is full, the overflow policy decides what happens to a new item:
+    "drop_oldest" discards the oldest queued item, "drop_newest" discards the new item,
+    and "block" waits up to block_timeout seconds for room before discarding the new item.
+    The thread takes out up to batch_size items at once and hands them to send_batch.
+    """
+    OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+    DEFAULT_MAX_SIZE = 10
+    DEFAULT_OVERFLOW_POLICY = "drop_oldest"
+    DEFAULT_BLOCK_TIMEOUT = 0.1
+
+    def __init__(self, send, max_size=DEFAULT_MAX_SIZE, overflow_policy=DEFAULT_OVERFLOW_POLICY,
+                 block_timeout=DEFAULT_BLOCK_TIMEOUT, name="sender", batch_size=1):
+        """
+        :param send: The function called with each item on the publisher thread.
+        Unused by subclasses overriding send_batch.
+        :param max_size: The maximum number of queued items
+        :param overflow_policy: One of OVERFLOW_POLICIES
+        :param block_timeout: The seconds "block" waits for room in the queue
+        :param name: The name of the publisher thread
+        :param batch_size: The maximum number of items the thread takes out at once
+        """
+        # Validate user inputs
+        if max_size <= 0:
+            raise ValueError("Queue size must be a positive integer")
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Overflow policy must be one of {self.OVERFLOW_POLICIES}")
+        if batch_size <= 0:
+            raise ValueError("Batch size must be a positive integer")
+
+        self.send = send
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+
+        self.num_enqueued = 0
+        self.num_sent = 0
+        self.num_dropped = 0
+        self.max_depth = 0
+
+        self._items = deque()
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """
+        The number of items waiting to be sent
+        """
+        return len(self._items)
+
+    def put(self, item):
+        """
+        Queue an item for the publisher thread, called from the ROS callback
+        :return: True if the item was queued, False if it was dropped
+        """
+        with self._condition:
+            if len(self._items) >= self.max_size:
+                if self.overflow_policy == "drop_oldest":
+                    self._items.popleft()
+                    self.num_dropped += 1
+                elif self.overflow_policy == "drop_newest":
+                    self.num_dropped += 1
+                    return False
+                else:
+                    deadline = time.monotonic() + self.block_timeout
+                    while len(self._items) >= self.max_size:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.num_dropped += 1
+                            return False
+                        self._condition.wait(remaining)
+
+            self._items.append(item)
+            self.num_enqueued += 1
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._condition.notify_all()
+        return True
+
+    def stop(self, timeout=None):
+        """
+        Stop the publisher thread once the queued items are sent
+        :param timeout: The maximum number of seconds to wait for the thread
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def send_batch(self, batch):
+        """
+        Send the items taken out at once, on the publisher thread. Subclasses may send them together.
+        :param batch: A list of items in queue order
+        """
+        for item in batch:
+            try:
+                self.send(item)
+                self.num_sent += 1
+            except Exception as e:
+                logging.error(f"Error occurs when sending an item from the sender queue: {e}")
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._items and self._running:
+                    self._condition.wait()
+                if not self._items:
+                    return
+                batch = [self._items.popleft() for _ in range(min(self.batch_size, len(self._items)))]
+                # Wake up a put blocked on a full queue
+                self._condition.notify_all()
+            self.send_batch(batch)
+
+
+class LatestFrameMailbox(SenderQueue):
+    """
+    A single-slot mailbox for real-time streaming: a newer frame replaces an unsent older one,
+    so the publisher thread always sends the latest frame. Replaced frames are counted as skipped.
+    """
+
+    def __init__(self, send, name="mailbox"):
+        """
+        :param send: The function called with each frame on the publisher thread
+        :param name: The name of the publisher thread
+        """
+        super().__init__(send, max_size=1, overflow_policy="drop_oldest", name=name)
+
+    @property
+    def num_skipped(self):
+        """
+        The number of frames replaced before they were sent
+        """
+        return self.num_dropped
@@ -0,0 +1,534 @@
+'''
+Store-and-forward queue on disk for the messages published while offline.
+
+The forwarders hand the messages they cannot send, because the broker
+connection is down, to a Spool instead of the small in-memory buffer of the
+connection. The spool keeps one ring of segment files per priority:
+
+    <folder>/p<priority>/00000001.spool
+    <folder>/p<priority>/00000002.spool
+    <folder>/p<priority>/cursor
+
+Each record is a header (payload length, CRC32 of the topic and payload,
+topic length, QoS, priority) followed by the topic and the payload. Writes
+are buffered and fsynced in batches, every fsync_interval seconds or
+fsync_bytes bytes. A ring holds at most max_segments files of
+segment_bytes each. When it is full, its oldest segment is dropped with the
+messages still in it.
+
+Once the connection is back, a drain thread sends the backlog through the
+bridge registered for each topic. Lower priority numbers go first. The
+drain is paced at drain_bytes_per_sec, so live traffic keeps most of the
+link while the backlog trickles out. The read position of each ring is
+saved in its cursor file, and the rings are scanned again on start up,
+so the backlog survives a restart. The drain keeps up to DRAIN_WINDOW
+records published and not yet acknowledged, so its pace is not one record
+per round trip to the broker. A record leaves its ring once paho took it,
+and for QoS 1 and 2 once the broker acknowledged it, in order. When the
+oldest one is not acknowledged within ACK_TIMEOUT, e.g. because the
+connection dropped again, the drain backs off and sends the whole window
+again. A record can be sent twice, e.g. if the process dies between the
+publish and the next cursor save, never lost.
+
+The priorities only order the backlog. Once the connection is back, the
+forwarders publish their live messages directly, so the drained records
+reach the same topics interleaved with newer ones. The host copes with
+that for the point cloud deltas: its DeltaDecoder keeps several keyframes
+by sequence number, so an old spooled keyframe does not replace the
+reference of the live deltas, see point_cloud_delta.py.
+'''
+
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+import metrics
+from rate_limiter import TokenBucket
+
+# Payload length, CRC32 of the topic and payload, topic length, QoS, priority
+SPOOL_RECORD = struct.Struct("<IIHBB")
+CURSOR = struct.Struct("<QQQ")
+
+
+def _segment_path(folder, number):
+    return os.path.join(folder, "%08d.spool" % number)
+
+
+class SpoolRing:
+    """
+    The segment files of one priority, appended by the forwarders and read by the drain thread
+    """
+
+    def __init__(self, folder, segment_bytes, max_segments, fsync_interval, fsync_bytes):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.fsync_interval = fsync_interval
+        self.fsync_bytes = fsync_bytes
+        self.cursor_path = os.path.join(folder, "cursor")
+
+        # Segment number mapped to its [bytes, records], oldest first
+        self.segments = {}
+        self.backlog_messages = 0
+        self.backlog_bytes = 0
+        self.num_dropped = 0
+        self._lock = threading.Lock()
+        self._writer = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._reader = None
+        self._reader_segment = None
+        self._peeked = None
+        self._recover()
+        # The drain sends ahead of the read position, which only moves on once a record is acknowledged
+        self.send_segment, self.send_offset = self.read_segment, self.read_offset
+
+    def _recover(self):
+        numbers = sorted(
+            int(name[:-len(".spool")]) for name in os.listdir(self.folder)
+            if name.endswith(".spool") and name[:-len(".spool")].isdigit()
+        )
+        for index, number in enumerate(numbers):
+            # Only the last segment can end with a torn record, its CRCs are checked
+            self.segments[number] = self._scan(number, verify=index == len(numbers) - 1)
+
+        self.read_segment, self.read_offset, self.read_records = numbers[0] if numbers else 1, 0, 0
+        if os.path.exists(self.cursor_path):
+            with open(self.cursor_path, "rb") as f:
+                data = f.read()
+            if len(data) == CURSOR.size:
+                segment, offset, records = CURSOR.unpack(data)
+                if segment in self.segments and offset <= self.segments[segment][0]:
+                    self.read_segment, self.read_offset, self.read_records = segment, offset, records
+                elif numbers and segment > numbers[-1]:
+                    self.read_segment, self.read_offset, self.read_records = segment, 0, 0
+        # Segments before the cursor were drained before the restart
+        for number in [number for number in self.segments if number < self.read_segment]:
+            self._delete(number)
+
+        for number, (size, records) in self.segments.items():
+            if number == self.read_segment:
+                size -= self.read_offset
+                records -= self.read_records
+            self.backlog_bytes += size
+            self.backlog_messages += records
+        self.write_segment = max(self.segments, default=self.read_segment)
+
+    def _scan(self, number, verify):
+        path = _segment_path(self.folder, number)
+        size = os.path.getsize(path)
+        offset = records = 0
+        with open(path, "rb") as f:
+            while offset + SPOOL_RECORD.size <= size:
+                f.seek(offset)
+                length, crc, topic_length, _, _ = SPOOL_RECORD.unpack(f.read(SPOOL_RECORD.size))
+                end = offset + SPOOL_RECORD.size + topic_length + length
+                if end > size:
+                    break
+                if verify and zlib.crc32(f.read(topic_length + length)) != crc:
+                    break
+                offset = end
+                records += 1
+        if offset < size:
+            logging.warning(f"Truncating {size - offset} bytes of a torn record in {path}")
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+        return [offset, records]
+
+    def _delete(self, number):
+        self.segments.pop(number, None)
+        try:
+            os.remove(_segment_path(self.folder, number))
+        except FileNotFoundError:
+            pass
+
+    def append(self, topic, payload, qos, priority):
+        topic = topic.encode()
+        header = SPOOL_RECORD.pack(len(payload), zlib.crc32(payload, zlib.crc32(topic)), len(topic), qos, priority)
+        size = len(header) + len(topic) + len(payload)
+        with self._lock:
+            segment = self.segments.get(self.write_segment)
+            if segment is None or (segment[0] and segment[0] + size > self.segment_bytes):
+                self._rotate()
+                segment = self.segments[self.write_segment]
+            elif self._writer is None:
+                # Reopened after a restart, the last segment has room left
+                self._writer = open(_segment_path(self.folder, self.write_segment), "ab")
+            self._writer.write(header)
+            self._writer.write(topic)
+            self._writer.write(payload)
+            segment[0] += size
+            segment[1] += 1
+            self.backlog_bytes += size
+            self.backlog_messages += 1
+            self._unsynced += size
+            now = time.monotonic()
+            if self._unsynced >= self.fsync_bytes or now - self._last_sync >= self.fsync_interval:
+                self._sync(now)
+
+    def _rotate(self):
+        if self._writer is not None:
+            self._sync(time.monotonic())
+            self._writer.close()
+            self._writer = None
+            self.write_segment += 1
+        elif self.write_segment in self.segments:
+            # Reopened after a restart, the last segment may be full already
+            self.write_segment += 1
+        self.segments[self.write_segment] = [0, 0]
+        self._writer = open(_segment_path(self.folder, self.write_segment), "ab")
+        # The ring is full: drop the oldest segment and the messages not yet drained from it
+        while len(self.segments) > self.max_segments:
+            oldest = min(self.segments)
+            size, records = self.segments[oldest]
+            if oldest == self.read_segment:
+                size -= self.read_offset
+                records -= self.read_records
+                self.read_segment, self.read_offset, self.read_records = oldest + 1, 0, 0
+            if oldest == self._reader_segment:
+                self._close_reader()
+            if (self.send_segment, self.send_offset) < (self.read_segment, self.read_offset):
+                self.send_segment, self.send_offset = self.read_segment, self.read_offset
+            self.backlog_bytes -= size
+            self.backlog_messages -= records
+            self.num_dropped += records
+            logging.warning(f"Spool {self.folder} is full, dropped {records} messages")
+            self._delete(oldest)
+
+    def _sync(self, now):
+        if self._writer is not None:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+        self._unsynced = 0
+        self._last_sync = now
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+            self._reader_segment = None
+
+    def _release_drained(self):
+        # Every record of the read segment was acknowledged, delete it and move to the next one
+        while self.read_segment < self.write_segment:
+            segment = self.segments.get(self.read_segment)
+            if segment is not None and self.read_offset < segment[0]:
+                return
+            if self._reader_segment == self.read_segment:
+                self._close_reader()
+            self._delete(self.read_segment)
+            self.read_segment, self.read_offset, self.read_records = self.read_segment + 1, 0, 0
+            self.save_cursor()
+
+    def peek(self):
+        """
+        :return: The next (topic, payload, qos) tuple to send, or None if every record was sent
+        """
+        with self._lock:
+            self._release_drained()
+            while True:
+                segment = self.segments.get(self.send_segment)
+                if segment is None or self.send_offset >= segment[0]:
+                    if self.send_segment >= self.write_segment:
+                        return None
+                    # Sent a whole segment, go on with the next one
+                    self.send_segment, self.send_offset = self.send_segment + 1, 0
+                    continue
+                if self.send_segment == self.write_segment and self._writer is not None:
+                    # The record may still sit in the write buffer
+                    self._writer.flush()
+                if self._reader_segment != self.send_segment:
+                    self._close_reader()
+                    self._reader = open(_segment_path(self.folder, self.send_segment), "rb")
+                    self._reader_segment = self.send_segment
+                self._reader.seek(self.send_offset)
+                length, _, topic_length, qos, _ = SPOOL_RECORD.unpack(self._reader.read(SPOOL_RECORD.size))
+                topic = self._reader.read(topic_length).decode()
+                self._peeked = (self.send_segment, self.send_offset, SPOOL_RECORD.size + topic_length + length)
+                return topic, self._reader.read(length), qos
+
+    def advance(self):
+        """
+        Mark the record returned by peek as sent, it stays in the ring until pop
+        :return: The token of the record to pop once it is acknowledged
+        """
+        with self._lock:
+            segment, offset, size = self._peeked
+            if (segment, offset) == (self.send_segment, self.send_offset):
+                self.send_offset += size
+            return self._peeked
+
+    def pop(self, token):
+        """
+        Remove the oldest sent record once it is acknowledged
+        :param token: The token advance returned for it
+        """
+        with self._lock:
+            self._release_drained()
+            segment, offset, size = token
+            if (segment, offset) != (self.read_segment, self.read_offset):
+                # The segment was dropped by a full ring meanwhile
+                return
+            self.read_offset += size
+            self.read_records += 1
+            self.backlog_bytes -= size
+            self.backlog_messages -= 1
+            self._release_drained()
+
+    def rewind(self):
+        """
+        Send again every record not acknowledged yet, e.g. after the connection dropped
+        """
+        with self._lock:
+            self.send_segment, self.send_offset = self.read_segment, self.read_offset
+
+    def save_cursor(self):
+        # Written aside and renamed, a crash leaves either the old or the new cursor
+        temporary = self.cursor_path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(CURSOR.pack(self.read_segment, self.read_offset, self.read_records))
+        os.replace(temporary, self.cursor_path)
+
+    def close(self):
+        with self._lock:
+            self._sync(time.monotonic())
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            self._close_reader()
+            self.save_cursor()
+
+
+class Spool:
+    """
+    Disk-backed outbound queue of the forwarders, drained by a background thread once the broker is reachable
+    """
+    DEFAULT_FOLDER = "spool"
+    DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+    DEFAULT_MAX_SEGMENTS = 64
+    DEFAULT_FSYNC_INTERVAL = 1.0
+    DEFAULT_FSYNC_BYTES = 4 * 1024 * 1024
+    DEFAULT_DRAIN_BYTES_PER_SEC = 256 * 1024
+    # Records drained between two saves of the read cursor
+    CURSOR_INTERVAL = 100
+    # Seconds between two checks of the connection while there is nothing to drain
+    IDLE_INTERVAL = 0.5
+    # Seconds the drain waits for the broker to acknowledge a QoS 1 or 2 record before sending it again
+    ACK_TIMEOUT = 10.0
+    # Records published and not yet acknowledged at once, so the drain is not held to one record per round trip
+    DRAIN_WINDOW = 32
+
+    def __init__(self, folder=DEFAULT_FOLDER, segment_bytes=DEFAULT_SEGMENT_BYTES, max_segments=DEFAULT_MAX_SEGMENTS,
+                 fsync_interval=DEFAULT_FSYNC_INTERVAL, fsync_bytes=DEFAULT_FSYNC_BYTES,
+                 drain_bytes_per_sec=DEFAULT_DRAIN_BYTES_PER_SEC):
+        """
+        :param folder: The folder of the segment files, one sub folder per priority
+        :param segment_bytes: The size a segment file is rotated at
+        :param max_segments: The number of segments of each priority, the oldest is dropped beyond it
+        :param fsync_interval: The maximum seconds between two fsyncs of the written records
+        :param fsync_bytes: The maximum bytes written between two fsyncs
+        :param drain_bytes_per_sec: The pace of the drain, None drains as fast as the bridges publish
+        """
+        # Validate user inputs
+        if segment_bytes <= 0 or max_segments <= 0:
+            raise ValueError("Segment size and count must be positive integers")
+        if drain_bytes_per_sec is not None and drain_bytes_per_sec <= 0:
+            raise ValueError("Drain rate must be positive")
+
+        self.folder = folder
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.fsync_interval = fsync_interval
+        self.fsync_bytes = fsync_bytes
+        self.drain_bytes_per_sec = drain_bytes_per_sec
+        self.drain_bucket = None
+        if drain_bytes_per_sec is not None:
+            self.drain_bucket = TokenBucket(drain_bytes_per_sec, drain_bytes_per_sec)
+
+        # Bridge publishing each topic, registered by the forwarders
+        self.bridges = {}
+        self.rings = {}
+        os.makedirs(folder, exist_ok=True)
+        for name in os.listdir(folder):
+            if name.startswith("p") and name[1:].isdigit():
+                self._ring(int(name[1:]))
+
+        self.num_drained = 0
+        self.bytes_drained = 0
+        # Smoothed bytes/sec achieved by the drain, for the ETA
+        self.drain_rate = None
+        self.backlog_messages = metrics.REGISTRY.gauge("spool.backlog_messages")
+        self.backlog_bytes = metrics.REGISTRY.gauge("spool.backlog_bytes")
+        self.drain_eta = metrics.REGISTRY.gauge("spool.drain_eta_seconds")
+        self._update_gauges()
+
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="spool_drain", daemon=True)
+        self._thread.start()
+
+    def _ring(self, priority):
+        ring = self.rings.get(priority)
+        if ring is None:
+            ring = SpoolRing(os.path.join(self.folder, f"p{priority}"), self.segment_bytes, self.max_segments,
+                             self.fsync_interval, self.fsync_bytes)
+            # Sorted by priority, so the drain finds the most important backlog first
+            self.rings = dict(sorted({**self.rings, priority: ring}.items()))
+        return ring
+
+    def register(self, topic, bridge):
+        """
+        Drain the records of a topic through a bridge, including those left from a previous run
+        """
+        self.bridges[topic] = bridge
+        with self._condition:
+            self._condition.notify()
+
+    def append(self, topic, payload, qos=0, priority=0):
+        """
+        Store a message until the drain thread can publish it
+        :param priority: Lower numbers are drained first
+        """
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self._ring(priority).append(topic, payload, qos, priority)
+        self._update_gauges()
+        with self._condition:
+            self._condition.notify()
+
+    @property
+    def pending(self):
+        """
+        The number of messages waiting in the spool
+        """
+        return sum(ring.backlog_messages for ring in self.rings.values())
+
+    def stats(self):
+        """
+        :return: A dictionary with the backlog in messages and bytes, the drain rate and ETA, and the drop count
+        """
+        backlog_bytes = sum(ring.backlog_bytes for ring in self.rings.values())
+        # The measured rate, bounded by the configured pace which the bursts exceed at first
+        rate = min(filter(None, (self.drain_rate, self.drain_bytes_per_sec)), default=None)
+        return {
+            "backlog_messages": self.pending,
+            "backlog_bytes": backlog_bytes,
+            "by_priority": {priority: ring.backlog_messages for priority, ring in self.rings.items()},
+            "drained": self.num_drained,
+            "dropped": sum(ring.num_dropped for ring in self.rings.values()),
+            "drain_bytes_per_sec": self.drain_rate,
+            "eta_seconds": backlog_bytes / rate if rate else None,
+        }
+
+    def _update_gauges(self):
+        stats = self.stats()
+        self.backlog_messages.set(stats["backlog_messages"])
+        self.backlog_bytes.set(stats["backlog_bytes"])
+        self.drain_eta.set(stats["eta_seconds"] or 0.0)
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+        for ring in self.rings.values():
+            ring.close()
+
+    def _next(self):
+        # The first ring, by priority, with a record whose bridge is connected
+        for ring in list(self.rings.values()):
+            record = ring.peek()
+            if record is None:
+                continue
+            bridge = self.bridges.get(record[0])
+            if bridge is not None and bridge.connection.online:
+                return ring, bridge, record
+        return None
+
+    def _rewind(self, rings, in_flight):
+        # Every record not acknowledged yet is sent again, after a pause for the connection to come back
+        for ring in rings | {entry[0] for entry in in_flight}:
+            ring.rewind()
+        in_flight.clear()
+        with self._condition:
+            if self._running:
+                self._condition.wait(self.IDLE_INTERVAL)
+
+    def _run(self):
+        since_cursor = 0
+        last_drain = None
+        # The records published and not yet popped, oldest first: [ring, token, info, qos, size, ack deadline]
+        in_flight = deque()
+        while self._running:
+            # Pop the acknowledged records in order, a record is acknowledged once paho took it for QoS 0
+            while in_flight and (in_flight[0][3] == 0 or in_flight[0][2].is_published()):
+                ring, token, _, _, size, _ = in_flight.popleft()
+                ring.pop(token)
+                self.num_drained += 1
+                self.bytes_drained += size
+                now = time.monotonic()
+                if last_drain is not None:
+                    rate = size / max(now - last_drain, 1e-6)
+                    self.drain_rate = rate if self.drain_rate is None else 0.9 * self.drain_rate + 0.1 * rate
+                last_drain = now
+                since_cursor += 1
+                if since_cursor >= self.CURSOR_INTERVAL:
+                    ring.save_cursor()
+                    since_cursor = 0
+                self._update_gauges()
+            if in_flight and time.monotonic() >= in_flight[0][5]:
+                # The broker did not acknowledge the oldest record in time, e.g. the connection dropped
+                self._rewind(set(), in_flight)
+                continue
+
+            item = self._next() if len(in_flight) < self.DRAIN_WINDOW else None
+            if item is None:
+                if in_flight:
+                    # The window is full, or there is nothing else to send: wait for the oldest acknowledgement
+                    in_flight[0][2].wait_for_publish(
+                        min(self.IDLE_INTERVAL, max(in_flight[0][5] - time.monotonic(), 0.0))
+                    )
+                    continue
+                if since_cursor:
+                    for ring in self.rings.values():
+                        ring.save_cursor()
+                    since_cursor = 0
+                if last_drain is not None:
+                    logging.info(f"Spool drained, {self.num_drained} messages sent so far")
+                last_drain = None
+                with self._condition:
+                    if self._running:
+                        self._condition.wait(self.IDLE_INTERVAL)
+                continue
+
+            ring, bridge, (topic, payload, qos) = item
+            if last_drain is None and not in_flight:
+                stats = self.stats()
+                logging.info(
+                    f"Draining {stats['backlog_messages']} spooled messages, {stats['backlog_bytes']} bytes, "
+                    f"ETA {stats['eta_seconds'] or 0.0:.1f} s"
+                )
+            if self.drain_bucket is not None:
+                self.drain_bucket.refill(time.monotonic())
+                wait = self.drain_bucket.wait_time(len(payload))
+                if wait:
+                    time.sleep(wait)
+                    self.drain_bucket.refill(time.monotonic())
+                self.drain_bucket.consume(len(payload))
+            try:
+                info = bridge.publish(topic, payload, qos)
+            except Exception as e:
+                logging.error(f"Error occurs when draining the spool: {e}")
+                info = None
+            # A BufferedPublish means the connection went offline meanwhile, the record is not sent
+            if not isinstance(info, mqtt.MQTTMessageInfo) or info.rc != mqtt.MQTT_ERR_SUCCESS:
+                self._rewind({ring}, in_flight)
+                continue
+            in_flight.append([ring, ring.advance(), info, qos, len(payload), time.monotonic() + self.ACK_TIMEOUT])
@@ -7,15 +7,28 @@ import requests
 import time
 import rospy
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from bridge import Bridge
+from connection import Connection
 from point_cloud_forwarder import PointCloudForwarder
 from image_forwarder import ImageForwarder
+from rate_limiter import RateLimiter
+from spool import Spool
+from metrics import MetricsReporter
+import commands
+import topics
 import logging
 import config as CONFIG
 
 class Vibot(Bridge):
     # Define class constant 
-    DEFAULT_MQTT_TOPIC = "/iot_device/command"
+    DEFAULT_MQTT_TOPIC = topics.COMMAND
+    # Seconds an image transfer lasts
+    IMAGE_TRANSFER_DURATION = 10
+    # Seconds to wait for the VIO service to answer
+    VIO_REQUEST_TIMEOUT = 5
+    # Seconds between two heartbeats
+    HEARTBEAT_INTERVAL = 2
     
     def __init__(
         self, 
@@ -26,25 +39,75 @@ class Vibot(Bridge):
         host=CONFIG.MQTT_BROKER.IP_ADDRESS, 
         port=1883, 
         keepalive=60, 
-        qos=0
+        qos=0,
+        device_id=CONFIG.DEVICE.ID
     ):
-       
-        self.status_check_topic = "/iot_device/status_check"
+        
+        # With a device id, every topic is namespaced so that one host can manage a fleet of Vibots, see topics.py
+        if device_id is not None:
+            topics.validate_device_id(device_id)
+            # Client ids must be unique on the broker
+            client_id = f"{client_id}_{device_id}"
+        self.device_id = device_id
+        mqtt_topic = topics.device_topic(mqtt_topic, device_id)
+        self.status_check_topic = topics.device_topic(topics.STATUS_CHECK, device_id)
+        self.status_response_topic = topics.device_topic(topics.STATUS_RESPONSE, device_id)
+        self.heartbeat_topic = topics.device_topic(topics.HEARTBEAT, device_id)
+        self.metrics_topic = topics.device_topic(topics.METRICS, device_id)
         self.command_topic = mqtt_topic
-        self.response_topic = "/iot_device/command_response"
+        self.response_topic = topics.device_topic(topics.COMMAND_RESPONSE, device_id)
         self.enable_vio_algorithm_url = 'http://localhost:8000/Smart/algorithmEnable'
         self.disable_vio_algorithm_url = 'http://localhost:8000/Smart/algorithmDisable'
         
+        # Commands are looked up by name instead of walking a chain of comparisons. 
+        # They run in order on one worker thread, off the network loop that every publish of the device goes through
+        self.command_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vibot_commands")
+        self.commands = commands.CommandDispatcher("command", self.unknown_command, executor=self.command_executor)
+        self.register_commands()
+        # The running image transfer, the command that started it and the timer ending it
+        self.image_transfer = None
+        self.image_timer = None
+        self.image_transfer_lock = threading.Lock()
+        
+        # One rate limiter paces both forwarders so that together they fill the link without overrunning the broker
+        self.rate_limiter = RateLimiter(
+            bytes_per_sec=CONFIG.RATE_LIMIT.BYTES_PER_SEC,
+            messages_per_sec=CONFIG.RATE_LIMIT.MESSAGES_PER_SEC,
+            burst_bytes=CONFIG.RATE_LIMIT.BURST_BYTES,
+            burst_messages=CONFIG.RATE_LIMIT.BURST_MESSAGES,
+            max_in_flight=CONFIG.RATE_LIMIT.MAX_IN_FLIGHT
+        )
+        
+        # The command handling and both forwarders share one connection to the broker, 
+        # with a single network thread and keepalive
+        # During an outage it reconnects in the background and buffers what is published meanwhile
+        connection = Connection(
+            client_id, user_id, password, host, port, keepalive,
+            min_backoff=CONFIG.RECONNECT.MIN_BACKOFF, max_backoff=CONFIG.RECONNECT.MAX_BACKOFF,
+            buffer_size=CONFIG.RECONNECT.BUFFER_SIZE, buffer_bytes=CONFIG.RECONNECT.BUFFER_BYTES,
+            buffer_policy=CONFIG.RECONNECT.BUFFER_POLICY
+        )
+        
+        # Optionally, what the forwarders publish during an outage goes to disk rather than to the connection buffer,
+        # it survives a restart and is drained at a bounded pace once the broker is back
+        self.spool = None
+        if CONFIG.SPOOL.ENABLED:
+            self.spool = Spool(
+                CONFIG.SPOOL.FOLDER, CONFIG.SPOOL.SEGMENT_BYTES, CONFIG.SPOOL.MAX_SEGMENTS,
+                CONFIG.SPOOL.FSYNC_INTERVAL, CONFIG.SPOOL.FSYNC_BYTES, CONFIG.SPOOL.DRAIN_BYTES_PER_SEC
+            )
+        
         # instantiate two bridges for point clouds and images
-        # for point cloud, the upper limit transfer one time is 5000
+        # for point cloud, large clouds are split into chunks so the transfer streams 
+        # until end_point_cloud_transfer is received. 
         self.pc_bridge = PointCloudForwarder(
-            mqtt_topic="/data/point_cloud", num_point_clouds=50,
-            host=CONFIG.MQTT_BROKER.IP_ADDRESS, port=1883, qos=2
+            mqtt_topic=topics.device_topic(topics.POINT_CLOUD, device_id), num_point_clouds=None,
+            qos=2, rate_limiter=self.rate_limiter, connection=connection, spool=self.spool
         )
         # for image transfer, one time one image
         self.img_bridge = ImageForwarder(
-            mqtt_topic="/data/img", 
-            host=CONFIG.MQTT_BROKER.IP_ADDRESS, port=1883, qos=2
+            mqtt_topic=topics.device_topic(topics.IMAGE, device_id),
+            qos=2, rate_limiter=self.rate_limiter, connection=connection, spool=self.spool
         )
 
         # Initialize the ROS forwarder node, which can
@@ -73,136 +136,225 @@ class Vibot(Bridge):
         self.logger.addHandler(file_handler)
         
         # We take the command topic as default mqtt topic. 
-        super().__init__(mqtt_topic, client_id, user_id, password, host, port, keepalive, qos)
+        # The network loop of the shared connection also delivers the publish acknowledgements of the forwarders
+        super().__init__(mqtt_topic, client_id, user_id, password, host, port, keepalive, qos,
+                         connection=connection)
+        
+        # Publish the metrics of all the bridges of the device periodically, the host aggregates them
+        self.metrics_reporter = MetricsReporter(
+            lambda payload: self.publish(self.metrics_topic, payload),
+            interval=CONFIG.METRICS.INTERVAL, source=device_id or client_id
+        )
+        self.metrics_reporter.start()
+        
+        # Continuously publish device heartbeat, from one thread whatever the number of reconnections
+        # daemon thread is running in the background and does not prevent the
+        # main program from existing. when the main program exists, any 
+        # remaining daemon threads are terminated automatically. 
+        self.heartbeat_thread = threading.Thread(target=self.send_heartbeat, name="heartbeat", daemon=True)
+        self.heartbeat_thread.start()
                 
     def msg_process(self, msg):
         """
-        Process incoming MQTT messages from topic "/iot_device/command"
+        Process incoming MQTT messages from the command topic
         """
-        msg_topic = msg.topic
-        msg = str(msg.payload.decode())
-        self.logger.info(f"Processing message {msg} from topic {msg_topic}")
-        
-        if msg == "status_check":
-            # This message is used to verify the status of the IoT device. 
-            # The current implementation involves the following steps:
-            # 1. The host sends a string "status_check" to the IoT device via the MQTT broker.
-            # 2. The device sends a string "status_ok" to the host via the broker to indicate that it is online and responsive.
-            # 
-            # TODO: To enhance the security of this verification process, additional authentication and authorization mechanisms 
-            # could be implemented to ensure that only authorized hosts can send the "status_check" message, 
-            # and only authorized devices can respond with the "status_ok" message.
-            self.publish("/iot_device/status_response", "status_ok")
-            self.logger.debug("Sent status_ok to /iot_device/status_response")
-        
-        elif msg == "enable_vio_service":
-
-            # Make the HTTP PUT request
-            http_response = requests.put(self.enable_vio_algorithm_url)
-
-            # Check the response status code
-            if http_response.status_code == 200: 
-                self.logger.info('Vio algorithm enabled\n')
-            else:
-                self.logger.warning('Failed to enable vio algorithm, please enable it manually\n')
-            
-            message = {'type': 'enable_vio', 'code': http_response.status_code}
-            json_message = json.dumps(message)
-            self.publish(self.response_topic, json_message)
-        
-        elif msg == "disable_vio_service":
-            
-            response = requests.put(self.disable_vio_algorithm_url)
-
-            if response.status_code == 200:
-                self.logger.info('Vio algorithm disabled\n')
-            else:
-                self.logger.info('Failed to disable vio algorithm, please disable it manually\n')
-            
-            message = {'type': 'disable_vio', 'code': response.status_code}
-            json_message = json.dumps(message)
-            self.publish(self.response_topic, json_message)
-                        
-        elif msg == "start_point_cloud_transfer":
-            
-            # TODO: for security concerns, every time the topic may be randomly
-            # generated, instead of a fixed one. 
-            message = {'type': 'start_pc', 'code': 200, 'topic': 'test_topic'}
-            json_message = json.dumps(message)
-            self.publish(self.response_topic, json_message)
-            self.logger.info("A message sent to iot_device/command_response indicating the point cloud transfer starts")
-            
-            try:
-                self.pc_bridge.start_forwarding()
-            except Exception as e:
-                self.logger.error(e)
-            
-        elif msg == "end_point_cloud_transfer":
-            
-            message = {'type': 'end_pc', 'code': 200}
-            json_message = json.dumps(message)
-            self.publish(self.response_topic, message=json_message)
-            self.logger.info("A message sent to iot_device/command_response indicating the point cloud transfer ends")
-            
-            try:
-                self.pc_bridge.stop_forwarding()
-            except Exception as e:
-                self.logger.error(e)
-            
-        elif msg == "start_image_transfer":
-            # Every time it just have to forward a certain amount of image message, like one image. 
-            # You may 
-            
-            message = {'type': 'start_img', 'code': 200, 'topic': 'test_topic'}
-            json_message = json.dumps(message)
-            self.publish(self.response_topic, message=json_message)
-            
-            try:
-                self.img_bridge.start_forwarding(100)
-                time.sleep(10)
-                self.img_bridge.stop_forwarding()
-            except Exception as e:
-                self.logger.error(e)
-            
-            message = {'type': 'end_img', 'code': 200, 'topic': 'test_topic'}
-            json_message = json.dumps(message)
-            self.publish(self.response_topic, message=json_message)
-            
+        self.logger.debug(f"Processing a command of {len(msg.payload)} bytes from topic {msg.topic}")
+        # The payload is decoded once, the handler is looked up by command name, see register_commands
+        self.commands.dispatch(msg.payload)
+
+    def register_commands(self):
+        """
+        Map every command to its handler, a new command only needs a handler and a line here
+        """
+        self.commands.register("status_check", self.status_check)
+        self.commands.register("enable_vio_service", self.enable_vio_service)
+        self.commands.register("disable_vio_service", self.disable_vio_service)
+        self.commands.register("start_point_cloud_transfer", self.start_point_cloud_transfer)
+        self.commands.register("set_point_cloud_filters", self.set_point_cloud_filters)
+        self.commands.register("get_point_cloud_filter_stats", self.get_point_cloud_filter_stats)
+        self.commands.register("request_keyframe", self.request_keyframe)
+        self.commands.register("end_point_cloud_transfer", self.end_point_cloud_transfer)
+        self.commands.register("start_image_transfer", self.start_image_transfer)
+
+    def respond(self, command, response_type, code, **fields):
+        """
+        Publish the response to a command, in the encoding the command came in
+        :param command: The Command being answered
+        :param response_type: The type of the response, e.g. "start_pc"
+        :param code: The HTTP-like status code
+        """
+        # Echo the correlation id, the host completes the request waiting for this response
+        if commands.CORRELATION_KEY in command.params:
+            fields[commands.CORRELATION_KEY] = command.params[commands.CORRELATION_KEY]
+        message = commands.encode_command(
+            response_type, {'code': code, **fields}, key='type', binary=command.binary
+        )
+        self.publish(self.response_topic, message)
+
+    def unknown_command(self, command):
+        self.logger.warning(f"Vibot received unknown message: {command.name}")
+        self.logger.warning("This could be a threat!")
+
+    def status_check(self, command):
+        # This message is used to verify the status of the IoT device. 
+        # The current implementation involves the following steps:
+        # 1. The host sends a string "status_check" to the IoT device via the MQTT broker.
+        # 2. The device sends a string "status_ok" to the host via the broker to indicate that it is online and responsive.
+        # 
+        # TODO: To enhance the security of this verification process, additional authentication and authorization mechanisms 
+        # could be implemented to ensure that only authorized hosts can send the "status_check" message, 
+        # and only authorized devices can respond with the "status_ok" message.
+        self.publish(self.status_response_topic, "status_ok")
+        self.logger.debug(f"Sent status_ok to {self.status_response_topic}")
+
+    def enable_vio_service(self, command):
+        # Make the HTTP PUT request
+        try:
+            http_response = requests.put(self.enable_vio_algorithm_url, timeout=self.VIO_REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            self.logger.warning(f'Failed to reach the vio service: {e}')
+            self.respond(command, 'enable_vio', 503, error=str(e))
+            return
+
+        # Check the response status code
+        if http_response.status_code == 200: 
+            self.logger.info('Vio algorithm enabled\n')
         else:
-            self.logger.warning(f"Vibot received unknown message: {msg}")
-            self.logger.warning("This could be a threat!")
-            pass
+            self.logger.warning('Failed to enable vio algorithm, please enable it manually\n')
+        
+        self.respond(command, 'enable_vio', http_response.status_code)
+
+    def disable_vio_service(self, command):
+        try:
+            response = requests.put(self.disable_vio_algorithm_url, timeout=self.VIO_REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            self.logger.warning(f'Failed to reach the vio service: {e}')
+            self.respond(command, 'disable_vio', 503, error=str(e))
+            return
+
+        if response.status_code == 200:
+            self.logger.info('Vio algorithm disabled\n')
+        else:
+            self.logger.info('Failed to disable vio algorithm, please disable it manually\n')
+        
+        self.respond(command, 'disable_vio', response.status_code)
+
+    def start_point_cloud_transfer(self, command):
+        params = command.params
+        # Per-transfer downsampling resolution, e.g. {"command": "start_point_cloud_transfer", "voxel_size": 0.05}
+        try:
+            self.pc_bridge.set_downsampling(
+                params.get('voxel_size'), params.get('voxel_mode', 'centroid'), params.get('max_points')
+            )
+        except (TypeError, ValueError) as e:
+            self.logger.warning(f"Invalid point cloud transfer parameters: {e}")
+            self.respond(command, 'start_pc', 400, error=str(e))
+            return
+        
+        # TODO: for security concerns, every time the topic may be randomly
+        # generated, instead of a fixed one. 
+        # Announce the codec so that the host picks the matching decoder
+        self.respond(command, 'start_pc', 200, topic='test_topic', codec=self.pc_bridge.codec.name)
+        self.logger.info("A message sent to iot_device/command_response indicating the point cloud transfer starts")
+        
+        try:
+            self.pc_bridge.start_forwarding()
+        except Exception as e:
+            self.logger.error(e)
+
+    def set_point_cloud_filters(self, command):
+        # e.g. {"command": "set_point_cloud_filters", "filters": [{"type": "range", "max": 20}]}
+        # An empty list removes all the filters. 
+        try:
+            self.pc_bridge.set_filters(command.params.get('filters', []))
+            self.respond(command, 'filters', 200)
+        except (KeyError, TypeError, ValueError) as e:
+            self.logger.warning(f"Invalid point cloud filters: {e}")
+            self.respond(command, 'filters', 400, error=str(e))
+
+    def get_point_cloud_filter_stats(self, command):
+        # Keep ratio and time of every filter stage on the last point cloud
+        self.respond(command, 'filter_stats', 200, stats=self.pc_bridge.filter_chain.report())
+
+    def request_keyframe(self, command):
+        # The host lost the keyframe the point cloud deltas refer to
+        self.pc_bridge.request_keyframe()
+
+    def end_point_cloud_transfer(self, command):
+        self.respond(command, 'end_pc', 200)
+        self.logger.info("A message sent to iot_device/command_response indicating the point cloud transfer ends")
+        
+        try:
+            self.pc_bridge.stop_forwarding()
+        except Exception as e:
+            self.logger.error(e)
+
+    def start_image_transfer(self, command):
+        # Every time it just have to forward a certain amount of image message, like one image. 
+        # A new transfer ends the one still running first
+        with self.image_transfer_lock:
+            previous, self.image_transfer = self.image_transfer, command
+            if self.image_timer is not None:
+                self.image_timer.cancel()
+            # The transfer ends on a timer thread, the command worker goes on with the next commands meanwhile
+            self.image_timer = threading.Timer(self.IMAGE_TRANSFER_DURATION, self.end_image_transfer, (command,))
+            self.image_timer.daemon = True
+        if previous is not None:
+            self.stop_image_transfer(previous)
+        
+        self.respond(command, 'start_img', 200, topic='test_topic')
+        
+        try:
+            self.img_bridge.start_forwarding(100)
+        except Exception as e:
+            self.logger.error(e)
+        self.image_timer.start()
+
+    def end_image_transfer(self, command):
+        """
+        Called by the timer of an image transfer once it lasted IMAGE_TRANSFER_DURATION
+        """
+        with self.image_transfer_lock:
+            if self.image_transfer is not command:
+                # A newer transfer replaced it and already ended it
+                return
+            self.image_transfer = None
+            self.image_timer = None
+        self.stop_image_transfer(command)
+
+    def stop_image_transfer(self, command):
+        try:
+            self.img_bridge.stop_forwarding()
+        except Exception as e:
+            self.logger.error(e)
+        
+        self.respond(command, 'end_img', 200, topic='test_topic')
     
                 
     def on_connect(self, client, userdata, flags, rc):
         """
         Callback function called when the client successfully connects to the broker
         """
-        print(f"Connected to MQTT broker with result code {str(rc)}")
-        self.client.subscribe(self.status_check_topic)
-        self.client.subscribe(self.command_topic)
+        self.logger.info(f"Connected to MQTT broker with result code {str(rc)}")
+        self.subscribe(self.status_check_topic)
+        self.subscribe(self.command_topic)
         self.timeout = 0
-        
-        # Continuously publish device heartbeat 
-        # daemon thread is running in the background and does not prevent the
-        # main program from existing. when the main program exists, any 
-        # remaining daemon threads are terminated automatically. 
-        heartbeat_thread = threading.Thread(target=self.send_heartbeat, daemon=True)
-        heartbeat_thread.start()   
     
     def send_heartbeat(self):
         """
         Publish device heartbeat 
         """
         while True:
-            self.publish("/iot_device/heartbeat", "heartbeat", qos=1)            
-            time.sleep(2)
+            # A heartbeat is only worth its time, skip them during an outage instead of buffering a burst
+            if self.connection.online:
+                self.publish(self.heartbeat_topic, "heartbeat", qos=1)            
+            time.sleep(self.HEARTBEAT_INTERVAL)
         
 if __name__ == "__main__":
     
     try: 
         # Set up MQTT client and callbacks
         sn = Vibot()
-        sn.client.loop_forever()
+        sn.connection.loop_forever()
     except rospy.ROSInterruptException:
         pass
@@ -0,0 +1,545 @@
+'''
+Asyncio facade of a Vibot for host applications built on an event loop.
+
+AsyncDevice talks to a device without the threads and polling loops of
+DeviceCommander. Its paho client is driven by the event loop itself,
+through the paho socket callbacks: the socket is watched with add_reader
+and add_writer, loop_misc runs every second for the keepalive, and the
+reconnect backoff waits with asyncio.sleep. Every callback runs on the
+event loop. What would block it runs elsewhere: each connection attempt,
+with its DNS lookup and TCP handshake, on the default executor, and the
+reassembly and decoding of the point clouds and images on a single decode
+thread, which keeps the frames in order. The decoded items are handed back
+to the event loop.
+
+    async def main():
+        async with AsyncDevice(host=broker) as device:
+            if not await device.status_check():
+                return
+            await device.enable_vio()
+            await device.start_point_cloud_transfer(voxel_size=0.05)
+            async for cloud in device.point_clouds():
+                print(cloud.header.seq, cloud.points.shape)
+
+    asyncio.run(main())
+
+Commands are coroutines. Each one resolves with the response of the
+device, raises CommandError when the device answers with an error code,
+and asyncio.TimeoutError when it does not answer in time. point_clouds(),
+images() and heartbeats() are async iterators, each with its own bounded
+queue. A consumer falling behind loses the oldest items, not the newest.
+The data topics are subscribed while at least one iterator is open.
+watch_status() yields True and False as the heartbeat of the device comes
+and goes.
+'''
+
+import asyncio
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from bridge import Bridge
+from connection import Connection
+import commands
+import topics
+import image_codec
+import point_cloud_codec as pc_codec
+import point_cloud_delta as pc_delta
+
+# header: the frame header, None for legacy hex frames, points: an (N, 3) float32 array
+PointCloudFrame = namedtuple("PointCloudFrame", ["header", "points"])
+# header: the image packet header with the image metadata, array: the decoded image
+ReceivedImage = namedtuple("ReceivedImage", ["header", "array"])
+
+
+class CommandError(Exception):
+    """
+    The device answered a command with an error code
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.code = response.params.get("code")
+        super().__init__(
+            f"Device answered {response.name} with code {self.code}: {response.params.get('error', '')}"
+        )
+
+
+class AsyncioNetworkLoop:
+    """
+    Run the network loop of a Connection on an asyncio event loop, reconnecting with its backoff
+    """
+    # Seconds between two calls of loop_misc, which sends the keepalive pings
+    MISC_INTERVAL = 1.0
+
+    def __init__(self, connection, loop):
+        """
+        :param connection: The Connection to drive, install the loop before it connects
+        :param loop: The running event loop
+        """
+        self.connection = connection
+        self.client = connection.client
+        self.loop = loop
+        self._loop_thread = threading.get_ident()
+        self._task = None
+        # The first attempt is made at once, the next ones after the backoff
+        self._attempted = False
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _call(self, func, *args):
+        # paho opens the socket on the executor thread while connecting, the event loop is only touched from its thread
+        if threading.get_ident() == self._loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._call(self.loop.add_reader, sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self._call(self.loop.remove_reader, sock)
+        self._call(self.loop.remove_writer, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock)
+
+    def start(self):
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        connection = self.connection
+        while not connection.disconnect_flag:
+            if self.client.socket() is None:
+                # Not connected, or the connection dropped: wait for the backoff and try again
+                delay = connection.next_backoff() if self._attempted else 0.0
+                self._attempted = True
+                await asyncio.sleep(delay)
+                if not connection.disconnect_flag:
+                    # The DNS lookup and the TCP handshake block, they must not hold up the event loop
+                    await self.loop.run_in_executor(None, connection.reconnect, delay)
+                continue
+            self.client.loop_misc()
+            await asyncio.sleep(self.MISC_INTERVAL)
+
+
+class AsyncDevice(Bridge):
+    """
+    Awaitable commands and async iterators of the data of a Vibot, on a single event loop
+    """
+    DEFAULT_MQTT_TOPIC = topics.COMMAND_RESPONSE
+    DEFAULT_BINARY_COMMANDS = False
+    # Seconds to wait for the response to a command
+    DEFAULT_TIMEOUT = 20.0
+    # Items each iterator keeps for a slow consumer before dropping the oldest one
+    DEFAULT_QUEUE_SIZE = 10
+    DEFAULT_HEARTBEAT_TIMEOUT = 60.0
+    KEYFRAME_REQUEST_INTERVAL = 1.0
+    # Checks, 10 ms apart, that the DISCONNECT packet was sent when closing
+    CLOSE_POLLS = 100
+
+    COMMAND_TOPIC = topics.COMMAND
+    HEARTBEAT_TOPIC = topics.HEARTBEAT
+    STATUS_CHECK_TOPIC = topics.STATUS_CHECK
+    STATUS_RESPONSE_TOPIC = topics.STATUS_RESPONSE
+    DATA_TOPICS = {"point_cloud": topics.POINT_CLOUD, "image": topics.IMAGE}
+
+    def __init__(
+            self,
+            mqtt_topic=DEFAULT_MQTT_TOPIC,
+            client_id="async_commander",
+            user_id="",
+            password="",
+            host="localhost",
+            port=1883,
+            keepalive=60,
+            qos=0,
+            binary_commands=DEFAULT_BINARY_COMMANDS,
+            timeout=DEFAULT_TIMEOUT,
+            queue_size=DEFAULT_QUEUE_SIZE,
+            heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT,
+            device_id=None
+    ):
+        """
+        Must be created on the running event loop, e.g. in a coroutine
+        :param binary_commands: Send the commands in the compact binary encoding
+        :param timeout: The default seconds to wait for the response to a command
+        :param queue_size: The number of items each iterator keeps for a slow consumer
+        :param heartbeat_timeout: Seconds without a heartbeat before the device is considered offline
+        :param device_id: The id namespacing the topics of the device, see topics.py. Optional, defaults to the global topics.
+        """
+        # Validate user inputs
+        if timeout <= 0 or heartbeat_timeout <= 0:
+            raise ValueError("Timeouts must be positive")
+        if queue_size <= 0:
+            raise ValueError("Queue size must be a positive integer")
+        if device_id is not None:
+            topics.validate_device_id(device_id)
+
+        self.device_id = device_id
+        mqtt_topic = topics.device_topic(mqtt_topic, device_id)
+        self.COMMAND_TOPIC = topics.device_topic(self.COMMAND_TOPIC, device_id)
+        self.HEARTBEAT_TOPIC = topics.device_topic(self.HEARTBEAT_TOPIC, device_id)
+        self.STATUS_CHECK_TOPIC = topics.device_topic(self.STATUS_CHECK_TOPIC, device_id)
+        self.STATUS_RESPONSE_TOPIC = topics.device_topic(self.STATUS_RESPONSE_TOPIC, device_id)
+        self.DATA_TOPICS = {stream: topics.device_topic(topic, device_id) for stream, topic in self.DATA_TOPICS.items()}
+
+        self.loop = asyncio.get_running_loop()
+        self.binary_commands = binary_commands
+        self.command_timeout = timeout
+        self.queue_size = queue_size
+        self.heartbeat_timeout = heartbeat_timeout
+        self.last_heartbeat_time = None
+        self.connected = asyncio.Event()
+
+        # Commands waiting for their response, by correlation id
+        self.pending = commands.PendingRequests()
+        self.responses = commands.CommandDispatcher("type", self.on_response, self.pending)
+        # The decoders are reset as the response is received, before the frames of the new transfer
+        self.responses.register("start_pc", self.on_start_pc)
+        self.responses.register("start_img", self.on_start_img)
+        self.topic_handlers = {
+            mqtt_topic: self.on_command_response,
+            self.HEARTBEAT_TOPIC: self.on_heartbeat,
+            self.STATUS_RESPONSE_TOPIC: self.on_status_response,
+            self.DATA_TOPICS["point_cloud"]: self.on_point_cloud,
+            self.DATA_TOPICS["image"]: self.on_image,
+        }
+        # Queues of the open iterators by stream
+        self.subscribers = {"point_cloud": set(), "image": set(), "heartbeat": set(), "status_response": set()}
+
+        # Decoding state of the data topics, as in PointCloudProcessor and ImageProcessor,
+        # used by the decode thread only, which takes the messages in the order they came in
+        self.decoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="async_device_decoder")
+        self.codec = pc_codec.create_codec("raw")
+        self.frame_assembler = pc_codec.FrameAssembler()
+        self.delta_decoder = pc_delta.DeltaDecoder()
+        self.image_assembler = image_codec.ImageAssembler()
+        self.last_keyframe_request = 0.0
+
+        # The network loop must be installed before the connection opens its socket, it makes the first attempt
+        connection = Connection(client_id, user_id, password, host, port, keepalive)
+        self.network_loop = AsyncioNetworkLoop(connection, self.loop)
+        super().__init__(mqtt_topic, client_id, user_id, password, host, port, keepalive, qos,
+                         connection=connection)
+        self.network_loop.start()
+
+    def connect(self):
+        """
+        Only record the broker, the network loop connects without blocking the event loop
+        """
+        self.client.connect_async(self.host, self.port, self.keepalive)
+
+    async def __aenter__(self):
+        await self.wait_connected()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def wait_connected(self, timeout=None):
+        """
+        Wait until the broker accepted the connection
+        :param timeout: Seconds to wait. Optional, defaults to the command timeout.
+        """
+        await asyncio.wait_for(self.connected.wait(), timeout or self.command_timeout)
+
+    async def close(self):
+        """
+        Disconnect from the broker and stop the network loop
+        """
+        self.pending.cancel_all()
+        self.disconnect()
+        # Give the network loop the chance to send the DISCONNECT packet, which closes the socket
+        for _ in range(self.CLOSE_POLLS):
+            if self.client.socket() is None:
+                break
+            await asyncio.sleep(0.01)
+        await self.network_loop.stop()
+        self.decoder.shutdown(wait=False)
+
+    def on_connect(self, client, userdata, flags, rc):
+        logging.info(f"Async device connected to MQTT broker with result code {str(rc)}")
+        self.subscribe(self.mqtt_topic, self.qos)
+        self.subscribe(self.HEARTBEAT_TOPIC)
+        self.subscribe(self.STATUS_RESPONSE_TOPIC)
+        self.connected.set()
+
+    def on_disconnect(self, client, userdata, rc):
+        super().on_disconnect(client, userdata, rc)
+        self.connected.clear()
+
+    def msg_process(self, msg):
+        handler = self.topic_handlers.get(msg.topic)
+        if handler is None:
+            logging.warning(f"Async device received a message from the unexpected topic {msg.topic}")
+            return
+        handler(msg)
+
+    def _put(self, stream, item):
+        for queue in self.subscribers[stream]:
+            if queue.full():
+                # Keep the freshest items for a consumer falling behind
+                queue.get_nowait()
+            queue.put_nowait(item)
+
+    async def _iterate(self, stream, topic=None):
+        subscribers = self.subscribers[stream]
+        if topic is not None and not subscribers:
+            self.subscribe(topic, self.qos)
+        queue = asyncio.Queue(self.queue_size)
+        subscribers.add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            subscribers.discard(queue)
+            if topic is not None and not subscribers:
+                self.unsubscribe(topic)
+
+    # Commands
+
+    async def command(self, name, response_type=None, timeout=None, **params):
+        """
+        Send a command to the device
+        :param name: The command name, e.g. "enable_vio_service"
+        :param response_type: The type of the response to wait for. Optional, defaults to not waiting.
+        :param timeout: Seconds to wait for the response. Optional, defaults to the timeout of the device.
+        :param params: The parameters of the command
+        :return: The response Command, None without response_type
+        """
+        if response_type is None:
+            self.publish(self.COMMAND_TOPIC, commands.encode_command(name, params, binary=self.binary_commands))
+            return None
+        # The device echoes the correlation id, so commands of the same type can be outstanding at once
+        correlation_id, future = self.pending.create(response_type)
+        params[commands.CORRELATION_KEY] = correlation_id
+        self.publish(self.COMMAND_TOPIC, commands.encode_command(name, params, binary=self.binary_commands))
+        try:
+            response = await asyncio.wait_for(asyncio.wrap_future(future), timeout or self.command_timeout)
+        finally:
+            self.pending.discard(correlation_id)
+        if response.params.get("code") != 200:
+            raise CommandError(response)
+        return response
+
+    async def enable_vio(self, timeout=None):
+        return await self.command("enable_vio_service", "enable_vio", timeout)
+
+    async def disable_vio(self, timeout=None):
+        return await self.command("disable_vio_service", "disable_vio", timeout)
+
+    async def start_point_cloud_transfer(self, voxel_size=None, voxel_mode="centroid", max_points=None, timeout=None):
+        """
+        Ask the device to start the point cloud transfer, and select the decoder of the codec it announces
+        :param voxel_size: The voxel edge length the device downsamples to. Optional, defaults to full resolution.
+        :param voxel_mode: "centroid" or "first" point per voxel
+        :param max_points: The point budget of each point cloud. Optional, defaults to no budget.
+        """
+        params = {}
+        if voxel_size is not None or max_points is not None:
+            params = {"voxel_size": voxel_size, "voxel_mode": voxel_mode, "max_points": max_points}
+        return await self.command("start_point_cloud_transfer", "start_pc", timeout, **params)
+
+    async def end_point_cloud_transfer(self, timeout=None):
+        return await self.command("end_point_cloud_transfer", "end_pc", timeout)
+
+    async def start_image_transfer(self, timeout=None):
+        return await self.command("start_image_transfer", "start_img", timeout)
+
+    async def set_point_cloud_filters(self, filters, timeout=None):
+        """
+        :param filters: A list of filter configurations, e.g. [{"type": "range", "min": 0.5, "max": 20}]
+        """
+        return await self.command("set_point_cloud_filters", "filters", timeout, filters=filters)
+
+    async def get_point_cloud_filter_stats(self, timeout=None):
+        """
+        :return: The keep ratio and time of every filter stage on the last point cloud
+        """
+        response = await self.command("get_point_cloud_filter_stats", "filter_stats", timeout)
+        return response.params["stats"]
+
+    async def status_check(self, timeout=None):
+        """
+        Verify the device: wait for its heartbeat, then for its answer to a status check
+        :return: True if the device answered in time
+        """
+        timeout = timeout or self.command_timeout
+        deadline = self.loop.time() + timeout
+        try:
+            if self.last_heartbeat_time is None:
+                await asyncio.wait_for(self._next("heartbeat"), timeout)
+            await asyncio.wait_for(
+                self._next("status_response", self.STATUS_CHECK_TOPIC, "status_check"),
+                max(0.0, deadline - self.loop.time())
+            )
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _next(self, stream, topic=None, message=None):
+        # Wait for the next item of a stream, the queue is registered before the message is published
+        queue = asyncio.Queue(1)
+        self.subscribers[stream].add(queue)
+        try:
+            if message is not None:
+                self.publish(topic, message, qos=2)
+            return await queue.get()
+        finally:
+            self.subscribers[stream].discard(queue)
+
+    def on_command_response(self, msg):
+        self.responses.dispatch(msg.payload)
+
+    def on_response(self, response):
+        """
+        Called with every response, before the command waiting for it completes
+        """
+        logging.debug(f"Response {response.name} received with code {response.params.get('code')}")
+
+    def on_start_pc(self, response):
+        self.on_response(response)
+        if response.params.get("code") == 200:
+            # Devices predating the codec negotiation send raw frames or legacy hex
+            self.decoder.submit(self._start_point_clouds, response.params.get("codec", "raw"))
+
+    def on_start_img(self, response):
+        self.on_response(response)
+        if response.params.get("code") == 200:
+            # The image ids restart with the transfer, e.g. after the device restarted
+            self.decoder.submit(self.image_assembler.reset)
+
+    def _start_point_clouds(self, codec):
+        self.codec = pc_codec.create_codec(codec)
+        self.frame_assembler.reset()
+        self.delta_decoder = pc_delta.DeltaDecoder()
+
+    # Subscriptions
+
+    def on_heartbeat(self, msg):
+        self.last_heartbeat_time = time.time()
+        self._put("heartbeat", self.last_heartbeat_time)
+
+    def on_status_response(self, msg):
+        self._put("status_response", msg.payload)
+
+    def heartbeats(self):
+        """
+        :return: An async iterator of the time.time() of each heartbeat of the device
+        """
+        return self._iterate("heartbeat")
+
+    async def watch_status(self, heartbeat_timeout=None):
+        """
+        Follow the heartbeat of the device
+        :param heartbeat_timeout: Seconds without a heartbeat before the device is offline. Optional, defaults to the timeout of the device.
+        :return: An async iterator yielding True when the device comes online and False when its heartbeat stops
+        """
+        heartbeat_timeout = heartbeat_timeout or self.heartbeat_timeout
+        online = None
+        queue = asyncio.Queue(1)
+        self.subscribers["heartbeat"].add(queue)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(queue.get(), heartbeat_timeout)
+                    status = True
+                except asyncio.TimeoutError:
+                    status = False
+                if status != online:
+                    online = status
+                    yield status
+        finally:
+            self.subscribers["heartbeat"].discard(queue)
+
+    def point_clouds(self):
+        """
+        :return: An async iterator of the PointCloudFrames received, from the next one on
+        """
+        return self._iterate("point_cloud", self.DATA_TOPICS["point_cloud"])
+
+    def images(self):
+        """
+        :return: An async iterator of the ReceivedImages received, from the next one on
+        """
+        return self._iterate("image", self.DATA_TOPICS["image"])
+
+    def on_point_cloud(self, msg):
+        self.loop.run_in_executor(self.decoder, self._decode_point_cloud, msg.payload).add_done_callback(
+            self._point_cloud_decoded
+        )
+
+    def _decode_point_cloud(self, payload):
+        # On the decode thread
+        try:
+            if pc_codec.is_chunk(payload):
+                payload = self.frame_assembler.add(payload)
+                if payload is None:
+                    # Wait for the remaining chunks of the frame
+                    return None
+            if pc_delta.is_delta_frame(payload):
+                header, points = self.delta_decoder.decode(payload)
+            else:
+                header, points = pc_codec.decode_points(payload, self.codec)
+            return PointCloudFrame(header, points)
+        except Exception as e:
+            logging.error(f"Error occurs when decoding a point cloud: {e}")
+            return None
+
+    def _point_cloud_decoded(self, future):
+        # Back on the event loop, in the order of the frames
+        if future.cancelled() or future.result() is None:
+            return
+        frame = future.result()
+        if frame.points is None:
+            # The keyframe of a delta frame was lost, the request is published from the event loop
+            self.request_keyframe()
+            return
+        self._put("point_cloud", frame)
+
+    def on_image(self, msg):
+        self.loop.run_in_executor(self.decoder, self._decode_image, msg.payload).add_done_callback(
+            self._image_decoded
+        )
+
+    def _decode_image(self, payload):
+        # On the decode thread
+        try:
+            image = self.image_assembler.add(payload)
+            if image is not None:
+                return ReceivedImage(image.header, image.to_array())
+        except Exception as e:
+            logging.error(f"Error occurs when decoding an image: {e}")
+        return None
+
+    def _image_decoded(self, future):
+        if not future.cancelled() and future.result() is not None:
+            self._put("image", future.result())
+
+    def request_keyframe(self):
+        """
+        Ask the device for a new keyframe after the reference of a delta frame was lost
+        """
+        now = time.monotonic()
+        if now - self.last_keyframe_request >= self.KEYFRAME_REQUEST_INTERVAL:
+            self.last_keyframe_request = now
+            logging.info("Lost the point cloud keyframe, requesting a new one")
+            self.publish(self.COMMAND_TOPIC, commands.encode_command("request_keyframe", binary=self.binary_commands))
@@ -2,10 +2,13 @@
 import paho.mqtt.client as mqtt
 import time
 import logging
+import metrics
+from connection import Connection
 
 class Bridge:
     def __init__(self, mqtt_topic, client_id="bridge", user_id="", password="", 
-                 host="localhost", port=1883, keepalive=60, qos=0):
+                 host="localhost", port=1883, keepalive=60, qos=0, rate_limiter=None, registry=None,
+                 connection=None):
         """
         Constructor method for the bridge class
         :param mqtt_topic: The topic to publish/subscribe to
@@ -19,6 +22,10 @@ class Bridge:
         :param keepalive: The keepalive interval for the client
         :param qos: The Quality of Service that determines the level of guarantee 
         for message delivery between MQTT client and broker. 
+        :param rate_limiter: The RateLimiter pacing the publishes. Optional, defaults to no pacing.
+        :param registry: The MetricsRegistry the bridge records into. Optional, defaults to metrics.REGISTRY.
+        :param connection: The Connection shared with other bridges. Optional, defaults to a connection of its own.
+        The broker parameters above are then taken from the connection.
         """
         # Validate user inputs
         if "#" in mqtt_topic or "+" in mqtt_topic:
@@ -34,48 +41,43 @@ class Bridge:
         self.client_id = client_id
         self.user_id = user_id
         self.password = password
-        self.host = host
-        self.port = port
-        self.keepalive = keepalive
         self.qos = qos
+        self.rate_limiter = rate_limiter
+
+        # Metrics are named after the client id, looked up once here and only updated on the hot path
+        self.registry = registry if registry is not None else metrics.REGISTRY
+        self.messages_published = self.registry.counter(f"{client_id}.messages_published")
+        self.bytes_published = self.registry.counter(f"{client_id}.bytes_published")
+        self.publish_failures = self.registry.counter(f"{client_id}.publish_failures")
+        self.publish_time = self.registry.histogram(f"{client_id}.publish_seconds")
+        self.publish_ack_latency = self.registry.histogram(f"{client_id}.publish_ack_seconds")
+        # Start time of each publish by message id, until on_publish reports its completion
+        self._publish_started = [0.0] * 65536
+        # Whether each message id holds an in-flight slot of the rate limiter
+        self._publish_limited = bytearray(65536)
 
-        self.disconnect_flag = False
-        self.rc = 1
         self.timeout = 0
 
-        # Create the MQTT client object, set the username and password, and register the callback functions
-        self.client = mqtt.Client(self.client_id, clean_session=True)
-        self.client.username_pw_set(self.user_id, self.password)
-        self.client.on_connect = self.on_connect
-        self.client.on_disconnect = self.on_disconnect
-        self.client.on_message = self.on_message
-        self.client.on_unsubscribe = self.on_unsubscribe
-        self.client.on_subscribe = self.on_subscribe
+        # Attach to the shared connection, or to a connection of our own
+        if connection is None:
+            connection = Connection(client_id, user_id, password, host, port, keepalive, registry=self.registry)
+        self.connection = connection
+        self.client = connection.client
+        self.host = connection.host
+        self.port = connection.port
+        self.keepalive = connection.keepalive
+        # Topic filters this bridge routed to its on_message, removed from the router when it disconnects
+        self.subscriptions = set()
+        connection.attach(self)
 
         # Connect to the broker
         self.connect()
 
     def connect(self):
         """
-        Connect to the MQTT broker
-        """
-        while self.rc != 0:
-            try:
-                self.rc = self.client.connect(self.host, self.port, self.keepalive)
-            except Exception as e:
-                # If the connection fails, wait for 2 seconds before trying again
-                # If the connection fails, log the error and wait for some time before trying again.
-                logging.error(f"Failed to connect to MQTT broker: {e}")
-                logging.info("Waiting for 2 seconds before retrying...")
-                time.sleep(2)
-                self.timeout += 2
-                
-                # Print some suggestions for potential soluations
-                print("---\nSuggestions: ")
-                print(f"1. Check the WIFI connection. MQTT return code(rc) currently is {self.rc}.")
-                print("2. Check the MQTT version in the cloud. You might encounter local loopback monitoring issue in mosquitto 2 and higher. (I encountered it in Aliyun). "
-                      +"\nYou may have to downgrade MQTT to 1.6 stable or configure mosquitto.conf as appropriate.")
-                print("3. Wait for a while, or rerun the program. \n")
+        Connect to the MQTT broker, once per connection
+        """
+        self.connection.connect()
 
     def msg_process(self, msg):
         """
@@ -91,33 +93,40 @@ class Bridge:
         """
         self.client.loop(loop_timeout)
 
+    def loop_start(self):
+        """
+        Start the network thread of the connection, shared with the other bridges attached to it
+        """
+        self.connection.loop_start()
+
+    def loop_stop(self):
+        self.connection.loop_stop()
+
     def on_connect(self, client, userdata, flags, rc):
         """
         Callback function called when the client successfully connects to the broker
         """
         logging.info(f"Connected to MQTT broker with result code {str(rc)}")
-        self.client.subscribe(self.mqtt_topic)
+        self.subscribe(self.mqtt_topic)
         self.timeout = 0
         
-    def subscribe(self, topic=None):
+    def subscribe(self, topic=None, qos=0):
         """
-        Subscribe to a topic. 
-        :param topic: The topic to subscribe to.Optional, defaults to the topic passed in the constructor method.
+        Subscribe to a topic, its messages are routed to on_message of this bridge. 
+        :param topic: The topic to subscribe to, wildcards are allowed. Optional, defaults to the topic passed in the constructor method.
+        :param qos: The QoS of the subscription
         """
         if topic is None:
-            topic == self.mqtt_topic
-        self.client.subscribe(topic)
+            topic = self.mqtt_topic
+        self.subscriptions.add(topic)
+        self.connection.router.add(topic, self.on_message, qos)
         
     def on_disconnect(self, client, userdata, rc):
         """
-        Callback function called when the client is unexpectedly disconnected from the broker
+        Callback function called when the client is disconnected from the broker, the connection reconnects
         """
         if rc != 0:
-            if not self.disconnect_flag:
-                logging.warning("Unexpected disconnection.")
-                logging.warning("Trying reconnection")
-                self.rc = rc
-                self.connect()
+            logging.warning(f"{self.client_id} lost the connection to the MQTT broker with result code {rc}")
 
     def on_message(self, client, userdata, msg):
         """
@@ -133,17 +142,17 @@ class Bridge:
         if topic is None:
             topic = self.mqtt_topic
         logging.info(f"Unsubscribing {topic}")
-        self.client.unsubscribe(topic)
+        self.subscriptions.discard(topic)
+        self.connection.router.remove(topic, self.on_message)
         logging.info(f"Unsubscribed {topic}")
         
     def disconnect(self):
         """
-        Disconnect from the MQTT broker
+        Detach from the connection, which disconnects from the MQTT broker with its last bridge
         """
-        logging.info("Disconnecting from MQTT broker...")
-        self.disconnect_flag = True
-        self.client.disconnect()
-        logging.info("Disconnected from MQTT broker...")
+        for topic in list(self.subscriptions):
+            self.unsubscribe(topic)
+        self.connection.detach(self)
 
     def on_unsubscribe(self, client, userdata, mid):
         """
@@ -157,17 +166,61 @@ class Bridge:
         """
         logging.info(f"Subscribed to topic with message id {str(mid)} and QoS {str(granted_qos)}")
     
+    def on_publish(self, client, userdata, mid):
+        """
+        Callback function called when the publish of a message has completed
+        """
+        started = self._publish_started[mid]
+        if started:
+            self._publish_started[mid] = 0.0
+            self.publish_ack_latency.observe(time.perf_counter() - started)
+        if self.rate_limiter is not None and self._publish_limited[mid]:
+            self.rate_limiter.release()
+
     def publish(self, topic=None, message=None, qos=0):
         """
         Publish a message to the MQTT broker
         :param message: The message to publish
+        :return: The MQTTMessageInfo of the message, or a BufferedPublish while the connection is offline
         """
         if topic is None:
             topic = self.mqtt_topic
         if message is None:
             message = "Warning: You have not specified the message to publish. Check out the Bridge class!"
-        logging.info(f"Publishing message the message ('{message}') to topic {topic}")
-        self.client.publish(topic, message, qos)
+        # Only log the size, formatting large binary payloads into the log line is expensive
+        logging.debug(f"Publishing a message of {len(message)} bytes to topic {topic}")
+        start = time.perf_counter()
+        buffered = self.connection.buffer_publish(self, topic, message, qos)
+        if buffered is not None:
+            # Offline, the connection sends the message through send once it reconnects
+            return buffered
+        if self.rate_limiter is not None:
+            # Wait for the rate limiter before handing the message to paho
+            self.rate_limiter.acquire(len(message))
+        return self.send(topic, message, qos, start)
+
+    def send(self, topic, message, qos, start, limited=True):
+        """
+        Hand a message to paho and account for it
+        :param start: The perf_counter time the publish started
+        :param limited: False if the message did not acquire the rate limiter
+        :return: The MQTTMessageInfo of the message
+        """
+        info = self.client.publish(topic, message, qos)
+        self.publish_time.observe(time.perf_counter() - start)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            self.publish_failures.inc()
+            if self.rate_limiter is not None and limited:
+                # on_publish will not be called for a message that failed to be sent
+                self.rate_limiter.release()
+            return info
+        self.messages_published.inc()
+        self.bytes_published.inc(len(message))
+        # The connection calls on_publish of this bridge once the message completes, even if it already did
+        self._publish_started[info.mid] = start
+        self._publish_limited[info.mid] = limited
+        self.connection.track_publish(info.mid, self)
+        return info
         
     def hook(self):
         """
@@ -181,5 +234,5 @@ class Bridge:
         """
         Get the amount of time elapsed since the connection attempt started
         """
-        return self.timeout
+        return self.connection.timeout
     
\ No newline at end of file
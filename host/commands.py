@@ -0,0 +1,262 @@
+'''
+Encoding and dispatch of the control messages: the commands the host sends
+on /iot_device/command and the responses the device sends back on
+/iot_device/command_response.
+
+A command travels in one of three encodings:
+
+    status_check                                      plain text, a command without parameters
+    {"command": "start_point_cloud_transfer", ...}    JSON object with its parameters
+    0xC1 <code> [JSON parameters]                     compact binary
+
+The binary encoding replaces the name by its one byte code from
+COMMAND_CODES and only carries the JSON of the parameters, when there are
+any. 0xC1 never starts a UTF-8 text, so the three encodings are told apart
+by their first byte. Responses are encoded the same way, with their name
+under "type" instead of "command".
+
+CommandDispatcher parses a payload exactly once and finds the handler of
+the command in a dictionary. Adding a command is a register call. Given an
+executor, it runs the handlers there instead of on the thread that
+received the payload, e.g. so that a slow handler does not hold up the
+network loop every publish goes through.
+
+A command may carry a correlation id in its parameters, under "id". The
+device echoes it back in the response, so the host can wait for the
+response of each command on its own future, with several commands
+outstanding at once. PendingRequests keeps those futures. Responses of
+devices predating the correlation ids complete the oldest command waiting
+for their type instead.
+
+This module is shared by the device and the host, keep both copies identical.
+'''
+
+import itertools
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+
+BINARY_MARKER = 0xC1
+
+# One byte code of each command and response name. Append only, the codes are part of the wire format.
+COMMAND_CODES = {
+    # Commands, host to device
+    "status_check": 1,
+    "enable_vio_service": 2,
+    "disable_vio_service": 3,
+    "start_point_cloud_transfer": 4,
+    "end_point_cloud_transfer": 5,
+    "start_image_transfer": 6,
+    "set_point_cloud_filters": 7,
+    "get_point_cloud_filter_stats": 8,
+    "request_keyframe": 9,
+    # Responses, device to host
+    "enable_vio": 64,
+    "disable_vio": 65,
+    "start_pc": 66,
+    "end_pc": 67,
+    "start_img": 68,
+    "end_img": 69,
+    "filters": 70,
+    "filter_stats": 71,
+}
+COMMAND_NAMES = {code: name for name, code in COMMAND_CODES.items()}
+
+# Type of the response the device sends to each command, request_keyframe has none
+RESPONSE_TYPES = {
+    "enable_vio_service": "enable_vio",
+    "disable_vio_service": "disable_vio",
+    "start_point_cloud_transfer": "start_pc",
+    "end_point_cloud_transfer": "end_pc",
+    "start_image_transfer": "start_img",
+    "set_point_cloud_filters": "filters",
+    "get_point_cloud_filter_stats": "filter_stats",
+}
+
+# Parameter of the correlation id of a command, echoed in its response
+CORRELATION_KEY = "id"
+
+# name: the command or response name, params: its parameters, binary: True if it came binary encoded
+Command = namedtuple("Command", ["name", "params", "binary"])
+
+
+def encode_command(name, params=None, key="command", binary=False):
+    """
+    Encode a command or a response
+    :param name: The command name, or the response type
+    :param params: A dictionary of parameters. Optional, defaults to none.
+    :param key: The field holding the name in the JSON encoding, "command" or "type"
+    :param binary: Use the compact binary encoding, the name must be in COMMAND_CODES
+    :return: The payload, bytes if binary, str otherwise
+    """
+    if binary:
+        if name not in COMMAND_CODES:
+            raise ValueError(f"Command {name} has no binary code")
+        header = bytes((BINARY_MARKER, COMMAND_CODES[name]))
+        return header + json.dumps(params, separators=(",", ":")).encode() if params else header
+    if not params:
+        return name
+    return json.dumps({key: name, **params})
+
+
+def decode_command(payload, key="command"):
+    """
+    Decode a command or a response in any of the three encodings
+    :param payload: The bytes or text of the message
+    :param key: The field holding the name in the JSON encoding, "command" or "type"
+    :return: A Command
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if payload[:1] == bytes((BINARY_MARKER,)):
+        if len(payload) < 2 or payload[1] not in COMMAND_NAMES:
+            raise ValueError("Unknown binary command code")
+        params = json.loads(payload[2:]) if len(payload) > 2 else {}
+        if not isinstance(params, dict):
+            raise ValueError("Command parameters must be a JSON object")
+        return Command(COMMAND_NAMES[payload[1]], params, True)
+    if payload[:1] == b"{":
+        # json.loads takes the bytes directly, no intermediate string
+        params = json.loads(payload)
+        if not isinstance(params, dict):
+            raise ValueError("Command must be a JSON object")
+        return Command(params.get(key, ""), params, False)
+    return Command(payload.decode(), {}, False)
+
+
+class CommandDispatcher:
+    """
+    Map command names to their handlers
+    """
+
+    def __init__(self, key="command", default=None, pending=None, executor=None):
+        """
+        :param key: The field holding the name in the JSON encoding, "command" or "type"
+        :param default: Called with the Command when no handler is registered for it. Optional, defaults to a warning.
+        :param pending: The PendingRequests completed by the responses, after their handler ran. Optional.
+        :param executor: A concurrent.futures.Executor running the handlers. Optional, defaults to the calling thread.
+            A single worker keeps the commands in order.
+        """
+        self.key = key
+        self.default = default
+        self.pending = pending
+        self.executor = executor
+        self.handlers = {}
+
+    def register(self, name, handler):
+        """
+        :param name: The command name, or the response type
+        :param handler: Called with the Command, its return value is returned by dispatch
+        """
+        self.handlers[name] = handler
+
+    def dispatch(self, payload):
+        """
+        Decode a payload and call the handler of its command
+        :return: The value returned by the handler, None if the payload is invalid.
+            With an executor, a Future of that value.
+        """
+        try:
+            command = decode_command(payload, self.key)
+        except (ValueError, UnicodeDecodeError) as e:
+            logging.warning(f"Invalid command received: {e}")
+            return None
+        if self.executor is not None:
+            return self.executor.submit(self._run, command)
+        return self.handle(command)
+
+    def handle(self, command):
+        """
+        Call the handler of a decoded command, then complete the request waiting for it
+        :return: The value returned by the handler
+        """
+        handler = self.handlers.get(command.name)
+        if handler is None:
+            if self.default is None:
+                logging.warning(f"No handler for command {command.name}")
+                result = None
+            else:
+                result = self.default(command)
+        else:
+            result = handler(command)
+        # The handlers update the state first, a caller woken by its response sees it updated
+        if self.pending is not None:
+            self.pending.resolve(command)
+        return result
+
+    def _run(self, command):
+        # On the executor nobody sees the exception of a handler, log it
+        try:
+            return self.handle(command)
+        except Exception as e:
+            logging.error(f"Error occurs when handling command {command.name}: {e}")
+            return None
+
+
+class PendingRequests:
+    """
+    The futures of the commands waiting for their response, by correlation id
+    """
+
+    def __init__(self):
+        # A random prefix keeps apart the ids of the hosts commanding the same device
+        self.prefix = os.urandom(3).hex()
+        self._next_id = itertools.count(1)
+        # Correlation id mapped to the (response type, Future) of the command, oldest first
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def create(self, response_type):
+        """
+        Register a command about to be sent
+        :param response_type: The type of the response expected, e.g. "enable_vio"
+        :return: A (correlation id, Future) tuple, the future completes with the response Command
+        """
+        correlation_id = f"{self.prefix}-{next(self._next_id)}"
+        future = Future()
+        with self._lock:
+            self._pending[correlation_id] = (response_type, future)
+        return correlation_id, future
+
+    def discard(self, correlation_id):
+        """
+        Forget a command whose caller stopped waiting, e.g. after a timeout
+        """
+        with self._lock:
+            self._pending.pop(correlation_id, None)
+
+    def resolve(self, response):
+        """
+        Complete the future of the command a response answers
+        :return: True if a command was waiting for the response
+        """
+        correlation_id = response.params.get(CORRELATION_KEY)
+        with self._lock:
+            if correlation_id is not None:
+                entry = self._pending.pop(correlation_id, None)
+            else:
+                # A device predating the correlation ids answered, complete the oldest command of this type
+                entry = None
+                for key, (response_type, _) in self._pending.items():
+                    if response_type == response.name:
+                        entry = self._pending.pop(key)
+                        break
+        if entry is None:
+            return False
+        future = entry[1]
+        if future.set_running_or_notify_cancel():
+            future.set_result(response)
+        return True
+
+    def cancel_all(self):
+        with self._lock:
+            entries = list(self._pending.values())
+            self._pending.clear()
+        for _, future in entries:
+            future.cancel()
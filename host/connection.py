@@ -0,0 +1,530 @@
+'''
+One MQTT connection shared by several bridges.
+
+Every Bridge used to open its own client, with its own network thread,
+keepalive traffic and TCP handshake with the broker. A Connection owns a
+single paho client instead, and the bridges of a process attach to it:
+
+    connection = Connection("vibot_device", host=broker)
+    forwarder = PointCloudForwarder(..., connection=connection)
+    vibot = Vibot(..., connection=connection)
+
+The TopicRouter of the connection registers one paho message callback per
+topic filter with message_callback_add, so paho does the wildcard matching,
+and dispatches each message to every handler registered on the filter. A
+handler raising an exception does not keep the other handlers from the
+message, nor stop the network loop. The filters are subscribed again on
+every connect.
+
+The paho callbacks are fanned out to the attached bridges, except
+on_publish which only goes to the bridge that published the message.
+
+The network loop of the connection (loop_start or loop_forever) is the only
+thread writing to the socket. While it runs, a publish from another thread
+only queues the packet in paho and wakes the loop through a socket pair, so
+the partial writes of large payloads never interleave. The loop also
+reconnects: when the connection drops, it retries with a jittered
+exponential backoff instead of blocking a paho callback. Messages published
+while offline are kept in a bounded buffer and sent in order once the
+broker accepts the connection again. When the buffer is full, the oldest or
+the newest message is dropped. stats() and the metrics report the
+reconnects, the time to recover and the buffered and dropped messages.
+
+This module is shared by the device and the host, keep both copies identical.
+'''
+
+import logging
+import random
+import select
+import socket
+import threading
+import time
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+import metrics
+
+
+class TopicRouter:
+    """
+    Dispatch the messages of a client to the handlers registered on the matching topic filters
+    """
+
+    def __init__(self, client):
+        """
+        :param client: The paho client the routes are registered on
+        """
+        self.client = client
+        # Topic filter mapped to its (handler, qos) pairs, replaced as a whole so dispatch needs no lock
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def add(self, topic_filter, handler, qos=0):
+        """
+        Route the messages matching a topic filter to a handler, and subscribe to the filter
+        :param topic_filter: A topic, the + and # wildcards are allowed
+        :param handler: Called with (client, userdata, msg) like a paho on_message callback
+        :param qos: The QoS the handler needs, the filter is subscribed with the highest one
+        """
+        # Validate user inputs
+        if qos not in [0, 1, 2]:
+            raise ValueError("QoS level must be 0, 1, or 2")
+
+        with self._lock:
+            handlers = self.routes.get(topic_filter, ())
+            previous_qos = max((route_qos for _, route_qos in handlers), default=-1)
+            handlers = tuple(route for route in handlers if route[0] != handler) + ((handler, qos),)
+            self.routes[topic_filter] = handlers
+        if previous_qos < 0:
+            self.client.message_callback_add(topic_filter, self._dispatcher(topic_filter))
+        if qos > previous_qos:
+            self.client.subscribe(topic_filter, qos)
+
+    def remove(self, topic_filter, handler):
+        """
+        Stop routing a topic filter to a handler, the filter is unsubscribed with its last handler
+        """
+        with self._lock:
+            handlers = tuple(route for route in self.routes.get(topic_filter, ()) if route[0] != handler)
+            if handlers:
+                self.routes[topic_filter] = handlers
+            else:
+                self.routes.pop(topic_filter, None)
+        if not handlers:
+            self.client.message_callback_remove(topic_filter)
+            self.client.unsubscribe(topic_filter)
+
+    def resubscribe(self):
+        """
+        Subscribe to every routed filter, the broker forgets them with a clean session
+        """
+        with self._lock:
+            subscriptions = [(topic_filter, max(qos for _, qos in handlers))
+                             for topic_filter, handlers in self.routes.items()]
+        if subscriptions:
+            self.client.subscribe(subscriptions)
+
+    def _dispatcher(self, topic_filter):
+        def dispatch(client, userdata, msg):
+            for handler, _ in self.routes.get(topic_filter, ()):
+                try:
+                    handler(client, userdata, msg)
+                except Exception as e:
+                    logging.error(f"Error occurs when handling a message from {msg.topic}: {e}")
+        return dispatch
+
+
+class BufferedPublish:
+    """
+    Stands in for the MQTTMessageInfo of a message published while offline
+    """
+
+    def __init__(self):
+        self.rc = mqtt.MQTT_ERR_SUCCESS
+        self.mid = None
+        # The MQTTMessageInfo of the message once it is sent on reconnect
+        self.info = None
+        self._sent = threading.Event()
+
+    def _set_sent(self, info):
+        self.info = info
+        self.rc = info.rc
+        self.mid = info.mid
+        self._sent.set()
+
+    def _set_dropped(self):
+        self.rc = mqtt.MQTT_ERR_QUEUE_SIZE
+        self._sent.set()
+
+    def is_published(self):
+        return self.info is not None and self.info.is_published()
+
+    def wait_for_publish(self, timeout=None):
+        """
+        Block until the message is published, or was dropped from the offline buffer, or the timeout expires
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._sent.wait(timeout) or self.info is None:
+            return
+        self.info.wait_for_publish(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+
+class Connection:
+    """
+    A paho client shared by the bridges attached to it
+    """
+    DEFAULT_MIN_BACKOFF = 1.0
+    DEFAULT_MAX_BACKOFF = 60.0
+    DEFAULT_BUFFER_SIZE = 1000
+    DEFAULT_BUFFER_BYTES = 8 * 1024 * 1024
+    DEFAULT_BUFFER_POLICY = "drop_oldest"
+    BUFFER_POLICIES = ("drop_oldest", "drop_newest")
+    # Seconds the network loop waits for traffic before checking whether it should stop
+    LOOP_TIMEOUT = 1.0
+    # Upper bounds in seconds of the time-to-recover histogram
+    RECOVERY_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+    def __init__(self, client_id="bridge", user_id="", password="", host="localhost", port=1883, keepalive=60,
+                 min_backoff=DEFAULT_MIN_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+                 buffer_size=DEFAULT_BUFFER_SIZE, buffer_bytes=DEFAULT_BUFFER_BYTES,
+                 buffer_policy=DEFAULT_BUFFER_POLICY, registry=None):
+        """
+        :param client_id: The ID of the client
+        :param user_id: The user ID for the broker
+        :param password: The password for the broker
+        :param host: The hostname or IP address of the broker
+        :param port: The port number of the broker
+        :param keepalive: The keepalive interval for the client
+        :param min_backoff: Seconds before the first reconnect attempt, doubled after each failure
+        :param max_backoff: The longest wait between two reconnect attempts
+        :param buffer_size: The maximum number of messages kept while offline
+        :param buffer_bytes: The maximum number of payload bytes kept while offline
+        :param buffer_policy: "drop_oldest" or "drop_newest" message when the offline buffer is full
+        :param registry: The MetricsRegistry of the reconnect and buffer metrics. Optional, defaults to metrics.REGISTRY.
+        """
+        # Validate user inputs
+        if keepalive <= 0:
+            raise ValueError("Keepalive interval must be a positive integer")
+        if not isinstance(port, int):
+            raise ValueError("Port must be an integer!")
+        if min_backoff <= 0 or max_backoff < min_backoff:
+            raise ValueError("Backoff must be positive and the maximum at least the minimum")
+        if buffer_size < 0 or buffer_bytes < 0:
+            raise ValueError("Offline buffer limits cannot be negative")
+        if buffer_policy not in self.BUFFER_POLICIES:
+            raise ValueError(f"Buffer policy must be one of {self.BUFFER_POLICIES}")
+
+        self.client_id = client_id
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.buffer_size = buffer_size
+        self.buffer_bytes = buffer_bytes
+        self.buffer_policy = buffer_policy
+        self.bridges = []
+        self.disconnect_flag = False
+        self.rc = 1
+        # Seconds spent waiting to reconnect since the connection was lost
+        self.timeout = 0
+        self._lock = threading.Lock()
+
+        # Reconnect state, owned by the network loop thread
+        self.online = False
+        self.attempts = 0
+        self.offline_since = None
+        self.last_recovery_seconds = None
+        self._loop_users = 0
+        self._loop_thread = None
+        self._stop = threading.Event()
+
+        # Messages published while offline, sent in order on reconnect
+        self._buffer = deque()
+        self._buffered_bytes = 0
+        self._buffer_lock = threading.Lock()
+
+        registry = registry if registry is not None else metrics.REGISTRY
+        self.reconnects = registry.counter(f"{client_id}.reconnects")
+        self.buffered = registry.gauge(f"{client_id}.offline_buffered")
+        self.buffer_dropped = registry.counter(f"{client_id}.offline_dropped")
+        self.recovery_time = registry.histogram(f"{client_id}.time_to_recover_seconds", self.RECOVERY_BUCKETS)
+
+        # Bridge of each message id until on_publish reports its completion, and the completions
+        # reported before the bridge was recorded. Single dict operations are atomic under the GIL,
+        # no lock is taken since paho calls on_publish while it holds its own message lock.
+        self._publishers = {}
+        self._completed = {}
+
+        self.client = mqtt.Client(client_id, clean_session=True)
+        self.client.username_pw_set(user_id, password)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.client.on_subscribe = self.on_subscribe
+        self.client.on_unsubscribe = self.on_unsubscribe
+        self.client.on_publish = self.on_publish
+        self.router = TopicRouter(self.client)
+
+    def attach(self, bridge):
+        """
+        Add a bridge to the connection, it receives the connection callbacks from now on
+        """
+        with self._lock:
+            self.bridges.append(bridge)
+        if self.client.is_connected():
+            # The connection was established before the bridge was attached
+            bridge.on_connect(self.client, None, {}, 0)
+
+    def detach(self, bridge):
+        """
+        Remove a bridge from the connection, the connection is closed with its last bridge
+        """
+        with self._lock:
+            if bridge in self.bridges:
+                self.bridges.remove(bridge)
+            last = not self.bridges
+        if last:
+            self.disconnect()
+
+    def connect(self):
+        """
+        Make one attempt to connect to the MQTT broker, does nothing when an attached bridge already did.
+        If it fails, the network loop keeps retrying with backoff once it is started.
+        """
+        if self.rc == 0:
+            return
+        try:
+            self.rc = self.client.connect(self.host, self.port, self.keepalive)
+        except Exception as e:
+            logging.error(f"Failed to connect to MQTT broker: {e}")
+            # Print some suggestions for potential soluations, once rather than on every attempt
+            print("---\nSuggestions: ")
+            print(f"1. Check the WIFI connection. MQTT return code(rc) currently is {self.rc}.")
+            print("2. Check the MQTT version in the cloud. You might encounter local loopback monitoring issue in mosquitto 2 and higher. (I encountered it in Aliyun). "
+                  +"\nYou may have to downgrade MQTT to 1.6 stable or configure mosquitto.conf as appropriate.")
+            print("3. Wait for a while, or rerun the program. \n")
+
+    def disconnect(self):
+        """
+        Disconnect from the MQTT broker
+        """
+        logging.info("Disconnecting from MQTT broker...")
+        self.disconnect_flag = True
+        self._stop.set()
+        self.client.disconnect()
+        logging.info("Disconnected from MQTT broker...")
+
+    def loop_start(self):
+        """
+        Start the network thread, unless another bridge already started it
+        """
+        with self._lock:
+            self._loop_users += 1
+            if self._loop_users == 1:
+                self._stop.clear()
+                self._loop_thread = threading.Thread(target=self.loop_forever, name=f"{self.client_id}_network",
+                                                     daemon=True)
+                self._loop_thread.start()
+
+    def loop_stop(self):
+        """
+        Stop the network thread once every bridge that started it has stopped it
+        """
+        with self._lock:
+            if self._loop_users == 0:
+                return
+            self._loop_users -= 1
+            if self._loop_users:
+                return
+            self._stop.set()
+            thread = self._loop_thread
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def loop_forever(self):
+        """
+        Run the network loop in this thread and reconnect whenever the connection drops, until disconnect
+        """
+        # Without a paho thread, paho writes a publish to the socket from the publishing thread, racing
+        # this loop. With a register_write callback it only queues the packet, and the callback wakes the loop.
+        wake_reader, self._wake_writer = socket.socketpair()
+        wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+        self.client.on_socket_register_write = self._wake
+        try:
+            while not self._stop.is_set():
+                if self._loop_once(wake_reader) == mqtt.MQTT_ERR_SUCCESS:
+                    continue
+                if self.disconnect_flag:
+                    break
+                self._reconnect()
+        finally:
+            self.client.on_socket_register_write = None
+            wake_reader.close()
+            self._wake_writer.close()
+
+    def _wake(self, client, userdata, sock):
+        try:
+            self._wake_writer.send(b"\0")
+        except OSError:
+            # The socket pair is full, the loop is already woken up
+            pass
+
+    def _loop_once(self, wake_reader):
+        sock = self.client.socket()
+        if sock is None:
+            return mqtt.MQTT_ERR_NO_CONN
+        writers = [sock] if self.client.want_write() else []
+        try:
+            readable, writable, _ = select.select([sock, wake_reader], writers, [], self.LOOP_TIMEOUT)
+        except (OSError, TypeError, ValueError):
+            return mqtt.MQTT_ERR_CONN_LOST
+
+        if wake_reader in readable:
+            try:
+                wake_reader.recv(4096)
+            except OSError:
+                pass
+        if sock in readable:
+            rc = self.client.loop_read()
+            if rc or self.client.socket() is None:
+                return rc or mqtt.MQTT_ERR_CONN_LOST
+        if sock in writable or self.client.want_write():
+            rc = self.client.loop_write()
+            if rc or self.client.socket() is None:
+                return rc or mqtt.MQTT_ERR_CONN_LOST
+        return self.client.loop_misc()
+
+    def _reconnect(self):
+        delay = self.next_backoff()
+        if self._stop.wait(delay):
+            return
+        self.reconnect(delay)
+
+    def next_backoff(self):
+        """
+        Count a reconnect attempt
+        :return: The seconds to wait before making it
+        """
+        # Jittered exponential backoff: half the delay is fixed, the other half random, so that many
+        # devices losing the same broker do not all come back at the same instant
+        delay = min(self.max_backoff, self.min_backoff * 2 ** self.attempts)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self.attempts += 1
+        logging.warning(f"Reconnecting to MQTT broker in {delay:.1f} s, attempt {self.attempts}")
+        return delay
+
+    def reconnect(self, delay=0.0):
+        """
+        Make one reconnect attempt, for network loops driven from outside, e.g. by an asyncio event loop
+        :param delay: The seconds waited since the previous attempt
+        """
+        self.timeout += delay
+        try:
+            self.rc = self.client.connect(self.host, self.port, self.keepalive)
+        except Exception as e:
+            self.rc = mqtt.MQTT_ERR_NO_CONN
+            logging.error(f"Failed to connect to MQTT broker: {e}")
+
+    def buffer_publish(self, bridge, topic, message, qos):
+        """
+        Keep a message published while offline, to be sent by bridge.send on reconnect
+        :return: A BufferedPublish, or None if the connection is online and the message must be sent now
+        """
+        with self._buffer_lock:
+            if self.online:
+                return None
+            pending = BufferedPublish()
+            if len(message) > self.buffer_bytes or not self.buffer_size:
+                self.buffer_dropped.inc()
+                pending._set_dropped()
+                return pending
+            while (len(self._buffer) >= self.buffer_size
+                   or self._buffered_bytes + len(message) > self.buffer_bytes):
+                if self.buffer_policy == "drop_newest":
+                    self.buffer_dropped.inc()
+                    pending._set_dropped()
+                    return pending
+                dropped = self._buffer.popleft()
+                self._buffered_bytes -= len(dropped[2])
+                self.buffer_dropped.inc()
+                dropped[4]._set_dropped()
+            self._buffer.append((bridge, topic, message, qos, pending))
+            self._buffered_bytes += len(message)
+            self.buffered.set(len(self._buffer))
+        return pending
+
+    def _flush(self):
+        # The lock is held until online is set, so a publish racing the flush cannot overtake the buffer
+        with self._buffer_lock:
+            if self._buffer:
+                logging.info(f"Sending {len(self._buffer)} messages published while offline")
+            while self._buffer:
+                bridge, topic, message, qos, pending = self._buffer.popleft()
+                # Not paced by the rate limiter, waiting for an in-flight slot here would block the network loop
+                pending._set_sent(bridge.send(topic, message, qos, time.perf_counter(), limited=False))
+            self._buffered_bytes = 0
+            self.buffered.set(0)
+            self.online = True
+
+    def stats(self):
+        """
+        :return: A dictionary of the connection state, reconnect and offline buffer counts
+        """
+        with self._buffer_lock:
+            buffered, buffered_bytes = len(self._buffer), self._buffered_bytes
+        return {
+            "online": self.online,
+            "reconnects": self.reconnects.value,
+            "attempts": self.attempts,
+            "offline_seconds": time.monotonic() - self.offline_since if self.offline_since else 0.0,
+            "last_recovery_seconds": self.last_recovery_seconds,
+            "buffered": buffered,
+            "buffered_bytes": buffered_bytes,
+            "dropped": self.buffer_dropped.value,
+        }
+
+    def track_publish(self, mid, bridge):
+        """
+        Route the completion of a published message to the on_publish of its bridge
+        :param mid: The message id paho returned for the message
+        """
+        self._publishers[mid] = bridge
+        # on_publish may have run before the bridge was recorded, whoever pops the bridge reports the completion
+        if self._completed.pop(mid, None):
+            bridge = self._publishers.pop(mid, None)
+            if bridge is not None:
+                bridge.on_publish(self.client, None, mid)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logging.error(f"MQTT broker refused the connection with result code {rc}")
+            return
+        self.timeout = 0
+        self.attempts = 0
+        if self.offline_since is not None:
+            self.last_recovery_seconds = time.monotonic() - self.offline_since
+            self.offline_since = None
+            self.reconnects.inc()
+            self.recovery_time.observe(self.last_recovery_seconds)
+            logging.info(f"Reconnected to MQTT broker after {self.last_recovery_seconds:.1f} s")
+        self.router.resubscribe()
+        self._flush()
+        for bridge in list(self.bridges):
+            bridge.on_connect(client, userdata, flags, rc)
+
+    def on_disconnect(self, client, userdata, rc):
+        with self._buffer_lock:
+            self.online = False
+        self.rc = rc if rc != 0 else 1
+        if rc != 0 and not self.disconnect_flag:
+            # The network loop reconnects, nothing blocks in this callback
+            logging.warning(f"Unexpected disconnection from MQTT broker with result code {rc}")
+            if self.offline_since is None:
+                self.offline_since = time.monotonic()
+        for bridge in list(self.bridges):
+            bridge.on_disconnect(client, userdata, rc)
+
+    def on_message(self, client, userdata, msg):
+        # Only messages matching no route end up here, e.g. after a handler was removed
+        logging.debug(f"No handler for the message from topic {msg.topic}")
+
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+        for bridge in list(self.bridges):
+            bridge.on_subscribe(client, userdata, mid, granted_qos)
+
+    def on_unsubscribe(self, client, userdata, mid):
+        for bridge in list(self.bridges):
+            bridge.on_unsubscribe(client, userdata, mid)
+
+    def on_publish(self, client, userdata, mid):
+        bridge = self._publishers.pop(mid, None)
+        if bridge is None:
+            self._completed[mid] = True
+            bridge = self._publishers.pop(mid, None)
+            if bridge is None:
+                return
+            self._completed.pop(mid, None)
+        bridge.on_publish(client, userdata, mid)
@@ -11,13 +11,21 @@ import logging
 import json
 import config as CONFIG
 import iot_status_checker as isc
+import metrics
+import commands
+import concurrent.futures
+import topics
 
 from bridge import Bridge
+from connection import Connection
 
 
 class DeviceCommander(Bridge):
     # Define class constant 
-    DEFAULT_MQTT_TOPIC = "/iot_device/command_response"
+    DEFAULT_MQTT_TOPIC = topics.COMMAND_RESPONSE
+    DEFAULT_BINARY_COMMANDS = False
+    # Seconds to wait for the response to a command
+    DEFAULT_TIMEOUT = 20.0
     
     def __init__(
             self, 
@@ -28,11 +36,19 @@ class DeviceCommander(Bridge):
             host="localhost", 
             port=1883, 
             keepalive=60, 
-            qos=0
+            qos=0,
+            binary_commands=DEFAULT_BINARY_COMMANDS,
+            device_id=None
     ):
+        # The device to command, its topics are namespaced by its id, see topics.py. None for a Vibot on the global topics.
+        if device_id is not None:
+            topics.validate_device_id(device_id)
+        self.device_id = device_id
+        mqtt_topic = topics.device_topic(mqtt_topic, device_id)
+        
         # topics in the mqtt broker 
-        self.DATA_TOPISCS = {"point_cloud": "/data/point_cloud",
-                             "image": "/data/img"}
+        self.DATA_TOPISCS = {"point_cloud": topics.device_topic(topics.POINT_CLOUD, device_id),
+                             "image": topics.device_topic(topics.IMAGE, device_id)}
 
         self.heartbeat_thread = None
         self.heartbeat_running = False
@@ -45,17 +61,43 @@ class DeviceCommander(Bridge):
         self.connected = False
         
         # constants for brokers
-        self.DEVICE_HEARTBEAT = "/iot_device/heartbeat"
-        self.COMMAND = "/iot_device/command"
-        self.COMMAND_RESPONSE = "/iot_device/command_response"
+        self.DEVICE_HEARTBEAT = topics.device_topic(topics.HEARTBEAT, device_id)
+        self.COMMAND = topics.device_topic(topics.COMMAND, device_id)
+        self.COMMAND_RESPONSE = mqtt_topic
+        self.DEVICE_METRICS = topics.device_topic(topics.METRICS, device_id)
+        
+        # Latest metrics snapshot of each device, merged with the metrics of this host on demand
+        self.metrics = metrics.MetricsAggregator()
+        
+        # Messages are dispatched by topic, then command responses by type, with dictionary lookups
+        self.topic_handlers = {
+            self.DEVICE_HEARTBEAT: self.on_heartbeat,
+            self.COMMAND_RESPONSE: self.msg_process,
+            self.DEVICE_METRICS: self.on_metrics,
+            self.DATA_TOPISCS["point_cloud"]: self.on_data,
+            self.DATA_TOPISCS["image"]: self.on_data,
+        }
+        # Commands sent with a correlation id wait on a future, completed as soon as their response is handled
+        self.pending = commands.PendingRequests()
+        self.responses = commands.CommandDispatcher("type", self.unexpected_response, self.pending)
+        self.register_responses()
+        # Send the commands in the compact binary encoding, the device answers in the encoding of the command
+        self.binary_commands = binary_commands
+        
+        # The commander, the processors and the status checker share one connection to the broker
+        connection = Connection(client_id, user_id, password, host, port, keepalive)
         
         # Instantiate two message processor classes for image and point cloud.
-        self.image_processor = ImageProcessor(self.DATA_TOPISCS["image"], host=CONFIG.CONNECTION.BROKER, port=1883)
-        self.pc_processor = PointCloudProcessor(self.DATA_TOPISCS["point_cloud"], host=CONFIG.CONNECTION.BROKER, port=1883)
+        self.image_processor = ImageProcessor(self.DATA_TOPISCS["image"], connection=connection)
+        self.pc_processor = PointCloudProcessor(self.DATA_TOPISCS["point_cloud"], command_topic=self.COMMAND,
+                                                connection=connection)
         
         # Topics for various data transfer. 
         self.pc_topic = None
         self.img_topic = None
+        # Set when the device announces a transfer topic, waited on instead of polling
+        self.pc_topic_ready = threading.Event()
+        self.img_topic_ready = threading.Event()
         
         # Configure logging to both console and file
         self.logger = logging.getLogger(__name__)
@@ -81,7 +123,7 @@ class DeviceCommander(Bridge):
         
         
         super().__init__(mqtt_topic, client_id, user_id, 
-                         password, host, port, keepalive, qos)
+                         password, host, port, keepalive, qos, connection=connection)
      
     def start_check_heartbeat(self):
         with self._lock:
@@ -125,82 +167,151 @@ class DeviceCommander(Bridge):
     # Define the function to handle incoming messages
     def on_message(self, client, userdata, msg):   
         
-        if msg.topic == self.DEVICE_HEARTBEAT:
-            self.last_heartbeat_time = time.time()
-            # test code: print message when it hearts the heartbeat. 
-            # self.logger.info(f"Heartbeat received, updated last_heartbeat: {self.last_heartbeat_time}")
-               
-        elif msg.topic == self.DATA_TOPISCS["point_cloud"]:
-            # point cloud message will be handled by point cloud processor instance 
-            pass
-        
-        elif msg.topic == self.DATA_TOPISCS["image"]:
-            # image message will be handled by image processor instance 
-            pass
-            
-        elif msg.topic == self.COMMAND_RESPONSE:  
-            # self.logger.info("Command response received!!!!!")
-            self.msg_process(msg)
-        
-        else: # If message is from an unknown topic, it serves as a reminder. 
+        handler = self.topic_handlers.get(msg.topic)
+        if handler is None: # If message is from an unknown topic, it serves as a reminder. 
             self.logger.warning(f"We unexpectedly received a message from {msg.topic} topic")
             self.logger.warning("This could be a threat! ")
+            return
+        handler(msg)
     
-    def is_json(self, string):
+    def on_heartbeat(self, msg):
+        self.last_heartbeat_time = time.time()
+        # test code: print message when it hearts the heartbeat. 
+        # self.logger.info(f"Heartbeat received, updated last_heartbeat: {self.last_heartbeat_time}")
+    
+    def on_data(self, msg):
+        # point cloud and image messages are handled by the processor instances
+        pass
+    
+    def on_metrics(self, msg):
         try:
-            json_object = json.loads(string)
-        except ValueError:
-            return False
-        return True
+            snapshot = json.loads(msg.payload)
+            self.metrics.add(snapshot.get("source") or "device", snapshot)
+        except (ValueError, KeyError) as e:
+            self.logger.warning(f"Invalid metrics snapshot received: {e}")
     
     def msg_process(self, msg):
         '''
-        TODO: You can add more functionality here if needed. 
+        Handle a command response, the handler is looked up by response type, see register_responses
         '''
-        
-        if self.is_json(msg.payload.decode()):
-            # Decode the message payload from JSON format
-            json_msg = json.loads(msg.payload.decode())
-            self.logger.info(f"Received JSON message: type {json_msg['type']} and code {json_msg['code']}")
-            
-            if json_msg['type'] == "enable_vio" and json_msg['code'] == 200:
-                self.vio_enabled = True
-                
-            elif json_msg['type'] == "disable_vio" and json_msg['code'] == 200:
-                self.vio_enabled = False
-                
-            elif json_msg['type'] == "start_pc" and json_msg['code'] == 200:
-                # self.logger.info("Device responses that it will be starting point cloud transfer")
-                self.pc_topic = json_msg['topic']
-                self.pc_processor.start_processing()
-            
-            elif json_msg['type'] == "end_pc" and json_msg['code'] == 200:
-                # self.logger.info("Device responses that it will be ending point cloud transfer")
-                self.pc_topic = None
-                self.pc_processor.stop_processing()
-                
-            elif json_msg['type'] == "start_img" and json_msg['code'] == 200:
-                # self.logger.info("Device responses that it will be starting image transfer")
-                self.img_topic = json_msg['topic']
-                self.image_processor.start_processing()
-                
-            elif json_msg['type'] == "end_img" and json_msg['code'] == 200:
-                # self.logger.info("Device responses that it will be ending image transfer")
-                self.img_topic = None
-                self.image_processor.stop_processing()
-            
-            else:
-                self.logger.warning(f"A JSON message {json_msg['type']} with code {json_msg['code']} is received unexpectedly!")
-        
+        self.responses.dispatch(msg.payload)
+    
+    def register_responses(self):
+        """
+        Map every response type to its handler, a new response only needs a handler and a line here
+        """
+        self.responses.register("enable_vio", self.on_enable_vio)
+        self.responses.register("disable_vio", self.on_disable_vio)
+        self.responses.register("start_pc", self.on_start_pc)
+        self.responses.register("end_pc", self.on_end_pc)
+        self.responses.register("filters", self.on_filters)
+        self.responses.register("filter_stats", self.on_filter_stats)
+        self.responses.register("start_img", self.on_start_img)
+        self.responses.register("end_img", self.on_end_img)
+    
+    def send_command(self, name, **params):
+        """
+        Publish a command to the device
+        :param name: The command name, e.g. "start_point_cloud_transfer"
+        :param params: The parameters of the command
+        """
+        self.publish(self.COMMAND, commands.encode_command(name, params, binary=self.binary_commands))
+    
+    def request(self, name, timeout=DEFAULT_TIMEOUT, **params):
+        """
+        Publish a command with a correlation id and wait for its response, several threads can wait at once
+        :param name: The command name, e.g. "enable_vio_service"
+        :param timeout: Seconds to wait for the response
+        :param params: The parameters of the command
+        :return: The response Command, None if it did not arrive in time
+        """
+        correlation_id, future = self.pending.create(commands.RESPONSE_TYPES[name])
+        self.send_command(name, **params, **{commands.CORRELATION_KEY: correlation_id})
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            return None
+        finally:
+            self.pending.discard(correlation_id)
+    
+    def unexpected_response(self, response):
+        self.logger.warning(
+            f"A JSON message {response.name} with code {response.params.get('code')} is received unexpectedly!"
+        )
+    
+    def on_enable_vio(self, response):
+        if response.params.get('code') != 200:
+            return self.unexpected_response(response)
+        self.vio_enabled = True
+    
+    def on_disable_vio(self, response):
+        if response.params.get('code') != 200:
+            return self.unexpected_response(response)
+        self.vio_enabled = False
+    
+    def on_start_pc(self, response):
+        if response.params.get('code') != 200:
+            return self.unexpected_response(response)
+        # self.logger.info("Device responses that it will be starting point cloud transfer")
+        self.pc_topic = response.params['topic']
+        # Devices predating the codec negotiation send raw frames or legacy hex
+        self.pc_processor.set_codec(response.params.get('codec', 'raw'))
+        self.pc_processor.start_processing()
+        self.pc_topic_ready.set()
+    
+    def on_end_pc(self, response):
+        if response.params.get('code') != 200:
+            return self.unexpected_response(response)
+        # self.logger.info("Device responses that it will be ending point cloud transfer")
+        self.pc_topic = None
+        self.pc_topic_ready.clear()
+        self.pc_processor.stop_processing()
+    
+    def on_filters(self, response):
+        if response.params.get('code') == 200:
+            self.logger.info("Device point cloud filters updated")
         else:
-            self.logger.warning("An invalid JSON message is received! Please check!")
-            self.logger.warning("This could be a threat!")
+            self.logger.warning(f"Device rejected the point cloud filters: {response.params.get('error')}")
+    
+    def on_filter_stats(self, response):
+        if response.params.get('code') != 200:
+            return self.unexpected_response(response)
+        for stage in response.params['stats']:
+            self.logger.info(
+                f"Filter {stage['name']} kept {stage['keep_ratio']:.1%} of the points in {stage['ms']:.2f} ms"
+            )
+    
+    def on_start_img(self, response):
+        if response.params.get('code') != 200:
+            return self.unexpected_response(response)
+        # self.logger.info("Device responses that it will be starting image transfer")
+        self.img_topic = response.params['topic']
+        self.image_processor.start_processing()
+        self.img_topic_ready.set()
+    
+    def on_end_img(self, response):
+        if response.params.get('code') != 200:
+            return self.unexpected_response(response)
+        # self.logger.info("Device responses that it will be ending image transfer")
+        self.img_topic = None
+        self.image_processor.stop_processing()
+    
+    def metrics_report(self):
+        """
+        Merge the latest device metrics with the metrics of this host
+        :return: A dictionary of counters, gauges and histogram percentiles, see metrics.summarize
+        """
+        self.metrics.add("host", metrics.REGISTRY.snapshot())
+        return metrics.summarize(self.metrics.merged())
     
     def check_device_power_status(self):
         
-        status_checker = isc.StatusChecker(client_id = "status_checker", host=CONFIG.MQTT_BROKER.IP_ADDRESS, port=1883)
+        status_checker = isc.StatusChecker(client_id = "status_checker", connection=self.connection,
+                                           device_id=self.device_id)
         
         status = status_checker.get_device_status()
+        # Remove its routes from the shared connection, the commander keeps using it
+        status_checker.disconnect()
         print("zzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzz")
         print("Status code: ", status)
         print("zzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzz")
@@ -214,14 +325,11 @@ class DeviceCommander(Bridge):
     # Define the function to enable the vio capturing algorithm
     def enable_vio_algorithm(self):
         
-        self.publish(self.COMMAND, "enable_vio_service")
-        timeout = time.time() + 20  # Wait for up to 20 seconds
-
-        while time.time() < timeout:
-            if self.vio_enabled:
-                self.logger.debug("Successfully enabled vio service")
-                return "vio algorithm is enabled"
-            time.sleep(1)
+        # Returns as soon as the device answers, or after DEFAULT_TIMEOUT seconds
+        response = self.request("enable_vio_service")
+        if response is not None and response.params.get('code') == 200:
+            self.logger.debug("Successfully enabled vio service")
+            return "vio algorithm is enabled"
 
         self.logger.debug("Failed to enable vio service")
         return "vio algorithm has trouble being enabled"          
@@ -230,15 +338,10 @@ class DeviceCommander(Bridge):
     # Define the function to disable the vio capturing algorithm
     def disable_vio_algorithm(self):
         
-        # Wait for 10 seconds and see if we can subscribe to message from topic RESPONSE
-        self.publish(self.COMMAND, "disable_vio_service")
-        timeout = time.time() + 20  # Wait for up to 20 seconds
-
-        while time.time() < timeout:
-            if not self.vio_enabled:
-                self.logger.debug("Successfully disabled vio service")
-                return "vio algorithm is disabled"
-            time.sleep(1)
+        response = self.request("disable_vio_service")
+        if response is not None and response.params.get('code') == 200:
+            self.logger.debug("Successfully disabled vio service")
+            return "vio algorithm is disabled"
 
         self.logger.debug("Failed to disable vio service")
         return "vio algorithm has trouble being disabled"  
@@ -256,23 +359,62 @@ class DeviceCommander(Bridge):
         # then the function executes the clear command instead.
             os.system('clear')
 
-    def wait_for_pc_topic(self):
-        while self.pc_topic is None:
-            time.sleep(0.5)  # wait for a short time before checking again
+    def start_pc_transfer(self, voxel_size=None, voxel_mode="centroid", max_points=None):
+        """
+        Ask the device to start the point cloud transfer
+        :param voxel_size: The voxel edge length the device downsamples to. Optional, defaults to full resolution.
+        :param voxel_mode: "centroid" or "first" point per voxel
+        :param max_points: The point budget of each point cloud. Optional, defaults to no budget.
+        """
+        # The announcement of the previous transfer must not satisfy wait_for_pc_topic
+        self.pc_topic_ready.clear()
+        if voxel_size is None and max_points is None:
+            self.send_command("start_point_cloud_transfer")
+        else:
+            self.send_command("start_point_cloud_transfer", voxel_size=voxel_size,
+                              voxel_mode=voxel_mode, max_points=max_points)
+
+    def set_pc_filters(self, filters):
+        """
+        Replace the spatial filter chain the device runs before encoding
+        :param filters: A list of filter configurations, e.g. [{"type": "range", "min": 0.5, "max": 20}]
+        """
+        self.send_command("set_point_cloud_filters", filters=filters)
+        
+    def request_pc_filter_stats(self):
+        """
+        Ask the device for the keep ratio and time of every filter stage
+        """
+        self.send_command("get_point_cloud_filter_stats")
+
+    def wait_for_pc_topic(self, timeout=DEFAULT_TIMEOUT):
+        # Woken by the start_pc response, no polling
+        if not self.pc_topic_ready.wait(timeout):
+            return "The device did not announce the point cloud topic in time"
         return f"The point cloud data will be transferred over topic {self.pc_topic}"
     
     def end_pc_transfer(self):
         self.pc_topic = None
+        self.pc_topic_ready.clear()
         return "OK"
     
-    def wait_for_img_topic(self):
-        while self.img_topic is None:
-            time.sleep(0.5)  # wait for a short time before checking again
+    def start_img_transfer(self):
+        """
+        Ask the device for an image
+        """
+        self.img_topic_ready.clear()
+        self.send_command("start_image_transfer")
+    
+    def wait_for_img_topic(self, timeout=DEFAULT_TIMEOUT):
+        # Woken by the start_img response, no polling
+        if not self.img_topic_ready.wait(timeout):
+            return "The device did not announce the image topic in time"
         
         return f"The image data will be transferred over topic {self.img_topic}"
     
     def end_img_transfer(self):
         self.img_topic = None
+        self.img_topic_ready.clear()
         return "OK"
             
     def menu(self):
@@ -289,11 +431,9 @@ class DeviceCommander(Bridge):
             # Continuously subscribe to heartbeat topic in the cloud.  
             self.subscribe(self.DEVICE_HEARTBEAT)
             self.subscribe(self.COMMAND_RESPONSE)
+            self.subscribe(self.DEVICE_METRICS)
             
-            self.client.message_callback_add(self.DEVICE_HEARTBEAT, self.on_message)
-            self.client.message_callback_add(self.COMMAND_RESPONSE, self.on_message)
-            
-            self.client.loop_start()
+            self.loop_start()
             
             self.last_heartbeat_time = time.time()
             self.heartbeat_thread = threading.Thread(target=self.check_heartbeat, daemon=True)
@@ -315,6 +455,7 @@ class DeviceCommander(Bridge):
                 {"name": "Start Point Cloud Transfer", "value": 3},
                 {"name": "End Point Cloud Transfer", "value": 4},
                 {"name": "Obtain one Image", "value": 5},
+                {"name": "Show Metrics", "value": 6},
                 {"name": "Exit", "value": 0}
             ]
                 
@@ -343,14 +484,14 @@ class DeviceCommander(Bridge):
                     
                 elif choice == "3":
                     # self.subscribe(self.DATA_TOPISCS["point_cloud"])
-                    self.publish(self.COMMAND, "start_point_cloud_transfer")
+                    self.start_pc_transfer()
                     print("Point cloud transfer starts. ")
                     # self.stop_check_heartbeat()
                     last_command_result = self.wait_for_pc_topic()
                     
                 elif choice == "4":
                     # self.subscribe(self.DATA_TOPISCS["image"])
-                    self.publish(self.COMMAND, "end_point_cloud_transfer")
+                    self.send_command("end_point_cloud_transfer")
                     print("Point cloud transfer ends. ")
                     # self.restart_check_heartbeat()
                     time.sleep(1)
@@ -358,7 +499,7 @@ class DeviceCommander(Bridge):
                     
                 elif choice == "5":
                     # self.unsubscribe(self.DATA_TOPISCS["point_cloud"])
-                    self.publish(self.COMMAND, "start_image_transfer")
+                    self.start_img_transfer()
                     print("Image transfer starts. ")
                     self.stop_check_heartbeat()
                     last_command_result = self.wait_for_img_topic()
@@ -367,6 +508,9 @@ class DeviceCommander(Bridge):
                     last_command_result = self.end_img_transfer()
                     time.sleep(1) 
                     
+                elif choice == "6":
+                    last_command_result = json.dumps(self.metrics_report(), indent=2)
+                    
                 else:
                     last_command_result = "Invalid choice. Please try again."
              
@@ -378,7 +522,7 @@ class DeviceCommander(Bridge):
                 time.sleep(0.1)
                 
         
-        self.client.loop_stop()
+        self.loop_stop()
     
     # Define the function to initiate data transfer
     def start_data_transfer(self, data):
@@ -0,0 +1,572 @@
+#!/usr/bin/env python
+'''
+Manage a fleet of Vibots from one host.
+
+Each Vibot of the fleet runs with its own device id (config.DEVICE.ID on
+the device), so its topics are namespaced, see topics.py. FleetManager
+subscribes once per kind of topic with a wildcard on the device level,
+whatever the number of devices:
+
+    /fleet/+/iot_device/heartbeat
+    /fleet/+/iot_device/command_response
+    /fleet/+/iot_device/status_response
+    /fleet/+/iot_device/metrics
+    /fleet/+/data/#
+
+Every message is routed to the DeviceState of the device named in its
+topic, which is created the first time a device is heard of. A DeviceState
+holds the heartbeat, VIO and stream state of its device, and the decoding
+state of its point cloud and image streams. All the devices share one MQTT
+connection and its network thread. The network thread only routes the data
+messages to a fixed pool of decode workers, which reassemble and decode
+them and run the processing hooks. The devices are spread over the workers
+by id, so the frames of a device stay in order, and a slow decode does not
+hold up the heartbeats and command responses of the fleet. The stream
+resets of a new transfer are applied on the network thread under the lock
+of the device, never through those queues, which drop data when full. By
+default every device records its point clouds through its own
+PointCloudWriter, in a subfolder of recordings/fleet named after its id.
+A single monitor thread sweeps the heartbeats of the whole fleet.
+
+    python fleet_manager.py --host localhost --interval 5
+'''
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+from bridge import Bridge
+import commands
+import image_codec
+import metrics
+import point_cloud_codec as pc_codec
+import point_cloud_delta as pc_delta
+from point_cloud_writer import PointCloudWriter
+from recording import RecordingWriter
+from sender import SenderQueue
+import topics
+
+
+class DeviceState:
+    """
+    The state of one device of the fleet, and the decoding state of its streams
+    """
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.first_seen = time.time()
+        self.last_heartbeat_time = None
+        self.online = False
+        self.vio_enabled = False
+        self.pc_streaming = False
+        self.img_streaming = False
+        self.filter_stats = None
+        # Commands sent with request, waiting for their response
+        self.pending = commands.PendingRequests()
+        # Decoding state of the streams, as in PointCloudProcessor and ImageProcessor.
+        # The decode worker holds the lock while decoding, the network thread while resetting it for a new transfer.
+        self.decode_lock = threading.Lock()
+        self.codec = pc_codec.create_codec("raw")
+        self.frame_assembler = pc_codec.FrameAssembler()
+        self.delta_decoder = pc_delta.DeltaDecoder()
+        self.image_assembler = image_codec.ImageAssembler()
+        self.last_keyframe_request = 0.0
+        self.last_seq = None
+        self.num_point_clouds_received = 0
+        self.num_frames_skipped = 0
+        self.num_images_received = 0
+        # Records the point clouds of the device, created by its decode worker on the first one
+        self.writer = None
+
+    def start_point_clouds(self, codec):
+        """
+        Reset the point cloud decoding for a new transfer
+        :param codec: The codec name announced in the start_pc response
+        """
+        self.codec = pc_codec.create_codec(codec)
+        self.frame_assembler.reset()
+        self.delta_decoder = pc_delta.DeltaDecoder()
+        self.last_seq = None
+
+    def start_images(self):
+        """
+        Reset the image reassembly for a new transfer
+        """
+        self.image_assembler.reset()
+
+    def track_sequence(self, seq):
+        if self.last_seq is not None:
+            gap = (seq - self.last_seq - 1) & 0xFFFFFFFF
+            # A huge gap means the sequence went backwards, e.g. the device restarted
+            if gap < 0x80000000:
+                self.num_frames_skipped += gap
+        self.last_seq = seq
+
+    def summary(self):
+        """
+        :return: A JSON-serializable dictionary of the state of the device
+        """
+        return {
+            "online": self.online,
+            "last_heartbeat_age": (
+                time.time() - self.last_heartbeat_time if self.last_heartbeat_time is not None else None
+            ),
+            "vio_enabled": self.vio_enabled,
+            "pc_streaming": self.pc_streaming,
+            "img_streaming": self.img_streaming,
+            "codec": self.codec.name,
+            "point_clouds": self.num_point_clouds_received,
+            "skipped": self.num_frames_skipped,
+            "images": self.num_images_received,
+            "writer": self.writer.stats() if self.writer is not None else None,
+        }
+
+
+class FleetManager(Bridge):
+    """
+    Follow and command many devices through one connection and a few wildcard subscriptions
+    """
+    DEFAULT_HEARTBEAT_TIMEOUT = 60.0
+    DEFAULT_BINARY_COMMANDS = False
+    # Seconds between two sweeps of the heartbeats of the fleet
+    MONITOR_INTERVAL = 1.0
+    KEYFRAME_REQUEST_INTERVAL = 1.0
+    # Threads decoding the data streams of the fleet, whatever the number of devices
+    DEFAULT_DECODE_WORKERS = 4
+    # Data messages waiting for each worker, see sender.SenderQueue for the overflow policies
+    DEFAULT_DECODE_QUEUE_SIZE = 256
+    DEFAULT_DECODE_OVERFLOW_POLICY = "drop_oldest"
+    # Each device records its point clouds in a subfolder named after its id, as PointCloudProcessor does
+    DEFAULT_RECORDING_FOLDER = "recordings/fleet"
+
+    def __init__(self, client_id="fleet_manager", user_id="", password="", host="localhost", port=1883,
+                 keepalive=60, qos=0, heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT,
+                 binary_commands=DEFAULT_BINARY_COMMANDS, device_ids=(), connection=None,
+                 decode_workers=DEFAULT_DECODE_WORKERS, decode_queue_size=DEFAULT_DECODE_QUEUE_SIZE,
+                 decode_overflow_policy=DEFAULT_DECODE_OVERFLOW_POLICY, recording_folder=DEFAULT_RECORDING_FOLDER):
+        """
+        :param heartbeat_timeout: Seconds without a heartbeat before a device is considered offline
+        :param binary_commands: Send the commands in the compact binary encoding
+        :param device_ids: The ids of the devices known in advance, the others are added when first heard of
+        :param decode_workers: The number of threads decoding the point clouds and images of the fleet
+        :param decode_queue_size: The maximum number of data messages waiting for each worker
+        :param decode_overflow_policy: One of SenderQueue.OVERFLOW_POLICIES
+        :param recording_folder: The folder of the point cloud recordings of the devices, None to record nothing
+        """
+        # Validate user inputs
+        if heartbeat_timeout <= 0:
+            raise ValueError("Heartbeat timeout must be positive")
+        if decode_workers <= 0:
+            raise ValueError("Number of decode workers must be a positive integer")
+        for device_id in device_ids:
+            topics.validate_device_id(device_id)
+
+        self.heartbeat_timeout = heartbeat_timeout
+        self.binary_commands = binary_commands
+        self.recording_folder = recording_folder
+        self.devices = {}
+        self._lock = threading.Lock()
+        for device_id in device_ids:
+            self.devices[device_id] = DeviceState(device_id)
+
+        # One subscription per kind of topic for the whole fleet, the device is found from the topic
+        self.filters = [
+            topics.fleet_filter(topics.HEARTBEAT),
+            topics.fleet_filter(topics.COMMAND_RESPONSE),
+            topics.fleet_filter(topics.STATUS_RESPONSE),
+            topics.fleet_filter(topics.METRICS),
+            topics.fleet_filter("/data/#"),
+        ]
+        # Messages are dispatched by topic without the device level, then command responses by type
+        self.topic_handlers = {
+            topics.HEARTBEAT: self.on_heartbeat,
+            topics.COMMAND_RESPONSE: self.on_command_response,
+            topics.STATUS_RESPONSE: self.on_status_response,
+            topics.METRICS: self.on_metrics,
+            topics.POINT_CLOUD: self.on_point_cloud,
+            topics.IMAGE: self.on_image,
+        }
+        self.response_handlers = {
+            "enable_vio": self.on_enable_vio,
+            "disable_vio": self.on_disable_vio,
+            "start_pc": self.on_start_pc,
+            "end_pc": self.on_end_pc,
+            "start_img": self.on_start_img,
+            "end_img": self.on_end_img,
+            "filters": self.on_filters,
+            "filter_stats": self.on_filter_stats,
+        }
+        # Latest metrics snapshot of each device
+        self.metrics = metrics.MetricsAggregator()
+        self.messages_received = metrics.REGISTRY.counter(f"{client_id}.messages_received")
+        self.devices_online = metrics.REGISTRY.gauge(f"{client_id}.devices_online")
+        self.decode_queue_depth = metrics.REGISTRY.gauge(f"{client_id}.decode_queue_depth")
+        self.decode_dropped = metrics.REGISTRY.gauge(f"{client_id}.decode_dropped")
+
+        # The network thread only routes the data messages, the workers decode them.
+        # Each device is bound to one worker, so its frames stay in order.
+        self.decoders = [
+            SenderQueue(self._decode, decode_queue_size, decode_overflow_policy, name=f"fleet_decoder_{index}")
+            for index in range(decode_workers)
+        ]
+
+        self._monitor = None
+        self._monitor_stop = threading.Event()
+
+        super().__init__(topics.FLEET_PREFIX, client_id, user_id, password, host, port, keepalive, qos,
+                         connection=connection)
+
+    def on_connect(self, client, userdata, flags, rc):
+        logging.info(f"Fleet manager connected to MQTT broker with result code {str(rc)}")
+        for topic_filter in self.filters:
+            self.subscribe(topic_filter, self.qos)
+        self.timeout = 0
+
+    def device(self, device_id):
+        """
+        :return: The DeviceState of a device, created if it was not known yet
+        """
+        state = self.devices.get(device_id)
+        if state is None:
+            with self._lock:
+                state = self.devices.get(device_id)
+                if state is None:
+                    state = DeviceState(device_id)
+                    self.devices[device_id] = state
+                    logging.info(f"Device {device_id} joined the fleet")
+        return state
+
+    def forget(self, device_id):
+        """
+        Drop the state of a device, e.g. one retired from the fleet
+        """
+        with self._lock:
+            self.devices.pop(device_id, None)
+
+    def msg_process(self, msg):
+        device_id, topic = topics.split_device_topic(msg.topic)
+        handler = self.topic_handlers.get(topic)
+        if device_id is None or handler is None:
+            logging.warning(f"Fleet manager received a message from the unexpected topic {msg.topic}")
+            return
+        self.messages_received.inc()
+        if topic in (topics.POINT_CLOUD, topics.IMAGE):
+            self.dispatch(self.device(device_id), handler, msg)
+        else:
+            handler(self.device(device_id), msg)
+
+    def dispatch(self, device, func, *args):
+        """
+        Run func(device, *args) on the decode worker of a device, after the work queued before for it.
+        For data messages only: the queue drops them when full, see DEFAULT_DECODE_OVERFLOW_POLICY.
+        """
+        decoder = self.decoders[zlib.crc32(device.device_id.encode()) % len(self.decoders)]
+        if not decoder.put((func, device, args)):
+            logging.debug(f"Decode queue is full, dropped a message of device {device.device_id}")
+        self.decode_queue_depth.set(sum(decoder.depth for decoder in self.decoders))
+        self.decode_dropped.set(sum(decoder.num_dropped for decoder in self.decoders))
+
+    def _decode(self, item):
+        func, device, args = item
+        with device.decode_lock:
+            func(device, *args)
+
+    def stop_decoders(self, timeout=None):
+        """
+        Stop the decode workers once the queued messages are processed, then the writers of the devices
+        :param timeout: The maximum number of seconds to wait for each thread
+        """
+        for decoder in self.decoders:
+            decoder.stop(timeout)
+        for device in list(self.devices.values()):
+            if device.writer is not None:
+                device.writer.stop(timeout)
+
+    def writer(self, device):
+        """
+        :return: The PointCloudWriter of a device, created on its first point cloud. Called on its decode worker.
+        """
+        if device.writer is None:
+            # Recorded frames keep a device name of at most 16 bytes, the folder keeps the whole id
+            name = device.device_id.encode()[:16].decode(errors="ignore")
+            recorder = RecordingWriter(os.path.join(self.recording_folder, device.device_id), name)
+            device.writer = PointCloudWriter(recorder=recorder)
+        return device.writer
+
+    # Commands
+
+    def send_command(self, device_id, name, **params):
+        """
+        Publish a command to one device
+        :param name: The command name, e.g. "start_point_cloud_transfer"
+        :param params: The parameters of the command
+        """
+        self.publish(
+            topics.device_topic(topics.COMMAND, device_id),
+            commands.encode_command(name, params, binary=self.binary_commands)
+        )
+
+    def request(self, device_id, name, **params):
+        """
+        Publish a command with a correlation id to one device, without waiting for its response
+        :return: A concurrent.futures.Future completed with the response Command. Cancel it to stop waiting.
+        """
+        device = self.device(device_id)
+        correlation_id, future = device.pending.create(commands.RESPONSE_TYPES[name])
+        future.add_done_callback(lambda _: device.pending.discard(correlation_id))
+        self.send_command(device_id, name, **params, **{commands.CORRELATION_KEY: correlation_id})
+        return future
+
+    def broadcast(self, name, online_only=True, **params):
+        """
+        Publish a command to every device of the fleet
+        :param online_only: Skip the devices whose heartbeat timed out
+        :return: The ids of the devices the command was sent to
+        """
+        device_ids = [state.device_id for state in list(self.devices.values()) if state.online or not online_only]
+        for device_id in device_ids:
+            self.send_command(device_id, name, **params)
+        return device_ids
+
+    def status_check(self, device_id):
+        """
+        Ask a device to answer on its status response topic, see on_status_response
+        """
+        self.publish(topics.device_topic(topics.STATUS_CHECK, device_id), "status_check", qos=2)
+
+    def on_command_response(self, device, msg):
+        try:
+            response = commands.decode_command(msg.payload, "type")
+        except (ValueError, UnicodeDecodeError) as e:
+            logging.warning(f"Invalid command response from device {device.device_id}: {e}")
+            return
+        handler = self.response_handlers.get(response.name)
+        if handler is None:
+            logging.warning(f"Unexpected response {response.name} from device {device.device_id}")
+        elif response.params.get("code") != 200 and response.name != "filters":
+            logging.warning(
+                f"Device {device.device_id} answered {response.name} with code {response.params.get('code')}"
+            )
+        else:
+            handler(device, response)
+        # The state is updated first, a caller woken by its response sees it updated
+        device.pending.resolve(response)
+
+    def on_enable_vio(self, device, response):
+        device.vio_enabled = True
+
+    def on_disable_vio(self, device, response):
+        device.vio_enabled = False
+
+    def on_start_pc(self, device, response):
+        device.pc_streaming = True
+        # Devices predating the codec negotiation send raw frames or legacy hex.
+        # Reset right here rather than through the decode queue, which may drop what it holds.
+        # The frames of the new transfer come after the response, they are decoded with the new state.
+        with device.decode_lock:
+            device.start_point_clouds(response.params.get("codec", "raw"))
+
+    def on_end_pc(self, device, response):
+        device.pc_streaming = False
+
+    def on_start_img(self, device, response):
+        device.img_streaming = True
+        with device.decode_lock:
+            device.start_images()
+
+    def on_end_img(self, device, response):
+        device.img_streaming = False
+
+    def on_filters(self, device, response):
+        if response.params.get("code") == 200:
+            logging.info(f"Device {device.device_id} point cloud filters updated")
+        else:
+            logging.warning(
+                f"Device {device.device_id} rejected the point cloud filters: {response.params.get('error')}"
+            )
+
+    def on_filter_stats(self, device, response):
+        device.filter_stats = response.params["stats"]
+
+    # Heartbeats and status
+
+    def on_heartbeat(self, device, msg):
+        device.last_heartbeat_time = time.time()
+        if not device.online:
+            device.online = True
+            self.on_device_online(device)
+
+    def on_status_response(self, device, msg):
+        logging.info(f"Device {device.device_id} answered the status check")
+
+    def on_metrics(self, device, msg):
+        try:
+            self.metrics.add(device.device_id, json.loads(msg.payload))
+        except ValueError as e:
+            logging.warning(f"Invalid metrics snapshot from device {device.device_id}: {e}")
+
+    def on_device_online(self, device):
+        """
+        Called when a device sends a heartbeat again, or for the first time
+        """
+        logging.info(f"Device {device.device_id} is online")
+
+    def on_device_offline(self, device):
+        """
+        Called from the monitor thread when the heartbeat of a device timed out
+        """
+        logging.warning(f"Heartbeat of device {device.device_id} timed out")
+
+    def check_heartbeats(self, now=None):
+        """
+        Mark the devices whose heartbeat timed out as offline
+        :return: The number of devices online
+        """
+        if now is None:
+            now = time.time()
+        online = 0
+        for device in list(self.devices.values()):
+            if device.online and now - device.last_heartbeat_time > self.heartbeat_timeout:
+                device.online = False
+                self.on_device_offline(device)
+            online += device.online
+        self.devices_online.set(online)
+        return online
+
+    def start_monitor(self):
+        """
+        Sweep the heartbeats of the fleet from one daemon thread, whatever the number of devices
+        """
+        if self._monitor is None:
+            self._monitor_stop.clear()
+            self._monitor = threading.Thread(target=self._run_monitor, name="fleet_monitor", daemon=True)
+            self._monitor.start()
+
+    def stop_monitor(self):
+        if self._monitor is not None:
+            self._monitor_stop.set()
+            self._monitor.join()
+            self._monitor = None
+
+    def _run_monitor(self):
+        while not self._monitor_stop.wait(self.MONITOR_INTERVAL):
+            try:
+                self.check_heartbeats()
+            except Exception as e:
+                logging.error(f"Error occurs when checking the heartbeats of the fleet: {e}")
+
+    def fleet_status(self):
+        """
+        :return: A dictionary of the summary of each device by id
+        """
+        return {device_id: device.summary() for device_id, device in list(self.devices.items())}
+
+    # Data streams
+
+    def on_point_cloud(self, device, msg):
+        try:
+            payload = msg.payload
+            if pc_codec.is_chunk(payload):
+                payload = device.frame_assembler.add(payload)
+                if payload is None:
+                    # Wait for the remaining chunks of the frame
+                    return
+            if pc_delta.is_delta_frame(payload):
+                header, points = device.delta_decoder.decode(payload)
+                if points is None:
+                    self.request_keyframe(device)
+                    return
+            else:
+                header, points = pc_codec.decode_points(payload, device.codec)
+            device.num_point_clouds_received += 1
+            if header is not None:
+                device.track_sequence(header.seq)
+            self.point_cloud_process(device, header, points)
+        except Exception as e:
+            logging.error(f"Error occurs when processing a point cloud of device {device.device_id}: {e}")
+
+    def on_image(self, device, msg):
+        try:
+            image = device.image_assembler.add(msg.payload)
+            if image is not None:
+                device.num_images_received += 1
+                self.image_process(device, image.header, image.to_array())
+        except Exception as e:
+            logging.error(f"Error occurs when processing an image of device {device.device_id}: {e}")
+
+    def request_keyframe(self, device):
+        """
+        Ask a device for a new keyframe after the reference of its delta frames was lost
+        """
+        now = time.monotonic()
+        if now - device.last_keyframe_request >= self.KEYFRAME_REQUEST_INTERVAL:
+            device.last_keyframe_request = now
+            logging.info(f"Lost the point cloud keyframe of device {device.device_id}, requesting a new one")
+            self.send_command(device.device_id, "request_keyframe")
+
+    def point_cloud_process(self, device, header, points):
+        """
+        Process a decoded point cloud, called on the decode worker of the device, in the order of its frames
+        :param device: The DeviceState of the device it came from
+        :param header: The frame header, None for legacy hex frames
+        :param points: An (N, 3) float32 array
+        """
+        # Recorded by the writer thread of the device, override to process the point clouds otherwise
+        if self.recording_folder is None:
+            return
+        writer = self.writer(device)
+        if header is None:
+            queued = writer.put(points)
+        else:
+            queued = writer.put(points, header.seq, header.stamp_secs, header.stamp_nsecs)
+        if not queued:
+            logging.debug(f"Point cloud writer of device {device.device_id} is behind, dropped a point cloud")
+
+    def image_process(self, device, header, image_array):
+        """
+        Process a reassembled image, called on the decode worker of the device, in the order of its images
+        :param device: The DeviceState of the device it came from
+        :param header: The image packet header with the image metadata
+        :param image_array: A NumPy view of the image data
+        """
+        # TODO: you can inherit this class and focus on coding in this method
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Follow the heartbeat and streams of a fleet of Vibots")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--devices", nargs="*", default=[], help="The ids of the devices known in advance")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between two status reports")
+    parser.add_argument("--heartbeat-timeout", type=float, default=FleetManager.DEFAULT_HEARTBEAT_TIMEOUT)
+    parser.add_argument("--recording-folder", default=FleetManager.DEFAULT_RECORDING_FOLDER,
+                        help="Each device records its point clouds in a subfolder named after its id")
+    parser.add_argument("--no-recording", action="store_true", help="Do not record the point clouds")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    manager = FleetManager(host=args.host, port=args.port, heartbeat_timeout=args.heartbeat_timeout,
+                           device_ids=args.devices,
+                           recording_folder=None if args.no_recording else args.recording_folder)
+    manager.loop_start()
+    manager.start_monitor()
+    try:
+        while True:
+            time.sleep(args.interval)
+            print(json.dumps(manager.fleet_status(), indent=2))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.stop_monitor()
+        manager.loop_stop()
+        manager.disconnect()
+        manager.stop_decoders()
+
+
+if __name__ == "__main__":
+    main()
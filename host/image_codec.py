@@ -0,0 +1,331 @@
+'''
+Packet format of the images transferred from the device to the host.
+
+An image is split into packets, each carrying a fixed-size little-endian
+header in front of a slice of the image data:
+
+    magic | version | compression | is_bigendian | image id | packet index | packet count | image size
+          | offset | width | height | step | stamp secs | stamp nsecs | encoding | slice ...
+
+The image data may be compressed as PNG or JPEG before it is split, in
+which case image size is the size of the compressed data while width,
+height, encoding and step still describe the original image.
+
+Every packet repeats the image metadata, so the host can allocate the image
+buffer from whichever packet arrives first and write each slice at its
+offset. ImageAssembler tolerates reordering and duplicates and evicts stale
+partial images.
+
+This module is shared by the device and the host, keep both copies identical.
+'''
+
+import struct
+import time
+from collections import OrderedDict, namedtuple
+
+import cv2
+import numpy as np
+
+PACKET_MAGIC = b"VIMG"
+PACKET_VERSION = 1
+
+# magic, version, compression, is_bigendian, pad, image id, packet index, packet count, image size,
+# offset, width, height, step, stamp secs, stamp nsecs, encoding
+PACKET_HEADER = struct.Struct("<4sBBBxIIIIIIIIII16s")
+
+PacketHeader = namedtuple(
+    "PacketHeader",
+    ["image_id", "packet_index", "packet_count", "image_size", "offset",
+     "width", "height", "step", "stamp_secs", "stamp_nsecs", "encoding", "is_bigendian", "compression"]
+)
+
+# Compression of the image data, mapped to the id written into the packet header
+COMPRESSIONS = {"none": 0, "png": 1, "jpeg": 2}
+COMPRESSION_NAMES = {value: key for key, value in COMPRESSIONS.items()}
+DEFAULT_JPEG_QUALITY = 90
+DEFAULT_PNG_LEVEL = 3
+
+# Number of channels and NumPy dtype of the common sensor_msgs/Image encodings
+ENCODING_LAYOUTS = {
+    "mono8": (1, np.uint8),
+    "8UC1": (1, np.uint8),
+    "mono16": (1, np.uint16),
+    "16UC1": (1, np.uint16),
+    "bgr8": (3, np.uint8),
+    "rgb8": (3, np.uint8),
+    "8UC3": (3, np.uint8),
+    "bgra8": (4, np.uint8),
+    "rgba8": (4, np.uint8),
+    "8UC4": (4, np.uint8),
+    "32FC1": (1, np.float32),
+}
+
+
+def compress_image(data, width, height, encoding, step, compression, quality=None):
+    """
+    Compress the image data before it is split into packets
+    :param data: A bytes-like object holding the image data
+    :param compression: "none", "png" (lossless) or "jpeg" (lossy)
+    :param quality: The JPEG quality (0-100) or the PNG compression level (0-9). Optional.
+    :return: A (compression, data) tuple. Encodings PNG or JPEG cannot represent fall back to "none".
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Compression must be one of {tuple(COMPRESSIONS)}")
+    if compression == "none" or encoding not in ENCODING_LAYOUTS:
+        return "none", data
+    channels, dtype = ENCODING_LAYOUTS[encoding]
+    if dtype is np.float32 or (compression == "jpeg" and (dtype is not np.uint8 or channels == 4)):
+        return "none", data
+
+    pixels = image_to_array(data, width, height, encoding, step)
+    if compression == "png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, DEFAULT_PNG_LEVEL if quality is None else quality]
+        ok, encoded = cv2.imencode(".png", pixels, params)
+    else:
+        params = [cv2.IMWRITE_JPEG_QUALITY, DEFAULT_JPEG_QUALITY if quality is None else quality]
+        ok, encoded = cv2.imencode(".jpg", pixels, params)
+    if not ok:
+        raise ValueError(f"Failed to compress a {encoding} image as {compression}")
+    return compression, encoded
+
+
+def decompress_image(data, compression):
+    """
+    Decompress PNG or JPEG image data back into pixels
+    :return: A (height, width, channels) array
+    """
+    pixels = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if pixels is None:
+        raise ValueError(f"Failed to decompress {compression} image data")
+    return pixels.reshape(pixels.shape[0], pixels.shape[1], -1)
+
+
+def split_image(data, image_id, packet_size, width, height, encoding, step,
+                is_bigendian=0, stamp_secs=0, stamp_nsecs=0, compression="none"):
+    """
+    Split the image data into packets
+    :param data: A bytes-like object holding the image data
+    :param image_id: The id shared by all the packets of the image
+    :param packet_size: The number of image bytes carried by each packet, header excluded
+    :param width: The width of the image in pixels
+    :param height: The height of the image in pixels
+    :param encoding: The sensor_msgs/Image encoding, e.g. "bgr8"
+    :param step: The length of an image row in bytes
+    :param compression: The compression already applied to the data by compress_image
+    :return: A list of bytearrays to publish
+    """
+    if packet_size <= 0:
+        raise ValueError("Packet size must be a positive integer")
+    encoded_name = encoding.encode()
+    if len(encoded_name) > 16:
+        raise ValueError(f"Image encoding {encoding} is longer than 16 bytes")
+
+    view = memoryview(data).cast("B")
+    packet_count = max(1, (len(view) + packet_size - 1) // packet_size)
+    packets = []
+    for index in range(packet_count):
+        offset = index * packet_size
+        piece = view[offset:offset + packet_size]
+        packet = bytearray(PACKET_HEADER.size + len(piece))
+        PACKET_HEADER.pack_into(
+            packet, 0, PACKET_MAGIC, PACKET_VERSION, COMPRESSIONS[compression], is_bigendian,
+            image_id & 0xFFFFFFFF, index, packet_count, len(view), offset,
+            width, height, step, stamp_secs, stamp_nsecs, encoded_name
+        )
+        memoryview(packet)[PACKET_HEADER.size:] = piece
+        packets.append(packet)
+    return packets
+
+
+def decode_packet_header(buffer):
+    """
+    Parse the header at the start of an image packet
+    :return: A PacketHeader tuple
+    """
+    if len(buffer) < PACKET_HEADER.size:
+        raise ValueError("Buffer is too short to hold an image packet header")
+    (magic, version, compression, is_bigendian, image_id, packet_index, packet_count, image_size, offset,
+     width, height, step, secs, nsecs, encoding) = PACKET_HEADER.unpack_from(buffer, 0)
+    if magic != PACKET_MAGIC:
+        raise ValueError("Buffer does not start with the image packet magic")
+    if version != PACKET_VERSION:
+        raise ValueError(f"Unsupported image packet version {version}")
+    if compression not in COMPRESSION_NAMES:
+        raise ValueError(f"Unsupported image compression {compression}")
+    if packet_index >= packet_count:
+        raise ValueError(f"Packet index {packet_index} is out of range of {packet_count} packets")
+    # Every packet but the only one of an empty image carries at least one byte, a larger count is corrupt
+    if packet_count > max(1, image_size):
+        raise ValueError(f"Packet count {packet_count} exceeds the {image_size} byte image size")
+    if offset + len(buffer) - PACKET_HEADER.size > image_size:
+        raise ValueError("Packet slice runs past the end of the image")
+    return PacketHeader(
+        image_id, packet_index, packet_count, image_size, offset, width, height, step,
+        secs, nsecs, encoding.rstrip(b"\0").decode(), is_bigendian, COMPRESSION_NAMES[compression]
+    )
+
+
+def image_to_array(data, width, height, encoding, step):
+    """
+    View the image data as a NumPy array without copying
+    :return: A (height, width, channels) array for known encodings, otherwise a (height, step) uint8 array
+    """
+    if encoding not in ENCODING_LAYOUTS:
+        return np.frombuffer(data, dtype=np.uint8, count=height * step).reshape(height, step)
+    channels, dtype = ENCODING_LAYOUTS[encoding]
+    itemsize = np.dtype(dtype).itemsize
+    rows = np.frombuffer(data, dtype=np.uint8, count=height * step).reshape(height, step)
+    # Drop the row padding, if any, and reinterpret the pixels in place
+    pixels = rows[:, :width * channels * itemsize].view(dtype)
+    return pixels.reshape(height, width, channels)
+
+
+class CompletedImage(namedtuple("CompletedImage", ["header", "data"])):
+    """
+    A reassembled image: the header of its packets and the image data
+    """
+
+    def to_array(self):
+        """
+        The image as a NumPy array, a view of the data unless the image was compressed
+        """
+        if self.header.compression != "none":
+            return decompress_image(self.data, self.header.compression)
+        return image_to_array(
+            self.data, self.header.width, self.header.height, self.header.encoding, self.header.step
+        )
+
+
+class _PartialImage:
+    """
+    An image being reassembled: the preallocated image buffer and the packets written into it
+    """
+    __slots__ = ("header", "buffer", "received", "num_received", "deadline")
+
+    def __init__(self, header, deadline):
+        self.header = header
+        self.buffer = bytearray(header.image_size)
+        self.received = bytearray(header.packet_count)
+        self.num_received = 0
+        self.deadline = deadline
+
+    @property
+    def footprint(self):
+        """
+        The bytes held by the image buffer and the packet bitmap
+        """
+        return len(self.buffer) + len(self.received)
+
+
+class ImageAssembler:
+    """
+    Reassemble the packets produced by split_image into whole images.
+    Packets may arrive in any order and duplicates are ignored. Incomplete images are evicted
+    when their deadline expires or when the partial images exceed the memory cap, oldest first.
+    A completed image id is only remembered for the timeout, so the ids restarting at 0 after
+    the device restarted are not taken for duplicates.
+    """
+    DEFAULT_TIMEOUT = 10.0
+    DEFAULT_MAX_PENDING_BYTES = 64 * 1024 * 1024
+    # Number of completed image ids remembered to drop their late duplicate packets
+    COMPLETED_HISTORY = 64
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_pending_bytes=DEFAULT_MAX_PENDING_BYTES):
+        """
+        :param timeout: Seconds after its first packet before an incomplete image is evicted
+        :param max_pending_bytes: The upper bound of memory held by incomplete images
+        """
+        if timeout <= 0:
+            raise ValueError("Timeout must be positive")
+        if max_pending_bytes <= 0:
+            raise ValueError("Maximum pending bytes must be positive")
+
+        self.timeout = timeout
+        self.max_pending_bytes = max_pending_bytes
+        self._pending = OrderedDict()
+        self._completed = OrderedDict()
+        self.pending_bytes = 0
+        self.num_images_completed = 0
+        self.num_images_evicted = 0
+        self.num_packets_dropped = 0
+
+    def add(self, packet, now=None):
+        """
+        Write a packet into its image buffer
+        :param packet: A bytes-like object holding one packet
+        :param now: The current monotonic time. Optional, defaults to time.monotonic().
+        :return: A CompletedImage, or None while packets are missing
+        """
+        if now is None:
+            now = time.monotonic()
+        header = decode_packet_header(packet)
+        self.evict_expired(now)
+        layout = (header.packet_count, header.image_size)
+
+        partial = self._pending.get(header.image_id)
+        if partial is None and header.image_id in self._completed:
+            if self._completed[header.image_id][0] == layout:
+                self.num_packets_dropped += 1
+                return None
+            del self._completed[header.image_id]
+        if partial is not None and (partial.header.packet_count, partial.header.image_size) != layout:
+            # The image id has been reused, e.g. after the device restarted
+            self._evict(header.image_id)
+            partial = None
+
+        if partial is None:
+            footprint = header.image_size + header.packet_count
+            if footprint > self.max_pending_bytes:
+                self.num_packets_dropped += 1
+                return None
+            while self._pending and self.pending_bytes + footprint > self.max_pending_bytes:
+                self._evict(next(iter(self._pending)))
+            partial = _PartialImage(header, now + self.timeout)
+            self._pending[header.image_id] = partial
+            self.pending_bytes += footprint
+
+        if partial.received[header.packet_index]:
+            self.num_packets_dropped += 1
+            return None
+        piece = memoryview(packet)[PACKET_HEADER.size:]
+        partial.buffer[header.offset:header.offset + len(piece)] = piece
+        partial.received[header.packet_index] = 1
+        partial.num_received += 1
+
+        if partial.num_received < header.packet_count:
+            return None
+        del self._pending[header.image_id]
+        self.pending_bytes -= partial.footprint
+        self.num_images_completed += 1
+        self._completed[header.image_id] = (layout, now + self.timeout)
+        if len(self._completed) > self.COMPLETED_HISTORY:
+            self._completed.popitem(last=False)
+        return CompletedImage(partial.header, partial.buffer)
+
+    def evict_expired(self, now=None):
+        """
+        Drop the incomplete images whose deadline has expired, and forget the completed ids as old
+        """
+        if now is None:
+            now = time.monotonic()
+        # Images are kept in arrival order of their first packet, so the oldest deadline comes first
+        while self._pending:
+            image_id, partial = next(iter(self._pending.items()))
+            if partial.deadline > now:
+                break
+            self._evict(image_id)
+        while self._completed and next(iter(self._completed.values()))[1] <= now:
+            self._completed.popitem(last=False)
+
+    def reset(self):
+        """
+        Drop the incomplete images and forget the completed ids, e.g. when a new transfer starts
+        """
+        while self._pending:
+            self._evict(next(iter(self._pending)))
+        self._completed.clear()
+
+    def _evict(self, image_id):
+        partial = self._pending.pop(image_id)
+        self.pending_bytes -= partial.footprint
+        self.num_images_evicted += 1
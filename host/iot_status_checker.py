@@ -1,14 +1,17 @@
 import paho.mqtt.client as mqtt
+import threading
 import time
 import config as CONFIG
 from bridge import Bridge
+import topics
 
 # Define a class to check the status of the IoT device
 # Once unconnected or started, try to estblish three-way handshake
 class StatusChecker(Bridge):
     def __init__(self, client_id = "client", 
                  user_id="", password="", 
-                 host="localhost", port=1883, keepalive=60, qos=0): 
+                 host="localhost", port=1883, keepalive=60, qos=0, connection=None,
+                 device_id=None): 
         
         # status check is composed of heartbeat check and response check. 
         # status_code is used for checking if the host can connect to the device through
@@ -17,14 +20,17 @@ class StatusChecker(Bridge):
         # 0 for not connected, 1 for connected, 2 for bug
         self.status = {'heartbeat': False, 'response_received': False}
         self.status_code = 0 
+        # Set by the network thread when each step completes, the checks wait on them instead of polling
+        self.heartbeat_received = threading.Event()
+        self.response_received = threading.Event()
         
-        # constants for brokers
-        self.DEVICE_HEARTBEAT = "/iot_device/heartbeat"
-        self.STATUS_CHECK = "/iot_device/status_check"
-        self.STATUS_RESPONSE = "/iot_device/status_response"
+        # constants for brokers, namespaced by the id of the device if any
+        self.DEVICE_HEARTBEAT = topics.device_topic(topics.HEARTBEAT, device_id)
+        self.STATUS_CHECK = topics.device_topic(topics.STATUS_CHECK, device_id)
+        self.STATUS_RESPONSE = topics.device_topic(topics.STATUS_RESPONSE, device_id)
         
         super().__init__(self.DEVICE_HEARTBEAT, client_id, user_id, 
-                         password, host, port, keepalive, qos)
+                         password, host, port, keepalive, qos, connection=connection)
 
     def on_connect(self, client, userdata, flags, rc):
         
@@ -44,6 +50,7 @@ class StatusChecker(Bridge):
             print(":) The heartbeat of vibot received")
             self.unsubscribe(self.DEVICE_HEARTBEAT)
             self.subscribe(self.STATUS_RESPONSE)
+            self.heartbeat_received.set()
             # it can be replaced by passwords or others related to cryptography
             # self.publish(topic=self.STATUS_CHECK, message="status_check", qos=2)
 
@@ -53,6 +60,7 @@ class StatusChecker(Bridge):
             self.status['response_received'] = True
             print("!!!great, response received here")
             self.unsubscribe(self.STATUS_RESPONSE)
+            self.response_received.set()
 
 
     # def connect(self):
@@ -74,14 +82,11 @@ class StatusChecker(Bridge):
         # Send command to device to verify connectivity
         
         self.publish(topic=self.STATUS_CHECK, message="status_check", qos=2)
-        time.sleep(1)
 
     def check_device_status(self, timeout=20.0):
-        # Wait for timeout seconds or until a status update and command response are received
-        start_time = time.time()
-        while (time.time() - start_time) < timeout:
-            if self.status['heartbeat'] and self.status['response_received']:
-                break
+        # Wait for timeout seconds or until a status update and command response are received,
+        # woken by the response rather than spinning
+        self.response_received.wait(timeout)
 
         # Return boolean value indicating device verification status
         return self.status['heartbeat'] and self.status['response_received']
@@ -90,20 +95,11 @@ class StatusChecker(Bridge):
     def get_device_status(self, timeout=20.0):
         # Connect to MQTT broker and subscribe to topics
         self.connect()
-        self.client.message_callback_add(self.DEVICE_HEARTBEAT, self.on_message)
-        self.client.message_callback_add(self.STATUS_RESPONSE, self.on_message)
 
         # Wait for status update and send command to device
-        time_wait = time.time() + timeout   # Loop for 5 seconds
-
-
-        self.client.loop_start()
-        while time.time() < time_wait:
-        
-            if self.status['heartbeat'] == True:
-                print("heartbeat detected")
-                break
-            time.sleep(1)
+        self.loop_start()
+        if self.heartbeat_received.wait(timeout):
+            print("heartbeat detected")
 
         if self.status['heartbeat']:
             self.send_command()
@@ -113,12 +109,12 @@ class StatusChecker(Bridge):
 
             # Disconnect from MQTT broker and return device verification status
             # self.disconnect()
-            self.client.loop_stop()
+            self.loop_stop()
             print(f"status code: {self.status_code}")
             return self.status_code
                 
         else:
-            self.client.loop_stop()
+            self.loop_stop()
             print(":( Please be advised that the vibot may fail to connect to the Internet.")
             print("1. Try to rerun the Vibot and check its network. ")
             print("2. Try to rerun this program. ")
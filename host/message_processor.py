@@ -7,9 +7,14 @@ import logging
 import numpy as np
 from sensor_msgs.msg import Image
 from sensor_msgs.msg import PointCloud
-import binascii
-import datetime
-import os
+import point_cloud_codec as pc_codec
+import point_cloud_delta as pc_delta
+import image_codec
+from point_cloud_writer import PointCloudWriter
+from recording import RecordingWriter
+import metrics
+import topics
+import time
 
 class ImageProcessor(Bridge):
     # Define class constants for magic numbers
@@ -30,10 +35,18 @@ class ImageProcessor(Bridge):
             keepalive=DEFAULT_KEEPALIVE, 
             qos=DEFAULT_QOS,
             exit_on_complete=DEFAULT_EXIT_ON_COMPLETE,
-            enable_logging=DEFAULT_ENABLE_LOGGING
+            enable_logging=DEFAULT_ENABLE_LOGGING,
+            connection=None
     ):
         
-        self.received_packets = []
+        # Reassembles the packets of each image into a preallocated buffer
+        self.assembler = image_codec.ImageAssembler()
+        self.latest_image = None
+        # Stage timings, see metrics.py
+        self.messages_received = metrics.REGISTRY.counter(f"{client_id}.messages_received")
+        self.bytes_received = metrics.REGISTRY.counter(f"{client_id}.bytes_received")
+        self.receive_to_decode_time = metrics.REGISTRY.histogram(f"{client_id}.receive_to_decode_seconds")
+        self.decode_time = metrics.REGISTRY.histogram(f"{client_id}.decode_seconds")
         
         # Validate user inputs
         if packet_size <= 0:
@@ -66,7 +79,7 @@ class ImageProcessor(Bridge):
             self.logger.addHandler(file_handler)
             
         super().__init__(mqtt_topic, client_id, user_id, 
-                         password, host, port, keepalive, qos)
+                         password, host, port, keepalive, qos, connection=connection)
     
     
     def on_connect(self, client, userdata, flags, rc): 
@@ -74,7 +87,7 @@ class ImageProcessor(Bridge):
         Callback function called when the client successfully connects to the broker
         """
         self.logger.info(f"Image Processor connected to MQTT broker with result code {str(rc)}")
-        self.client.subscribe(self.mqtt_topic)
+        self.subscribe(self.mqtt_topic, self.qos)
         self.timeout = 0
         
     def start_processing(self):
@@ -82,6 +95,8 @@ class ImageProcessor(Bridge):
         Enable image processing
         """
         self.processing_enabled = True
+        # The image ids restart with the transfer, e.g. after the device restarted
+        self.assembler.reset()
         self.logger.info("Image processing started")
 
     def stop_processing(self):
@@ -91,35 +106,60 @@ class ImageProcessor(Bridge):
         self.processing_enabled = False
         self.logger.info("Image processing stopped")
         
+    def image_process(self, image_msg, image_array):
+        """
+        Process a reassembled image
+        :param image_msg: The sensor_msgs/Image message
+        :param image_array: A NumPy view of the image data, (height, width, channels) for known encodings
+        """
+        # TODO: you can inherit this class and focus on coding in this method
+        pass
+        
     def on_message(self, client, userdata, msg):
        
        # If the message is from the topic targeted for the point cloud transmission, 
        # and the processing is enabled. 
        if msg.topic == self.mqtt_topic and self.processing_enabled: 
             try:
-                self.logger.info(
+                self.logger.debug(
                     "Received packet {} with payload size {}".format(
-                        self.num_packets_received, len(msg)
+                        self.num_packets_received, len(msg.payload)
                     )
                 )
-                # Append the received packet to the list of received packets
-                self.received_packets.append(msg)
-                # If we've received all of the packets for the image, reassemble the image
-                if len(self.received_packets) == self.num_packets:
-                    # Concatenate the received packets into a single byte array
-                    byte_array = b"".join(self.received_packets)
-
+                received = time.perf_counter()
+                self.messages_received.inc()
+                self.bytes_received.inc(len(msg.payload))
+                self.num_packets_received += 1
+                # Write the packet into its image buffer, packets may arrive out of order
+                image = self.assembler.add(msg.payload)
+                # If we've received all of the packets for the image, the assembler returns it
+                if image is not None:
+                    header = image.header
+                    # Compressed images are decoded here, the others are a view of the reassembled buffer
+                    start = time.perf_counter()
+                    image_array = image.to_array()
+                    self.decode_time.observe(time.perf_counter() - start)
+                    self.receive_to_decode_time.observe(time.perf_counter() - received)
+                    
                     # Create a new Image message and set its fields
                     image_msg = Image()
-                    image_msg.header.stamp = rospy.Time.now()
-                    image_msg.data = byte_array
+                    image_msg.header.stamp = rospy.Time(header.stamp_secs, header.stamp_nsecs)
+                    image_msg.height = header.height
+                    image_msg.width = header.width
+                    image_msg.encoding = header.encoding
+                    image_msg.is_bigendian = header.is_bigendian
+                    if header.compression == "none":
+                        image_msg.step = header.step
+                        image_msg.data = image.data
+                    else:
+                        image_msg.step = image_array.strides[0]
+                        image_msg.data = image_array.tobytes()
+                    self.latest_image = image_msg
                     self.logger.debug("An image is received.")
-                    # Reset the list of received packets
-                    self.received_packets = []
         
-                    self.num_packets_received = 0
-                    self.logger.info("Forwarded image {} successfully".format(self.num_image_received))
+                    self.logger.info("Received image {} successfully".format(self.num_image_received))
                     self.num_image_received += 1
+                    self.image_process(image_msg, image_array)
                     
             except TypeError as e:
                 self.logger.error("Type error occurs when processing Image: {}".format(e))
@@ -131,10 +171,21 @@ class ImageProcessor(Bridge):
 
 class PointCloudProcessor(Bridge):
     # Define class constants for magic numbers
+    # Topic the keyframe requests are sent to, and the minimum seconds between two requests
+    COMMAND_TOPIC = topics.COMMAND
+    KEYFRAME_REQUEST_INTERVAL = 1.0
     DEFAULT_QOS = 0
     DEFAULT_KEEPALIVE = 60
     DEFAULT_EXIT_ON_COMPLETE = True
     DEFAULT_ENABLE_LOGGING = True
+    # "recording" appends the point clouds to rolling segments, "ply" writes one PLY file per point cloud
+    STORAGES = ("recording", "ply")
+    DEFAULT_STORAGE = "recording"
+    DEFAULT_RECORDING_FOLDER = "recordings/point_cloud"
+    DEFAULT_DEVICE = "vibot"
+    DEFAULT_SAVE_FOLDER = PointCloudWriter.DEFAULT_FOLDER
+    DEFAULT_WRITER_QUEUE_SIZE = PointCloudWriter.DEFAULT_MAX_QUEUE_SIZE
+    DEFAULT_WRITER_OVERFLOW_POLICY = PointCloudWriter.DEFAULT_OVERFLOW_POLICY
     def __init__(
             self, 
             mqtt_topic, 
@@ -146,10 +197,46 @@ class PointCloudProcessor(Bridge):
             keepalive=DEFAULT_KEEPALIVE, 
             qos=DEFAULT_QOS,
             exit_on_complete=DEFAULT_EXIT_ON_COMPLETE,
-            enable_logging=DEFAULT_ENABLE_LOGGING
+            enable_logging=DEFAULT_ENABLE_LOGGING,
+            storage=DEFAULT_STORAGE,
+            recording_folder=DEFAULT_RECORDING_FOLDER,
+            device=DEFAULT_DEVICE,
+            save_folder=DEFAULT_SAVE_FOLDER,
+            writer_queue_size=DEFAULT_WRITER_QUEUE_SIZE,
+            writer_overflow_policy=DEFAULT_WRITER_OVERFLOW_POLICY,
+            command_topic=COMMAND_TOPIC,
+            connection=None
     ):
+        # Validate user inputs
+        if storage not in self.STORAGES:
+            raise ValueError(f"Storage must be one of {self.STORAGES}")
+        
         self.num_point_clouds_received = 0
+        # Files are written by a background thread, the network thread only queues the decoded arrays
+        recorder = RecordingWriter(recording_folder, device) if storage == "recording" else None
+        # Stage timings, see metrics.py
+        self.messages_received = metrics.REGISTRY.counter(f"{client_id}.messages_received")
+        self.bytes_received = metrics.REGISTRY.counter(f"{client_id}.bytes_received")
+        self.receive_to_decode_time = metrics.REGISTRY.histogram(f"{client_id}.receive_to_decode_seconds")
+        self.decode_time = metrics.REGISTRY.histogram(f"{client_id}.decode_seconds")
+        self.writer = PointCloudWriter(
+            save_folder, max_queue_size=writer_queue_size, overflow_policy=writer_overflow_policy,
+            recorder=recorder
+        )
+        # Replaced by the codec announced in the start_pc response
+        self.codec = pc_codec.create_codec("raw")
+        # Reassembles the frames the device splits into chunks
+        self.assembler = pc_codec.FrameAssembler()
+        # Reference state of the keyframe and delta frames
+        self.delta_decoder = pc_delta.DeltaDecoder()
+        self.last_keyframe_request = 0.0
+        self.command_topic = command_topic
         self.exit_on_complete = exit_on_complete
+        
+        # Sequence tracking, the device numbers every source point cloud, so gaps are the skipped ones
+        self.last_seq = None
+        self.num_frames_skipped = 0
+        self.first_frame_time = None
 
         # Set initial value of processing_enabled to False
         self.processing_enabled = False
@@ -173,14 +260,14 @@ class PointCloudProcessor(Bridge):
             self.logger.addHandler(file_handler)
             
         super().__init__(mqtt_topic, client_id, user_id, 
-                         password, host, port, keepalive, qos)
+                         password, host, port, keepalive, qos, connection=connection)
     
     def on_connect(self, client, userdata, flags, rc): 
         """
         Callback function called when the client successfully connects to the broker
         """
         self.logger.info(f"Point Cloud Processor connected to MQTT broker with result code {str(rc)}")
-        self.client.subscribe(self.mqtt_topic)
+        self.subscribe(self.mqtt_topic, self.qos)
         self.timeout = 0
         
     def on_message(self, client, userdata, msg):
@@ -191,35 +278,46 @@ class PointCloudProcessor(Bridge):
             try:
                 self.logger.debug(
                     "Received point cloud {} with payload size {}".format(
-                        self.num_point_clouds_received, len(msg)
+                        self.num_point_clouds_received, len(msg.payload)
                     )
                 )
+                received = time.perf_counter()
+                self.messages_received.inc()
+                self.bytes_received.inc(len(msg.payload))
+                payload = msg.payload
+                if pc_codec.is_chunk(payload):
+                    payload = self.assembler.add(payload)
+                    if payload is None:
+                        # Wait for the remaining chunks of the frame
+                        return
+                
+                start = time.perf_counter()
+                if pc_delta.is_delta_frame(payload):
+                    # Rebuild the full point cloud from the keyframe and the voxel-level delta
+                    header, point_clouds = self.delta_decoder.decode(payload)
+                    if point_clouds is None:
+                        self.request_keyframe()
+                        return
+                else:
+                    # Map the payload into an (N, 3) float32 array, binary frames and legacy hex are both accepted
+                    header, point_clouds = pc_codec.decode_points(payload, self.codec)
+                    if header is not None:
+                        stats = self.codec.decode_stats
+                        self.logger.debug(
+                            "Decoded point cloud {} with codec {} in {:.2f} ms, {} bytes saved on the wire".format(
+                                header.seq, self.codec.name, stats.seconds * 1000, stats.bytes_saved
+                            )
+                        )
+                decoded = time.perf_counter()
+                self.decode_time.observe(decoded - start)
+                self.receive_to_decode_time.observe(decoded - received)
+                
                 # Increment the number of point clouds received. 
                 self.num_point_clouds_received += 1
+                if header is not None:
+                    self.track_sequence(header.seq)
                 
-                # Decode the hexadecimal message to a binary string
-                binary_msg = binascii.unhexlify(msg)
-
-                # Unpack the binary string to a list of floats
-                num_floats = len(binary_msg) // 4  # Each float is 4 bytes
-                float_list = struct.unpack("<%sf" % num_floats, binary_msg)
-
-                # Reshape the list of floats to a list of tuples representing the point cloud
-                point_clouds = [(float_list[i], float_list[i+1], float_list[i+2]) for i in range(0, num_floats, 3)]
-                
-                # Save the cloud_points_flat data to a file with an index and the current date and time in the filename
-                now = datetime.datetime.now()
-                date_time_string = now.strftime("%Y-%m-%d_%H-%M-%S-%f")
-                filename = f'cloud_sub_{date_time_string}.ply'
-                foldername = 'point_cloud_sets'
-                if not os.path.exists(foldername):
-                    os.mkdir(foldername)
-                    
-                filepath = os.path.join(foldername, filename)
-                with open(filepath, 'w') as f:
-                    f.write(f'ply\nformat ascii 1.0\nelement vertex {len(point_clouds)}\nproperty float x\nproperty float y\nproperty float z\nend_header\n')
-                    for point in point_clouds:
-                        f.write(f'{point[0]} {point[1]} {point[2]}\n')
+                self.save_point_cloud(point_clouds, header)
                 
             except TypeError as e:
                 self.logger.error("Type error occurs when processing point cloud: {}".format(e))
@@ -227,11 +325,78 @@ class PointCloudProcessor(Bridge):
             except Exception as e:
                 self.logger.error("Error occurs when processing point cloud: {}".format(e))
         
+    def save_point_cloud(self, point_clouds, header=None):
+        """
+        Queue an (N, 3) array of points to be recorded or saved to a binary PLY file by the writer thread
+        :param header: The frame header with the sequence number and the stamp. Optional, legacy hex frames have none.
+        """
+        if header is None:
+            queued = self.writer.put(point_clouds)
+        else:
+            queued = self.writer.put(point_clouds, header.seq, header.stamp_secs, header.stamp_nsecs)
+        if not queued:
+            self.logger.debug(
+                "Point cloud writer is behind, dropped a point cloud with {} queued".format(self.writer.depth)
+            )
+
+    def request_keyframe(self):
+        """
+        Ask the device for a new keyframe after the reference of a delta frame was lost
+        """
+        now = time.monotonic()
+        if now - self.last_keyframe_request >= self.KEYFRAME_REQUEST_INTERVAL:
+            self.last_keyframe_request = now
+            self.logger.info("Lost the point cloud keyframe, requesting a new one")
+            self.publish(self.command_topic, "request_keyframe")
+
+    def track_sequence(self, seq):
+        """
+        Count the source point clouds the device skipped, e.g. in real-time streaming mode
+        :param seq: The sequence number in the frame header
+        """
+        if self.first_frame_time is None:
+            self.first_frame_time = time.monotonic()
+        if self.last_seq is not None:
+            gap = (seq - self.last_seq - 1) & 0xFFFFFFFF
+            # A huge gap means the sequence went backwards, e.g. the device restarted
+            if gap < 0x80000000:
+                self.num_frames_skipped += gap
+        self.last_seq = seq
+
+    def frame_rate_report(self):
+        """
+        Compare the rate of the point clouds received against the rate of the source point clouds on the device
+        :return: A dictionary with the received and skipped counts and both frame rates in frames per second
+        """
+        received = self.num_point_clouds_received
+        elapsed = time.monotonic() - self.first_frame_time if self.first_frame_time is not None else 0.0
+        source = received + self.num_frames_skipped
+        return {
+            "received": received,
+            "skipped": self.num_frames_skipped,
+            "effective_fps": received / elapsed if elapsed > 0 else 0.0,
+            "source_fps": source / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def set_codec(self, name):
+        """
+        Select the decoder matching the codec announced by the device
+        :param name: The codec name from the start_pc response, e.g. "int16+zlib:6"
+        """
+        self.codec = pc_codec.create_codec(name)
+        self.logger.info(f"Point cloud codec set to {self.codec.name}")
+
     def start_processing(self):
         """
         Enable point cloud processing
         """
         self.processing_enabled = True
+        self.num_point_clouds_received = 0
+        # The frame ids restart with the transfer, e.g. after the device restarted
+        self.assembler.reset()
+        self.last_seq = None
+        self.num_frames_skipped = 0
+        self.first_frame_time = None
         self.logger.info("Point cloud processing started")
 
     def stop_processing(self):
@@ -239,7 +404,18 @@ class PointCloudProcessor(Bridge):
         Disable point cloud processing
         """
         self.processing_enabled = False
-        self.logger.info("Point cloud processing stopped")
+        report = self.frame_rate_report()
+        self.logger.info(
+            "Point cloud processing stopped, received {} and skipped {} point clouds, {:.1f} of {:.1f} fps".format(
+                report["received"], report["skipped"], report["effective_fps"], report["source_fps"]
+            )
+        )
+        stats = self.writer.stats()
+        self.logger.info(
+            "Point cloud writer: {} written, {} dropped, {} queued, flush latency {:.1f} ms mean, {:.1f} ms max".format(
+                stats["written"], stats["dropped"], stats["depth"], stats["mean_flush_ms"], stats["max_flush_ms"]
+            )
+        )
     
     # please use a single rospy.spin() loop that listens for messages on 
     # all of the relevant MQTT topics.    
@@ -0,0 +1,240 @@
+'''
+Lightweight metrics recorded by the bridges: counters, gauges and
+fixed-bucket latency histograms.
+
+A metric is created once, under a lock, and kept by the code that records
+into it. Recording is then a plain attribute update with no lock and no
+new container: a counter adds to an int, a histogram finds its bucket with
+a binary search over a tuple of bounds and bumps a preallocated list. The
+updates rely on the GIL, a rare lost update under contention is accepted
+in exchange for a hot path cheap enough to leave on in production.
+
+The device publishes REGISTRY.snapshot() on its metrics topic,
+topics.device_topic(topics.METRICS, device_id), every few seconds, and the
+host merges the snapshots with MetricsAggregator.
+
+This module is shared by the device and the host, keep both copies identical.
+'''
+
+import bisect
+import json
+import logging
+import threading
+import time
+
+# Upper bounds in seconds, from 50 microseconds to 10 seconds, the last bucket counts the overflow
+DEFAULT_LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """
+    Counts of observations per fixed bucket, plus their number and sum
+    """
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds=DEFAULT_LATENCY_BUCKETS):
+        """
+        :param bounds: The sorted upper bounds of the buckets
+        """
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+def histogram_percentile(bounds, counts, q):
+    """
+    Estimate a percentile from bucket counts, as the upper bound of the bucket holding it
+    :param q: The percentile, between 0 and 100
+    :return: The estimate, None without observations, inf when it falls in the overflow bucket
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = total * q / 100
+    seen = 0
+    for index, count in enumerate(counts):
+        seen += count
+        if seen >= rank and count:
+            return bounds[index] if index < len(bounds) else float("inf")
+    return float("inf")
+
+
+class MetricsRegistry:
+    """
+    The named metrics of a process
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name):
+        """
+        Get or create a counter, keep the returned object instead of looking it up on the hot path
+        """
+        with self._lock:
+            return self.counters.setdefault(name, Counter())
+
+    def gauge(self, name):
+        with self._lock:
+            return self.gauges.setdefault(name, Gauge())
+
+    def histogram(self, name, bounds=DEFAULT_LATENCY_BUCKETS):
+        with self._lock:
+            return self.histograms.setdefault(name, Histogram(bounds))
+
+    def snapshot(self):
+        """
+        :return: A JSON-serializable dictionary of the current values
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = dict(self.histograms)
+        return {
+            "time": time.time(),
+            "counters": {name: metric.value for name, metric in counters.items()},
+            "gauges": {name: metric.value for name, metric in gauges.items()},
+            "histograms": {
+                name: {"bounds": list(metric.bounds), "counts": list(metric.counts),
+                       "count": metric.count, "sum": metric.sum}
+                for name, metric in histograms.items()
+            },
+        }
+
+
+# The registry of this process, the bridges record into it unless they are given another one
+REGISTRY = MetricsRegistry()
+
+
+def summarize(snapshot):
+    """
+    Condense a snapshot for logging: counters, gauges, and the mean, p50, p95 and p99 of each histogram in milliseconds
+    """
+    summary = {"counters": snapshot["counters"], "gauges": snapshot["gauges"], "histograms": {}}
+    for name, histogram in snapshot["histograms"].items():
+        if not histogram["count"]:
+            continue
+        bounds_ms = [bound * 1000 for bound in histogram["bounds"]]
+        summary["histograms"][name] = {
+            "count": histogram["count"],
+            "mean_ms": histogram["sum"] * 1000 / histogram["count"],
+            "p50_ms": histogram_percentile(bounds_ms, histogram["counts"], 50),
+            "p95_ms": histogram_percentile(bounds_ms, histogram["counts"], 95),
+            "p99_ms": histogram_percentile(bounds_ms, histogram["counts"], 99),
+        }
+    return summary
+
+
+class MetricsAggregator:
+    """
+    Keep the latest snapshot of every source, e.g. each device and the host itself, and merge them
+    """
+
+    def __init__(self):
+        self.snapshots = {}
+
+    def add(self, source, snapshot):
+        """
+        :param source: The name of the device or process the snapshot comes from
+        :param snapshot: A dictionary from MetricsRegistry.snapshot, or its JSON text
+        """
+        if isinstance(snapshot, (str, bytes, bytearray)):
+            snapshot = json.loads(snapshot)
+        self.snapshots[source] = snapshot
+
+    def merged(self):
+        """
+        Merge the latest snapshots: counters and histogram buckets are summed, gauges are kept per source
+        :return: A dictionary shaped like a snapshot
+        """
+        merged = {"counters": {}, "gauges": {}, "histograms": {}}
+        for source, snapshot in self.snapshots.items():
+            for name, value in snapshot["counters"].items():
+                merged["counters"][name] = merged["counters"].get(name, 0) + value
+            for name, value in snapshot["gauges"].items():
+                merged["gauges"][f"{source}.{name}"] = value
+            for name, histogram in snapshot["histograms"].items():
+                target = merged["histograms"].get(name)
+                if target is None or target["bounds"] != histogram["bounds"]:
+                    # Histograms with other bounds cannot be summed, keep them apart
+                    if target is not None:
+                        name = f"{source}.{name}"
+                    merged["histograms"][name] = {
+                        "bounds": list(histogram["bounds"]), "counts": list(histogram["counts"]),
+                        "count": histogram["count"], "sum": histogram["sum"],
+                    }
+                    continue
+                target["counts"] = [a + b for a, b in zip(target["counts"], histogram["counts"])]
+                target["count"] += histogram["count"]
+                target["sum"] += histogram["sum"]
+        return merged
+
+
+class MetricsReporter:
+    """
+    Publish the snapshots of a registry periodically from a daemon thread
+    """
+    DEFAULT_INTERVAL = 10.0
+
+    def __init__(self, publish, registry=REGISTRY, interval=DEFAULT_INTERVAL, source=""):
+        """
+        :param publish: The function called with the JSON text of each snapshot
+        :param registry: The MetricsRegistry to report
+        :param interval: Seconds between two snapshots
+        :param source: The name of this process in the snapshots, e.g. the device id
+        """
+        if interval <= 0:
+            raise ValueError("Interval must be positive")
+        self.publish = publish
+        self.registry = registry
+        self.interval = interval
+        self.source = source
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics_reporter", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                snapshot = self.registry.snapshot()
+                snapshot["source"] = self.source
+                self.publish(json.dumps(snapshot))
+            except Exception as e:
+                logging.error(f"Error occurs when publishing the metrics: {e}")
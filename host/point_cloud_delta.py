@@ -0,0 +1,240 @@
+'''
+Keyframe and delta encoding between consecutive point clouds.
+
+Points are snapped to a fixed voxel grid and each occupied voxel is packed
+into one int64 key. Every keyframe_interval frames the device sends a
+keyframe holding all the keys. The frames in between are sent as the keys
+added and removed against the last keyframe, and a frame identical to the
+previous one collapses to a "no change" marker. A delta frame only depends
+on its keyframe, so a lost delta only loses that frame.
+
+The deltas refer to the last keyframe sent, not to the last keyframe the
+host acknowledged: the host does not acknowledge keyframes. Instead, when
+it misses the keyframe a delta refers to, it sends request_keyframe, and
+the next frame of the device is a keyframe, see DeltaEncoder.request_keyframe.
+
+The decoder keeps the last few keyframes and frames by sequence number, not
+only the latest. The frames a device spooled while offline are drained
+interleaved with its live frames, see device/spool.py, and each stream finds
+the keyframe it refers to.
+
+    magic | kind | flags | voxel size | sequence | reference sequence | adds | removes | stamp secs | stamp nsecs | keys ...
+
+The keys of each list are sorted, delta coded and compressed with zlib.
+
+This module is shared by the device and the host, keep both copies identical.
+'''
+
+import struct
+import zlib
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+DELTA_MAGIC = b"VPCD"
+KIND_KEYFRAME = 0
+KIND_DELTA = 1
+KIND_NO_CHANGE = 2
+
+# magic, kind, flags, pad, voxel size, sequence, reference sequence, adds, removes, stamp secs, stamp nsecs
+DELTA_HEADER = struct.Struct("<4sBBxxfIIIIII")
+KEY_DTYPE = np.dtype("<i8")
+
+# Every voxel coordinate takes 21 bits, a signed range of about one million voxels on each axis
+KEY_BITS = 21
+KEY_BIAS = 1 << (KEY_BITS - 1)
+KEY_MASK = (1 << KEY_BITS) - 1
+
+DeltaHeader = namedtuple(
+    "DeltaHeader",
+    ["kind", "voxel_size", "seq", "ref_seq", "num_adds", "num_removes", "stamp_secs", "stamp_nsecs"]
+)
+
+
+def is_delta_frame(payload):
+    """
+    Check if the payload is a keyframe, delta or no change frame
+    """
+    return bytes(payload[:len(DELTA_MAGIC)]) == DELTA_MAGIC
+
+
+def points_to_keys(points, voxel_size):
+    """
+    Snap the points to the voxel grid
+    :return: The sorted unique int64 keys of the occupied voxels
+    """
+    cells = np.floor(np.asarray(points, dtype=np.float64) / voxel_size).astype(np.int64) + KEY_BIAS
+    # Points out of the grid range are clipped to its border
+    np.clip(cells, 0, KEY_MASK, out=cells)
+    keys = (cells[:, 0] << (2 * KEY_BITS)) | (cells[:, 1] << KEY_BITS) | cells[:, 2]
+    return np.unique(keys)
+
+
+def keys_to_points(keys, voxel_size):
+    """
+    Convert voxel keys back to the points at the voxel centers
+    :return: An (N, 3) float32 array
+    """
+    cells = np.empty((len(keys), 3), dtype=np.int64)
+    cells[:, 0] = keys >> (2 * KEY_BITS)
+    cells[:, 1] = (keys >> KEY_BITS) & KEY_MASK
+    cells[:, 2] = keys & KEY_MASK
+    points = (cells - KEY_BIAS).astype(np.float32)
+    points += 0.5
+    points *= voxel_size
+    return points
+
+
+def _pack_keys(keys):
+    return zlib.compress(np.diff(keys, prepend=0).astype(KEY_DTYPE).tobytes(), 1)
+
+
+def _unpack_keys(data, count):
+    keys = np.cumsum(np.frombuffer(zlib.decompress(data), dtype=KEY_DTYPE, count=count))
+    return keys
+
+
+def _encode(kind, voxel_size, seq, ref_seq, adds, removes, stamp_secs, stamp_nsecs):
+    add_data = _pack_keys(adds) if len(adds) else b""
+    remove_data = _pack_keys(removes) if len(removes) else b""
+    header = DELTA_HEADER.pack(
+        DELTA_MAGIC, kind, 0, voxel_size, seq & 0xFFFFFFFF, ref_seq & 0xFFFFFFFF,
+        len(adds), len(removes), stamp_secs, stamp_nsecs
+    )
+    # The compressed add list is prefixed with its length to find the remove list
+    return b"".join((header, struct.pack("<I", len(add_data)), add_data, remove_data))
+
+
+def decode_delta_header(buffer):
+    """
+    Parse the header at the start of a delta frame
+    :return: A DeltaHeader tuple
+    """
+    if len(buffer) < DELTA_HEADER.size:
+        raise ValueError("Buffer is too short to hold a delta frame header")
+    magic, kind, _, voxel_size, seq, ref_seq, adds, removes, secs, nsecs = DELTA_HEADER.unpack_from(buffer, 0)
+    if magic != DELTA_MAGIC:
+        raise ValueError("Buffer does not start with the delta frame magic")
+    if kind not in (KIND_KEYFRAME, KIND_DELTA, KIND_NO_CHANGE):
+        raise ValueError(f"Unknown delta frame kind {kind}")
+    return DeltaHeader(kind, voxel_size, seq, ref_seq, adds, removes, secs, nsecs)
+
+
+class DeltaEncoder:
+    """
+    Encode consecutive point clouds as keyframes, deltas against the last keyframe and no change markers
+    """
+    DEFAULT_KEYFRAME_INTERVAL = 10
+
+    def __init__(self, voxel_size, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+        """
+        :param voxel_size: The edge length of the voxel grid the points are snapped to
+        :param keyframe_interval: The number of frames from one keyframe to the next
+        """
+        # Validate user inputs
+        if voxel_size <= 0:
+            raise ValueError("Voxel size must be positive")
+        if keyframe_interval <= 0:
+            raise ValueError("Keyframe interval must be a positive integer")
+
+        self.voxel_size = voxel_size
+        self.keyframe_interval = keyframe_interval
+        self.keyframe_keys = None
+        self.keyframe_seq = None
+        self.previous_keys = None
+        self.previous_seq = None
+        self.frames_since_keyframe = 0
+        self.num_keyframes = 0
+        self.num_deltas = 0
+        self.num_no_change = 0
+
+    def request_keyframe(self):
+        """
+        Send the next frame as a keyframe, e.g. when the host lost the current one
+        """
+        self.keyframe_keys = None
+
+    def encode(self, points, seq, stamp_secs=0, stamp_nsecs=0):
+        """
+        Encode a point cloud
+        :param points: An (N, 3) array of xyz coordinates
+        :param seq: The sequence number of the frame
+        :return: The bytes of a keyframe, delta or no change frame
+        """
+        keys = points_to_keys(points, self.voxel_size)
+
+        if self.keyframe_keys is None or self.frames_since_keyframe >= self.keyframe_interval:
+            self.keyframe_keys = keys
+            self.keyframe_seq = seq
+            self.frames_since_keyframe = 0
+            self.num_keyframes += 1
+            frame = _encode(KIND_KEYFRAME, self.voxel_size, seq, seq, keys, (), stamp_secs, stamp_nsecs)
+        elif np.array_equal(keys, self.previous_keys):
+            # The host already has this exact frame, refer to it instead of repeating the delta
+            self.num_no_change += 1
+            frame = _encode(KIND_NO_CHANGE, self.voxel_size, seq, self.previous_seq, (), (), stamp_secs, stamp_nsecs)
+        else:
+            adds = np.setdiff1d(keys, self.keyframe_keys, assume_unique=True)
+            removes = np.setdiff1d(self.keyframe_keys, keys, assume_unique=True)
+            self.num_deltas += 1
+            frame = _encode(KIND_DELTA, self.voxel_size, seq, self.keyframe_seq, adds, removes, stamp_secs, stamp_nsecs)
+
+        self.frames_since_keyframe += 1
+        self.previous_keys = keys
+        self.previous_seq = seq
+        return frame
+
+
+class DeltaDecoder:
+    """
+    Rebuild full point clouds from keyframes, deltas and no change markers
+    """
+    # Keyframes, and decoded frames for the no change markers, kept as references
+    MAX_REFERENCES = 4
+
+    def __init__(self):
+        # Sequence number mapped to the keys, oldest first
+        self.keyframes = OrderedDict()
+        self.frames = OrderedDict()
+        self.num_missing_reference = 0
+
+    def _keep(self, references, seq, keys):
+        references[seq] = keys
+        references.move_to_end(seq)
+        while len(references) > self.MAX_REFERENCES:
+            references.popitem(last=False)
+
+    def decode(self, payload):
+        """
+        Decode a frame against the reference state
+        :param payload: A bytes-like object holding a keyframe, delta or no change frame
+        :return: A (DeltaHeader, points) tuple. points is None when the frame refers to a keyframe
+        or frame this decoder does not have, in which case the host should request a keyframe.
+        """
+        header = decode_delta_header(payload)
+        body = memoryview(payload)[DELTA_HEADER.size:]
+
+        if header.kind == KIND_NO_CHANGE:
+            keys = self.frames.get(header.ref_seq)
+            if keys is None:
+                self.num_missing_reference += 1
+                return header, None
+        else:
+            (add_size,) = struct.unpack_from("<I", body, 0)
+            adds = _unpack_keys(body[4:4 + add_size], header.num_adds) if header.num_adds else np.empty(0, KEY_DTYPE)
+            removes = (_unpack_keys(body[4 + add_size:], header.num_removes)
+                       if header.num_removes else np.empty(0, KEY_DTYPE))
+
+            if header.kind == KIND_KEYFRAME:
+                self._keep(self.keyframes, header.seq, adds)
+                keys = adds
+            else:
+                keyframe_keys = self.keyframes.get(header.ref_seq)
+                if keyframe_keys is None:
+                    self.num_missing_reference += 1
+                    return header, None
+                kept = np.setdiff1d(keyframe_keys, removes, assume_unique=True)
+                keys = np.union1d(kept, adds)
+
+        self._keep(self.frames, header.seq, keys)
+        return header, keys_to_points(keys, header.voxel_size)
@@ -0,0 +1,181 @@
+'''
+Background writer of the point clouds received by the host.
+
+PointCloudProcessor runs in the paho network thread, so it only queues the
+decoded (N, 3) arrays. A dedicated writer thread takes them out in batches
+and either appends them to a recording (see recording.py), flushed once per
+batch, or writes each one as a binary little-endian PLY file through a
+large buffered file object. When the disk falls behind, the bounded queue
+applies an overflow policy instead of stalling the MQTT reception.
+'''
+
+import datetime
+import logging
+import os
+import time
+
+import numpy as np
+
+import point_cloud_codec as pc_codec
+import metrics
+from sender import SenderQueue
+
+PLY_HEADER = (
+    "ply\nformat binary_little_endian 1.0\nelement vertex {}\n"
+    "property float x\nproperty float y\nproperty float z\nend_header\n"
+)
+
+
+def write_ply(path, points, buffer_size=-1):
+    """
+    Write an (N, 3) array of points to a binary little-endian PLY file
+    :param path: The path of the file
+    :param points: An (N, 3) array of xyz coordinates
+    :param buffer_size: The buffer size of the file object. Optional, defaults to the io default.
+    :return: The number of bytes written
+    """
+    data = np.ascontiguousarray(points, dtype='<f4')
+    header = PLY_HEADER.format(len(data)).encode()
+    with open(path, 'wb', buffering=buffer_size) as f:
+        f.write(header)
+        f.write(memoryview(data).cast("B"))
+    return len(header) + data.nbytes
+
+
+class PointCloudWriter(SenderQueue):
+    """
+    A bounded queue of point clouds drained by a dedicated writer thread, which appends them to a
+    RecordingWriter when one is given, otherwise writes one PLY file per point cloud.
+    When the queue is full, the overflow policy decides what happens to a new point cloud,
+    see sender.SenderQueue.
+    """
+    DEFAULT_FOLDER = "point_cloud_sets"
+    DEFAULT_MAX_QUEUE_SIZE = 32
+    DEFAULT_BATCH_SIZE = 8
+    DEFAULT_OVERFLOW_POLICY = "drop_oldest"
+    DEFAULT_BLOCK_TIMEOUT = 0.05
+    DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, folder=DEFAULT_FOLDER, max_queue_size=DEFAULT_MAX_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 overflow_policy=DEFAULT_OVERFLOW_POLICY, block_timeout=DEFAULT_BLOCK_TIMEOUT,
+                 buffer_size=DEFAULT_BUFFER_SIZE, recorder=None):
+        """
+        :param folder: The folder the PLY files are written to, created if missing. Unused with a recorder.
+        :param max_queue_size: The maximum number of point clouds waiting to be written
+        :param batch_size: The maximum number of point clouds the writer thread takes out at once
+        :param overflow_policy: One of SenderQueue.OVERFLOW_POLICIES
+        :param block_timeout: The seconds "block" waits for room in the queue
+        :param buffer_size: The buffer size of each file object in bytes
+        :param recorder: A RecordingWriter owned by the writer thread. Optional, defaults to PLY files.
+        """
+        # Validate user inputs
+        if buffer_size <= 0:
+            raise ValueError("Buffer size must be a positive integer")
+
+        self.folder = folder
+        self.buffer_size = buffer_size
+        self.recorder = recorder
+
+        self.num_written = 0
+        self.num_failed = 0
+        self.bytes_written = 0
+        # Seconds from put to the point cloud being handed to the OS
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self.write_time = metrics.REGISTRY.histogram("point_cloud_writer.write_seconds")
+        self.flush_latency = metrics.REGISTRY.histogram("point_cloud_writer.flush_latency_seconds")
+        self.queue_depth = metrics.REGISTRY.gauge("point_cloud_writer.queue_depth")
+        self.queue_dropped = metrics.REGISTRY.gauge("point_cloud_writer.queue_dropped")
+
+        # Created once here instead of checked on every point cloud
+        if recorder is None:
+            os.makedirs(self.folder, exist_ok=True)
+
+        # The queue validates the other inputs and starts the writer thread
+        super().__init__(None, max_queue_size, overflow_policy, block_timeout,
+                         name="point_cloud_writer", batch_size=batch_size)
+
+    @property
+    def mean_flush_latency(self):
+        return self.total_flush_latency / self.num_written if self.num_written else 0.0
+
+    def put(self, points, seq=0, stamp_secs=0, stamp_nsecs=0):
+        """
+        Queue a point cloud to be written, called from the network thread
+        :param points: An (N, 3) array of xyz coordinates, not modified afterwards by the caller
+        :param seq: The sequence number of the point cloud, kept in the recorded frame
+        :param stamp_secs: The seconds of the point cloud stamp, kept in the recorded frame
+        :param stamp_nsecs: The nanoseconds of the point cloud stamp, kept in the recorded frame
+        :return: True if the point cloud was queued, False if it was dropped
+        """
+        # The file name and the recording timestamp keep the reception time, not the time the writer thread gets to it
+        queued = super().put((points, seq, stamp_secs, stamp_nsecs, time.time_ns(), time.monotonic()))
+        self.queue_depth.set(self.depth)
+        self.queue_dropped.set(self.num_dropped)
+        return queued
+
+    def stats(self):
+        """
+        :return: A dictionary with the queue depth, the counters and the flush latencies in milliseconds
+        """
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "written": self.num_written,
+            "dropped": self.num_dropped,
+            "failed": self.num_failed,
+            "bytes_written": self.bytes_written,
+            "last_flush_ms": self.last_flush_latency * 1000,
+            "mean_flush_ms": self.mean_flush_latency * 1000,
+            "max_flush_ms": self.max_flush_latency * 1000,
+        }
+
+    def stop(self, timeout=None):
+        """
+        Stop the writer thread once the queued point clouds are written, then close the recorder
+        :param timeout: The maximum number of seconds to wait for the thread
+        """
+        super().stop(timeout)
+        if self.recorder is not None and not self._thread.is_alive():
+            self.recorder.close()
+
+    def _write(self, points, seq, stamp_secs, stamp_nsecs, received_ns):
+        if self.recorder is not None:
+            frame = pc_codec.encode_frame(points, seq, stamp_secs, stamp_nsecs)
+            self.recorder.append(frame, len(points), received_ns)
+            return len(frame)
+        received = datetime.datetime.fromtimestamp(received_ns / 1e9)
+        filename = f'cloud_sub_{received.strftime("%Y-%m-%d_%H-%M-%S-%f")}.ply'
+        return write_ply(os.path.join(self.folder, filename), points, self.buffer_size)
+
+    def send_batch(self, batch):
+        """
+        Write the point clouds taken out at once, with one flush of the recording for the batch
+        """
+        written = []
+        for points, seq, stamp_secs, stamp_nsecs, received_ns, enqueued in batch:
+            try:
+                start = time.perf_counter()
+                self.bytes_written += self._write(points, seq, stamp_secs, stamp_nsecs, received_ns)
+                self.write_time.observe(time.perf_counter() - start)
+                written.append(enqueued)
+            except Exception as e:
+                self.num_failed += 1
+                logging.error(f"Error occurs when writing point cloud {seq}: {e}")
+        if self.recorder is not None:
+            # One flush for the whole batch
+            try:
+                self.recorder.flush()
+            except Exception as e:
+                logging.error(f"Error occurs when flushing the point cloud recording: {e}")
+
+        now = time.monotonic()
+        for enqueued in written:
+            latency = now - enqueued
+            self.num_written += 1
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self.total_flush_latency += latency
+            self.flush_latency.observe(latency)
+        self.queue_depth.set(self.depth)
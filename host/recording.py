@@ -0,0 +1,331 @@
+'''
+Append-only recording store of the frames received by the host.
+
+A recording is a folder of rolling segments. Each segment is a pair of files:
+
+    <number>.seg    the frames appended back to back
+    <number>.idx    one fixed-width little-endian record per frame
+
+    timestamp ns | offset | length | count | crc32 | device | pad
+
+The timestamps never decrease across a recording, so a reader maps the
+index files with mmap and finds any frame number or time in O(log n) with
+a binary search, without parsing the segments. The frames are sliced out
+of the mapped segment files without copying.
+
+The store does not interpret the frames. PointCloudProcessor records
+binary point cloud frames (see point_cloud_codec.encode_frame), so a
+recorded frame decodes with point_cloud_codec.decode_points and replays
+as is, and count is its number of points.
+
+A segment is rotated when it grows past a size or covers more than a time
+span. When the host crashes, the tail of the last segment may hold a frame
+without its index record or an index record whose frame was not fully
+written. Opening a RecordingWriter on the folder truncates that tail back
+to the last frame whose checksum matches.
+'''
+
+import mmap
+import os
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+
+# timestamp ns, offset, length, count, crc32, device, pad
+INDEX_RECORD = struct.Struct("<qQIII16s4x")
+INDEX_DTYPE = np.dtype({
+    "names": ["timestamp", "offset", "length", "count", "crc", "device"],
+    "formats": ["<i8", "<u8", "<u4", "<u4", "<u4", "S16"],
+    "offsets": [0, 8, 16, 20, 24, 28],
+    "itemsize": INDEX_RECORD.size,
+})
+
+RecordedFrame = namedtuple("RecordedFrame", ["timestamp_ns", "device", "count", "data"])
+
+
+def segment_paths(folder, number):
+    """
+    :return: The (segment, index) file paths of a segment number
+    """
+    name = os.path.join(folder, f"{number:08d}")
+    return name + SEGMENT_SUFFIX, name + INDEX_SUFFIX
+
+
+def list_segments(folder):
+    """
+    :return: The sorted numbers of the segments in a recording folder
+    """
+    if not os.path.isdir(folder):
+        return []
+    return sorted(
+        int(name[:-len(INDEX_SUFFIX)]) for name in os.listdir(folder)
+        if name.endswith(INDEX_SUFFIX) and name[:-len(INDEX_SUFFIX)].isdigit()
+    )
+
+
+def recover_segment(segment_path, index_path):
+    """
+    Truncate the tail of a segment left by a crash: index records whose frame is missing or
+    does not match its checksum, then the frame bytes no index record refers to
+    :return: A (number of frames, last timestamp or None) tuple
+    """
+    segment_size = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+    records = np.fromfile(index_path, dtype=INDEX_DTYPE) if os.path.exists(index_path) else np.empty(0, INDEX_DTYPE)
+
+    # Frames are appended in order, so only the tail can be damaged. A missing segment holds no frame.
+    valid = len(records) if os.path.exists(segment_path) else 0
+    if valid:
+        with open(segment_path, "rb") as f:
+            while valid > 0:
+                record = records[valid - 1]
+                end = int(record["offset"]) + int(record["length"])
+                if end <= segment_size:
+                    f.seek(int(record["offset"]))
+                    if zlib.crc32(f.read(int(record["length"]))) == record["crc"]:
+                        break
+                valid -= 1
+
+    data_end = int(records[valid - 1]["offset"]) + int(records[valid - 1]["length"]) if valid else 0
+    with open(index_path, "ab") as f:
+        f.truncate(valid * INDEX_RECORD.size)
+    with open(segment_path, "ab") as f:
+        f.truncate(data_end)
+    return valid, int(records[valid - 1]["timestamp"]) if valid else None
+
+
+class RecordingWriter:
+    """
+    Append frames to the rolling segments of a recording folder.
+    Not thread-safe, PointCloudWriter calls it from its writer thread only.
+    """
+    DEFAULT_MAX_SEGMENT_BYTES = 256 * 1024 * 1024
+    DEFAULT_MAX_SEGMENT_SECONDS = 600
+    DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, folder, device="", max_segment_bytes=DEFAULT_MAX_SEGMENT_BYTES,
+                 max_segment_seconds=DEFAULT_MAX_SEGMENT_SECONDS, buffer_size=DEFAULT_BUFFER_SIZE, fsync=False):
+        """
+        :param folder: The recording folder, created if missing. An existing recording is recovered and continued.
+        :param device: The default device name recorded with each frame, at most 16 bytes
+        :param max_segment_bytes: Rotate the segment once it holds this many bytes
+        :param max_segment_seconds: Rotate the segment once its frames span this many seconds. None disables it.
+        :param buffer_size: The buffer size of the segment file object in bytes
+        :param fsync: Also fsync the files on every flush, so flushed frames survive a power loss
+        """
+        # Validate user inputs
+        if max_segment_bytes <= 0:
+            raise ValueError("Maximum segment size must be a positive integer")
+        if max_segment_seconds is not None and max_segment_seconds <= 0:
+            raise ValueError("Maximum segment duration must be positive")
+        if len(device.encode()) > 16:
+            raise ValueError(f"Device name {device} is longer than 16 bytes")
+
+        self.folder = folder
+        self.device = device.encode()
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_ns = None if max_segment_seconds is None else int(max_segment_seconds * 1e9)
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+
+        self.num_frames = 0
+        self.num_segments = 0
+        self.last_timestamp = None
+        os.makedirs(folder, exist_ok=True)
+
+        # Recover the tail of the last segment, then continue the recording in a new segment
+        segments = list_segments(folder)
+        self.segment_number = 0
+        if segments:
+            count, last_timestamp = recover_segment(*segment_paths(folder, segments[-1]))
+            self.last_timestamp = last_timestamp
+            self.segment_number = segments[-1] + 1 if count else segments[-1]
+
+        self._segment = None
+        self._index = None
+        self.segment_bytes = 0
+        self.segment_first_timestamp = None
+
+    def _open_segment(self):
+        segment_path, index_path = segment_paths(self.folder, self.segment_number)
+        self._segment = open(segment_path, "wb", buffering=self.buffer_size)
+        self._index = open(index_path, "wb")
+        self.segment_bytes = 0
+        self.segment_first_timestamp = None
+        self.num_segments += 1
+
+    def _close_segment(self):
+        if self._segment is None:
+            return
+        self.flush()
+        self._segment.close()
+        self._index.close()
+        self._segment = None
+        self._index = None
+        self.segment_number += 1
+
+    def append(self, data, count=0, timestamp_ns=None, device=None):
+        """
+        Append a frame
+        :param data: A bytes-like object holding the frame
+        :param count: The number of points or pixels of the frame, recorded in the index
+        :param timestamp_ns: The time of the frame in nanoseconds since the epoch. Optional, defaults to now.
+        A timestamp before the previous one is raised to it, so the index stays sorted.
+        :param device: The device name of this frame. Optional, defaults to the writer device.
+        """
+        if timestamp_ns is None:
+            timestamp_ns = time.time_ns()
+        if self.last_timestamp is not None and timestamp_ns < self.last_timestamp:
+            timestamp_ns = self.last_timestamp
+
+        if self._segment is not None and (
+                self.segment_bytes >= self.max_segment_bytes
+                or (self.max_segment_ns is not None
+                    and timestamp_ns - self.segment_first_timestamp >= self.max_segment_ns)):
+            self._close_segment()
+        if self._segment is None:
+            self._open_segment()
+            self.segment_first_timestamp = timestamp_ns
+
+        view = memoryview(data).cast("B")
+        self._segment.write(view)
+        self._index.write(INDEX_RECORD.pack(
+            timestamp_ns, self.segment_bytes, len(view), count, zlib.crc32(view),
+            self.device if device is None else device.encode()
+        ))
+        self.segment_bytes += len(view)
+        self.last_timestamp = timestamp_ns
+        self.num_frames += 1
+
+    def flush(self):
+        """
+        Hand the buffered frames to the OS, frames first so an index record never refers to a missing frame
+        """
+        if self._segment is None:
+            return
+        self._segment.flush()
+        if self.fsync:
+            os.fsync(self._segment.fileno())
+        self._index.flush()
+        if self.fsync:
+            os.fsync(self._index.fileno())
+
+    def close(self):
+        self._close_segment()
+
+
+class _MappedSegment:
+    """
+    A segment and its index mapped read-only
+    """
+
+    def __init__(self, segment_path, index_path):
+        self.data = None
+        self.index = np.empty(0, INDEX_DTYPE)
+        with open(index_path, "rb") as f:
+            index_size = os.fstat(f.fileno()).st_size // INDEX_RECORD.size * INDEX_RECORD.size
+            if index_size:
+                self._index_map = mmap.mmap(f.fileno(), index_size, access=mmap.ACCESS_READ)
+                self.index = np.frombuffer(self._index_map, dtype=INDEX_DTYPE)
+        with open(segment_path, "rb") as f:
+            segment_size = os.fstat(f.fileno()).st_size
+            if segment_size:
+                self.data = mmap.mmap(f.fileno(), segment_size, access=mmap.ACCESS_READ)
+        # The writer may still be appending, ignore the records whose frame is not written yet
+        if len(self.index):
+            ends = self.index["offset"] + self.index["length"]
+            self.index = self.index[:np.searchsorted(ends, segment_size, side="right")]
+
+
+class RecordingReader:
+    """
+    Random access to the frames of a recording folder through mmap.
+    The frames are those present when the reader was opened.
+    """
+
+    def __init__(self, folder):
+        """
+        :param folder: The recording folder
+        """
+        if not os.path.isdir(folder):
+            raise ValueError(f"Recording folder {folder} does not exist")
+        self.folder = folder
+        self.segments = []
+        for number in list_segments(folder):
+            segment = _MappedSegment(*segment_paths(folder, number))
+            if len(segment.index):
+                self.segments.append(segment)
+        counts = [len(segment.index) for segment in self.segments]
+        # Frame number of the first frame of each segment, and the time of the first frame of each segment
+        self._starts = np.cumsum([0] + counts[:-1]).astype(np.int64)
+        self._first_times = np.array([segment.index["timestamp"][0] for segment in self.segments], dtype=np.int64)
+        self._length = sum(counts)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, number):
+        """
+        :return: A RecordedFrame whose data is a zero-copy memoryview of the segment
+        """
+        if number < 0:
+            number += self._length
+        if not 0 <= number < self._length:
+            raise IndexError("Frame number out of range")
+        position = int(np.searchsorted(self._starts, number, side="right")) - 1
+        segment = self.segments[position]
+        record = segment.index[number - self._starts[position]]
+        offset = int(record["offset"])
+        return RecordedFrame(
+            int(record["timestamp"]), record["device"].rstrip(b"\0").decode(), int(record["count"]),
+            memoryview(segment.data)[offset:offset + int(record["length"])]
+        )
+
+    def __iter__(self):
+        for number in range(self._length):
+            yield self[number]
+
+    def find_time(self, timestamp_ns):
+        """
+        :return: The number of the first frame at or after timestamp_ns, len(self) if there is none
+        """
+        if not self.segments:
+            return 0
+        # The last segment starting strictly before timestamp_ns, frames of equal timestamps may straddle
+        # a segment boundary. When it has no frame at or after timestamp_ns, within is its length, and the
+        # frame number is the first frame of the next segment.
+        position = max(0, int(np.searchsorted(self._first_times, timestamp_ns, side="left")) - 1)
+        within = int(np.searchsorted(self.segments[position].index["timestamp"], timestamp_ns, side="left"))
+        return int(self._starts[position]) + within
+
+    def time_range(self, start_ns=None, end_ns=None):
+        """
+        Iterate over the frames with start_ns <= timestamp < end_ns
+        """
+        first = 0 if start_ns is None else self.find_time(start_ns)
+        last = self._length if end_ns is None else self.find_time(end_ns)
+        for number in range(first, last):
+            yield self[number]
+
+    @property
+    def start_time(self):
+        return int(self._first_times[0]) if self.segments else None
+
+    @property
+    def end_time(self):
+        return int(self.segments[-1].index["timestamp"][-1]) if self.segments else None
+
+    def close(self):
+        self.segments = []
+        self._length = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
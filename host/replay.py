@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+'''
+Record the device traffic and replay it to a broker without a physical Vibot.
+
+A replay folder holds one recording (see recording.py) per stream:
+
+    <folder>/point_cloud    published on /data/point_cloud
+    <folder>/image          published on /data/img
+
+With a device id, both record and replay the topics of that device,
+e.g. /fleet/<device id>/data/point_cloud, see topics.py. A replay can then
+drive the fleet manager, one replayer per simulated device.
+
+TrafficRecorder subscribes to both data topics and records every message
+as it came over the wire, chunks and image packets included. The point
+cloud recordings of PointCloudProcessor (recordings/point_cloud) replay
+as well. They hold whole binary frames, which Replayer splits into chunks
+again. The processor decoding them must use the raw codec.
+
+Replayer merges the streams by timestamp and republishes the frames through
+Bridge.publish with the recorded inter-frame timing, scaled by a speed
+factor, or as fast as the broker accepts them, then reports the achieved
+throughput. The frame id of the chunks and the image id of the packets are
+rewritten on every loop, otherwise the host assemblers would drop the
+frames of the next loop as duplicates of the ones they just completed.
+
+    python replay.py recordings --speed 2 --host localhost
+    python replay.py recordings/traffic --max-speed --loops 5
+    python replay.py recordings/traffic --record
+    python replay.py recordings/traffic --device-id vibot_1
+'''
+
+import argparse
+import heapq
+import json
+import logging
+import os
+import struct
+import time
+from collections import OrderedDict, deque
+
+from bridge import Bridge
+import image_codec
+import point_cloud_codec as pc_codec
+from recording import RecordingReader, RecordingWriter
+import topics
+
+# Stream name, i.e. sub folder of the replay folder, mapped to its global topic
+STREAM_TOPICS = {"point_cloud": topics.POINT_CLOUD, "image": topics.IMAGE}
+
+# The frame id of a chunk and the image id of a packet, and their offsets in the headers
+ID_FIELD = struct.Struct("<I")
+CHUNK_ID_OFFSET = len(pc_codec.CHUNK_MAGIC)
+PACKET_ID_OFFSET = struct.calcsize("<4sBBBx")
+
+
+class TrafficRecorder(Bridge):
+    """
+    Record the messages of the data topics into a replay folder
+    """
+    DEFAULT_FOLDER = "recordings/traffic"
+    # Seconds between two flushes of the recordings
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, folder=DEFAULT_FOLDER, client_id="traffic_recorder", user_id="", password="",
+                 host="localhost", port=1883, keepalive=60, qos=0, device_id=None):
+        """
+        :param folder: The replay folder, one recording per stream is created in it
+        :param device_id: The id of the device to record, see topics.py. Optional, defaults to the global topics.
+        """
+        # Validate user inputs
+        if device_id is not None:
+            topics.validate_device_id(device_id)
+            # Client ids must be unique on the broker, e.g. with one replayer per simulated device
+            client_id = f"{client_id}_{device_id}"
+
+        self.folder = folder
+        self.stream_topics = {stream: topics.device_topic(topic, device_id) for stream, topic in STREAM_TOPICS.items()}
+        self.topic_streams = {topic: stream for stream, topic in self.stream_topics.items()}
+        self.writers = {
+            stream: RecordingWriter(os.path.join(folder, stream)) for stream in STREAM_TOPICS
+        }
+        self.num_messages = 0
+        self.last_flush = time.monotonic()
+        super().__init__(self.stream_topics["point_cloud"], client_id, user_id, password, host, port, keepalive, qos)
+
+    def on_connect(self, client, userdata, flags, rc):
+        logging.info(f"Traffic recorder connected to MQTT broker with result code {str(rc)}")
+        for topic in self.stream_topics.values():
+            self.subscribe(topic, self.qos)
+
+    def msg_process(self, msg):
+        stream = self.topic_streams.get(msg.topic)
+        if stream is None:
+            return
+        # The messages are appended to a buffered file, the files are only flushed once in a while
+        self.writers[stream].append(msg.payload)
+        self.num_messages += 1
+        now = time.monotonic()
+        if now - self.last_flush >= self.FLUSH_INTERVAL:
+            self.last_flush = now
+            for writer in self.writers.values():
+                writer.flush()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+class Replayer(Bridge):
+    """
+    Republish the recordings of a replay folder on their data topics
+    """
+    DEFAULT_SPEED = 1.0
+    DEFAULT_MAX_CHUNK_SIZE = 256 * 1024
+    # Maximum number of messages handed to paho and not yet sent, bounds the memory at maximum speed
+    DEFAULT_MAX_IN_FLIGHT = 100
+    # Number of recorded ids whose rewritten id is remembered, enough for the chunks of a frame to interleave
+    ID_HISTORY = 1024
+
+    def __init__(self, folder, speed=DEFAULT_SPEED, streams=tuple(STREAM_TOPICS), client_id="replayer",
+                 user_id="", password="", host="localhost", port=1883, keepalive=60, qos=0,
+                 max_chunk_size=DEFAULT_MAX_CHUNK_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, device_id=None):
+        """
+        :param folder: The replay folder, or a recording folder named after its stream
+        :param speed: The factor applied to the recorded pace, e.g. 2 replays twice as fast.
+        None replays as fast as possible.
+        :param streams: The names of the streams to replay
+        :param max_chunk_size: Whole point cloud frames larger than this are split into chunks
+        :param max_in_flight: The maximum number of messages published but not yet sent
+        :param device_id: The id of the device to replay as, see topics.py. Optional, defaults to the global topics.
+        """
+        # Validate user inputs
+        if speed is not None and speed <= 0:
+            raise ValueError("Speed must be positive")
+        if max_in_flight <= 0:
+            raise ValueError("Maximum in-flight messages must be a positive integer")
+        unknown = set(streams) - set(STREAM_TOPICS)
+        if unknown:
+            raise ValueError(f"Streams must be among {tuple(STREAM_TOPICS)}")
+        if device_id is not None:
+            topics.validate_device_id(device_id)
+            # Client ids must be unique on the broker, e.g. with one replayer per simulated device
+            client_id = f"{client_id}_{device_id}"
+
+        self.readers = {}
+        if os.path.basename(os.path.normpath(folder)) in streams:
+            self.readers[os.path.basename(os.path.normpath(folder))] = RecordingReader(folder)
+        else:
+            for stream in streams:
+                path = os.path.join(folder, stream)
+                if os.path.isdir(path):
+                    self.readers[stream] = RecordingReader(path)
+        if not self.readers:
+            raise ValueError(f"No recording of {streams} found in {folder}")
+
+        self.stream_topics = {stream: topics.device_topic(topic, device_id) for stream, topic in STREAM_TOPICS.items()}
+        self.speed = speed
+        self.max_chunk_size = max_chunk_size
+        self.max_in_flight = max_in_flight
+        # Random first ids, so a host that already saw a replay does not take the next one for duplicates
+        self.next_frame_id = int.from_bytes(os.urandom(4), "little")
+        self.next_image_id = int.from_bytes(os.urandom(4), "little")
+        # (stream, recorded id, layout) mapped to the id it is replayed with in the current loop
+        self._ids = OrderedDict()
+        super().__init__(self.stream_topics[next(iter(self.readers))], client_id, user_id, password,
+                         host, port, keepalive, qos)
+
+    def on_connect(self, client, userdata, flags, rc):
+        logging.info(f"Replayer connected to MQTT broker with result code {str(rc)}")
+
+    def frames(self):
+        """
+        :return: An iterator of (timestamp ns, stream, RecordedFrame) tuples over all streams in time order
+        """
+        return heapq.merge(
+            *(self._stream_frames(stream, reader) for stream, reader in self.readers.items()),
+            key=lambda item: (item[0], item[1])
+        )
+
+    @staticmethod
+    def _stream_frames(stream, reader):
+        # A function binds the stream of each reader, a nested generator expression would see the last one
+        for frame in reader:
+            yield frame.timestamp_ns, stream, frame
+
+    def _next_id(self, stream):
+        if stream == "point_cloud":
+            new_id = self.next_frame_id
+            self.next_frame_id = (self.next_frame_id + 1) & 0xFFFFFFFF
+        else:
+            new_id = self.next_image_id
+            self.next_image_id = (self.next_image_id + 1) & 0xFFFFFFFF
+        return new_id
+
+    def _rewrite_id(self, stream, data, offset, layout):
+        """
+        Replace the recorded id of a chunk or packet by the id of its frame in the current loop
+        """
+        key = (stream, ID_FIELD.unpack_from(data, offset)[0], layout)
+        new_id = self._ids.get(key)
+        if new_id is None:
+            new_id = self._ids[key] = self._next_id(stream)
+            if len(self._ids) > self.ID_HISTORY:
+                self._ids.popitem(last=False)
+        message = bytearray(data)
+        ID_FIELD.pack_into(message, offset, new_id)
+        return message
+
+    def _messages(self, stream, data):
+        if stream == "point_cloud" and pc_codec.is_chunk(data):
+            header = pc_codec.decode_chunk_header(data)
+            return [self._rewrite_id(stream, data, CHUNK_ID_OFFSET, (header.chunk_count, header.frame_size))]
+        if stream == "image" and bytes(data[:len(image_codec.PACKET_MAGIC)]) == image_codec.PACKET_MAGIC:
+            header = image_codec.decode_packet_header(data)
+            return [self._rewrite_id(stream, data, PACKET_ID_OFFSET, (header.packet_count, header.image_size))]
+        if stream == "point_cloud" and len(data) > self.max_chunk_size:
+            return pc_codec.split_frame(data, self._next_id(stream), self.max_chunk_size)
+        # paho does not accept a memoryview
+        return [bytes(data)]
+
+    def replay(self, loops=1):
+        """
+        Replay the recordings
+        :param loops: The number of times the recordings are replayed
+        :return: A dictionary with the frames, messages and bytes sent, the elapsed seconds,
+        the achieved rates and the largest lag behind the recorded schedule in milliseconds
+        """
+        self.loop_start()
+        # The CONNACK is handled by the network loop, do not count the wait for it as replay time
+        deadline = time.monotonic() + self.keepalive
+        while not self.client.is_connected() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        in_flight = deque()
+        num_frames = num_messages = num_bytes = 0
+        max_lag = 0.0
+        start = time.monotonic()
+        try:
+            for _ in range(loops):
+                # Every loop replays its frames with new ids
+                self._ids.clear()
+                loop_start = time.monotonic()
+                first_timestamp = None
+                for timestamp, stream, frame in self.frames():
+                    if first_timestamp is None:
+                        first_timestamp = timestamp
+                    if self.speed is not None:
+                        due = loop_start + (timestamp - first_timestamp) / 1e9 / self.speed
+                        delay = due - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                        else:
+                            max_lag = max(max_lag, -delay)
+
+                    for message in self._messages(stream, frame.data):
+                        if len(in_flight) >= self.max_in_flight:
+                            in_flight.popleft().wait_for_publish()
+                        in_flight.append(self.publish(self.stream_topics[stream], message, self.qos))
+                        num_messages += 1
+                        num_bytes += len(message)
+                    num_frames += 1
+            while in_flight:
+                in_flight.popleft().wait_for_publish()
+            elapsed = time.monotonic() - start
+        finally:
+            self.loop_stop()
+
+        return {
+            "frames": num_frames,
+            "messages": num_messages,
+            "bytes": num_bytes,
+            "seconds": elapsed,
+            "frames_per_sec": num_frames / elapsed if elapsed > 0 else 0.0,
+            "messages_per_sec": num_messages / elapsed if elapsed > 0 else 0.0,
+            "bytes_per_sec": num_bytes / elapsed if elapsed > 0 else 0.0,
+            "max_lag_ms": max_lag * 1000,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record or replay the point cloud and image traffic of a Vibot")
+    parser.add_argument("folder", help="The replay folder, or a recording folder named point_cloud or image")
+    parser.add_argument("--record", action="store_true", help="Record the data topics into the folder instead")
+    parser.add_argument("--speed", type=float, default=Replayer.DEFAULT_SPEED, help="Factor applied to the recorded pace")
+    parser.add_argument("--max-speed", action="store_true", help="Replay as fast as possible")
+    parser.add_argument("--loops", type=int, default=1, help="Number of times the recordings are replayed")
+    parser.add_argument("--streams", nargs="+", default=list(STREAM_TOPICS), choices=list(STREAM_TOPICS))
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--qos", type=int, default=0, choices=[0, 1, 2])
+    parser.add_argument("--device-id", help="Record or replay the topics of this device, e.g. for the fleet manager")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if args.record:
+        recorder = TrafficRecorder(args.folder, host=args.host, port=args.port, qos=args.qos,
+                                   device_id=args.device_id)
+        try:
+            recorder.connection.loop_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            recorder.close()
+            logging.info(f"Recorded {recorder.num_messages} messages into {args.folder}")
+        return
+
+    replayer = Replayer(
+        args.folder, None if args.max_speed else args.speed, args.streams,
+        host=args.host, port=args.port, qos=args.qos, device_id=args.device_id
+    )
+    report = replayer.replay(args.loops)
+    replayer.disconnect()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+'''
+MQTT topics of a Vibot, optionally namespaced by device id.
+
+Without a device id, a Vibot uses the global topics below, and one host can
+talk to one Vibot. With a device id, every topic is prefixed with the
+fleet prefix and the id:
+
+    /iot_device/heartbeat    ->  /fleet/<device_id>/iot_device/heartbeat
+    /data/point_cloud        ->  /fleet/<device_id>/data/point_cloud
+
+A fleet manager then receives a topic of every device with a single
+wildcard subscription, e.g. /fleet/+/data/# for all the data streams, and
+finds the device from the topic with split_device_topic. A device id is
+one topic level, it cannot hold "/", "+" or "#".
+
+This module is shared by the device and the host, keep both copies identical.
+'''
+
+FLEET_PREFIX = "/fleet"
+
+COMMAND = "/iot_device/command"
+COMMAND_RESPONSE = "/iot_device/command_response"
+STATUS_CHECK = "/iot_device/status_check"
+STATUS_RESPONSE = "/iot_device/status_response"
+HEARTBEAT = "/iot_device/heartbeat"
+METRICS = "/iot_device/metrics"
+POINT_CLOUD = "/data/point_cloud"
+IMAGE = "/data/img"
+
+
+def validate_device_id(device_id):
+    if not device_id or any(character in device_id for character in "/+#"):
+        raise ValueError("Device id must be a non-empty topic level without '/', '+' or '#'")
+
+
+def device_topic(topic, device_id=None):
+    """
+    :param topic: One of the global topics above
+    :param device_id: The id of the device. Optional, defaults to the global topic.
+    :return: The topic of the device
+    """
+    if device_id is None:
+        return topic
+    return f"{FLEET_PREFIX}/{device_id}{topic}"
+
+
+def fleet_filter(topic):
+    """
+    :return: The wildcard filter matching a topic of every device, e.g. /fleet/+/iot_device/heartbeat
+    """
+    return f"{FLEET_PREFIX}/+{topic}"
+
+
+def split_device_topic(topic):
+    """
+    :return: A (device id, global topic) tuple, the device id is None for a topic outside the fleet prefix
+    """
+    if not topic.startswith(FLEET_PREFIX + "/"):
+        return None, topic
+    device_id, separator, rest = topic[len(FLEET_PREFIX) + 1:].partition("/")
+    if not separator:
+        return None, topic
+    return device_id, "/" + rest
@@ -0,0 +1,103 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "host"))
+
+from point_cloud_codec import CHUNK_HEADER, CHUNK_MAGIC, FrameAssembler, split_frame
+
+
+def frame(size, seed=0):
+    return bytes((seed + index) % 251 for index in range(size))
+
+
+class FrameAssemblerTest(unittest.TestCase):
+
+    def test_out_of_order_and_duplicates(self):
+        assembler = FrameAssembler()
+        data = frame(1000)
+        chunks = split_frame(data, 7, 300)
+        self.assertEqual(len(chunks), 4)
+        for chunk in (chunks[2], chunks[0], chunks[2], chunks[3]):
+            self.assertIsNone(assembler.add(chunk, now=0.0))
+        self.assertEqual(assembler.add(chunks[1], now=0.0), data)
+        self.assertEqual(assembler.num_chunks_dropped, 1)
+        self.assertEqual(assembler.pending_bytes, 0)
+
+    def test_late_duplicate_of_completed_frame(self):
+        assembler = FrameAssembler()
+        chunks = split_frame(frame(1000), 7, 300)
+        for chunk in chunks:
+            assembler.add(chunk, now=0.0)
+        # A retransmitted chunk must not start a new partial frame
+        self.assertIsNone(assembler.add(chunks[0], now=1.0))
+        self.assertEqual(assembler.num_chunks_dropped, 1)
+        self.assertEqual(assembler.pending_bytes, 0)
+
+    def test_completed_ids_forgotten_after_timeout(self):
+        assembler = FrameAssembler(timeout=5.0)
+        for chunk in split_frame(frame(1000), 0, 300):
+            assembler.add(chunk, now=0.0)
+        # The device restarted, its frame ids start again at 0 with the same layout
+        data = frame(1000, seed=1)
+        result = None
+        for chunk in split_frame(data, 0, 300):
+            result = assembler.add(chunk, now=6.0)
+        self.assertEqual(result, data)
+
+    def test_reset_forgets_completed_ids(self):
+        assembler = FrameAssembler()
+        for chunk in split_frame(frame(1000), 0, 300):
+            assembler.add(chunk, now=0.0)
+        assembler.reset()
+        data = frame(1000, seed=1)
+        result = None
+        for chunk in split_frame(data, 0, 300):
+            result = assembler.add(chunk, now=0.0)
+        self.assertEqual(result, data)
+
+    def test_chunk_count_beyond_frame_size(self):
+        assembler = FrameAssembler()
+        # Four billion chunks of a ten byte frame would allocate a 4 GiB bitmap
+        chunk = CHUNK_HEADER.pack(CHUNK_MAGIC, 1, 0, 0xFFFFFFFF, 10, 0) + b"x"
+        with self.assertRaises(ValueError):
+            assembler.add(chunk, now=0.0)
+        self.assertEqual(assembler.pending_bytes, 0)
+
+    def test_memory_cap_evicts_oldest(self):
+        # Each partial frame holds 1000 bytes and a bitmap of 4 chunks
+        assembler = FrameAssembler(max_pending_bytes=2100)
+        for frame_id in range(3):
+            assembler.add(split_frame(frame(1000), frame_id, 300)[0], now=0.0)
+        self.assertEqual(assembler.pending_bytes, 2 * 1004)
+        self.assertEqual(assembler.num_frames_evicted, 1)
+        # The oldest frame was evicted, its remaining chunks start over and do not complete it
+        for chunk in split_frame(frame(1000), 0, 300)[1:]:
+            self.assertIsNone(assembler.add(chunk, now=0.0))
+
+    def test_frame_larger_than_cap(self):
+        assembler = FrameAssembler(max_pending_bytes=500)
+        self.assertIsNone(assembler.add(split_frame(frame(1000), 0, 300)[0], now=0.0))
+        self.assertEqual(assembler.pending_bytes, 0)
+        self.assertEqual(assembler.num_chunks_dropped, 1)
+
+    def test_timeout_evicts_incomplete_frame(self):
+        assembler = FrameAssembler(timeout=5.0)
+        assembler.add(split_frame(frame(1000), 0, 300)[0], now=0.0)
+        assembler.evict_expired(now=6.0)
+        self.assertEqual(assembler.pending_bytes, 0)
+        self.assertEqual(assembler.num_frames_evicted, 1)
+
+    def test_reused_id_with_another_layout(self):
+        assembler = FrameAssembler()
+        assembler.add(split_frame(frame(1000), 0, 300)[0], now=0.0)
+        data = frame(500)
+        result = None
+        for chunk in split_frame(data, 0, 300):
+            result = assembler.add(chunk, now=0.0)
+        self.assertEqual(result, data)
+        self.assertEqual(assembler.num_frames_evicted, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
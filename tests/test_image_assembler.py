@@ -0,0 +1,109 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "host"))
+
+from image_codec import PACKET_HEADER, PACKET_MAGIC, PACKET_VERSION, ImageAssembler, split_image
+
+
+def image(size, seed=0):
+    return bytes((seed + index) % 251 for index in range(size))
+
+
+def packets(data, image_id, packet_size=300):
+    # A mono8 image one row high, the layout does not matter to the assembler
+    return split_image(data, image_id, packet_size, len(data), 1, "mono8", len(data))
+
+
+class ImageAssemblerTest(unittest.TestCase):
+
+    def test_out_of_order_and_duplicates(self):
+        assembler = ImageAssembler()
+        data = image(1000)
+        parts = packets(data, 7)
+        self.assertEqual(len(parts), 4)
+        for packet in (parts[3], parts[1], parts[3], parts[0]):
+            self.assertIsNone(assembler.add(packet, now=0.0))
+        completed = assembler.add(parts[2], now=0.0)
+        self.assertEqual(completed.data, data)
+        self.assertEqual(completed.header.image_id, 7)
+        self.assertEqual(assembler.num_packets_dropped, 1)
+        self.assertEqual(assembler.pending_bytes, 0)
+
+    def test_late_duplicate_of_completed_image(self):
+        assembler = ImageAssembler()
+        parts = packets(image(1000), 7)
+        for packet in parts:
+            assembler.add(packet, now=0.0)
+        self.assertIsNone(assembler.add(parts[0], now=1.0))
+        self.assertEqual(assembler.num_packets_dropped, 1)
+        self.assertEqual(assembler.pending_bytes, 0)
+
+    def test_completed_ids_forgotten_after_timeout(self):
+        assembler = ImageAssembler(timeout=5.0)
+        for packet in packets(image(1000), 0):
+            assembler.add(packet, now=0.0)
+        # The device restarted, its image count starts again at 0 with the same layout
+        data = image(1000, seed=1)
+        completed = None
+        for packet in packets(data, 0):
+            completed = assembler.add(packet, now=6.0)
+        self.assertEqual(completed.data, data)
+
+    def test_reset_forgets_completed_ids(self):
+        assembler = ImageAssembler()
+        for packet in packets(image(1000), 0):
+            assembler.add(packet, now=0.0)
+        assembler.reset()
+        data = image(1000, seed=1)
+        completed = None
+        for packet in packets(data, 0):
+            completed = assembler.add(packet, now=0.0)
+        self.assertEqual(completed.data, data)
+
+    def test_packet_count_beyond_image_size(self):
+        assembler = ImageAssembler()
+        packet = PACKET_HEADER.pack(
+            PACKET_MAGIC, PACKET_VERSION, 0, 0, 1, 0, 0xFFFFFFFF, 10, 0, 10, 1, 10, 0, 0, b"mono8"
+        ) + b"x"
+        with self.assertRaises(ValueError):
+            assembler.add(packet, now=0.0)
+        self.assertEqual(assembler.pending_bytes, 0)
+
+    def test_memory_cap_evicts_oldest(self):
+        # Each partial image holds 1000 bytes and a bitmap of 4 packets
+        assembler = ImageAssembler(max_pending_bytes=2100)
+        for image_id in range(3):
+            assembler.add(packets(image(1000), image_id)[0], now=0.0)
+        self.assertEqual(assembler.pending_bytes, 2 * 1004)
+        self.assertEqual(assembler.num_images_evicted, 1)
+        for packet in packets(image(1000), 0)[1:]:
+            self.assertIsNone(assembler.add(packet, now=0.0))
+
+    def test_image_larger_than_cap(self):
+        assembler = ImageAssembler(max_pending_bytes=500)
+        self.assertIsNone(assembler.add(packets(image(1000), 0)[0], now=0.0))
+        self.assertEqual(assembler.pending_bytes, 0)
+        self.assertEqual(assembler.num_packets_dropped, 1)
+
+    def test_timeout_evicts_incomplete_image(self):
+        assembler = ImageAssembler(timeout=5.0)
+        assembler.add(packets(image(1000), 0)[0], now=0.0)
+        assembler.evict_expired(now=6.0)
+        self.assertEqual(assembler.pending_bytes, 0)
+        self.assertEqual(assembler.num_images_evicted, 1)
+
+    def test_reused_id_with_another_layout(self):
+        assembler = ImageAssembler()
+        assembler.add(packets(image(1000), 0)[0], now=0.0)
+        data = image(500)
+        completed = None
+        for packet in packets(data, 0):
+            completed = assembler.add(packet, now=0.0)
+        self.assertEqual(completed.data, data)
+        self.assertEqual(assembler.num_images_evicted, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
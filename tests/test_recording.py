@@ -0,0 +1,119 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "host"))
+
+from recording import INDEX_RECORD, RecordingReader, RecordingWriter, list_segments, recover_segment, segment_paths
+
+
+def frame(index, size=100):
+    return bytes([index % 256]) * size
+
+
+class RecordingTest(unittest.TestCase):
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+
+    def record(self, timestamps, **kwargs):
+        writer = RecordingWriter(self.folder, "vibot", **kwargs)
+        for index, timestamp in enumerate(timestamps):
+            writer.append(frame(index), index, timestamp)
+        writer.close()
+        return writer
+
+    def read(self):
+        with RecordingReader(self.folder) as reader:
+            return [(recorded.timestamp_ns, bytes(recorded.data)) for recorded in reader]
+
+    def test_torn_tail(self):
+        self.record([1, 2, 3, 4])
+        segment_path, index_path = segment_paths(self.folder, 0)
+        # The last frame was only partly written when the host crashed
+        with open(segment_path, "r+b") as f:
+            f.truncate(os.path.getsize(segment_path) - 10)
+
+        self.assertEqual(recover_segment(segment_path, index_path), (3, 3))
+        self.assertEqual(os.path.getsize(segment_path), 300)
+        self.assertEqual(os.path.getsize(index_path), 3 * INDEX_RECORD.size)
+
+    def test_torn_tail_with_bad_checksum(self):
+        self.record([1, 2, 3])
+        segment_path, index_path = segment_paths(self.folder, 0)
+        with open(segment_path, "r+b") as f:
+            f.seek(250)
+            f.write(b"\xff")
+
+        self.assertEqual(recover_segment(segment_path, index_path), (2, 2))
+        self.assertEqual(self.read(), [(1, frame(0)), (2, frame(1))])
+
+    def test_lost_index_record(self):
+        self.record([1, 2, 3])
+        segment_path, index_path = segment_paths(self.folder, 0)
+        # The frame reached the segment, its index record did not
+        with open(index_path, "r+b") as f:
+            f.truncate(2 * INDEX_RECORD.size + 7)
+
+        self.assertEqual(recover_segment(segment_path, index_path), (2, 2))
+        # The frame bytes no index record refers to are truncated too
+        self.assertEqual(os.path.getsize(segment_path), 200)
+        self.assertEqual(os.path.getsize(index_path), 2 * INDEX_RECORD.size)
+
+    def test_missing_segment(self):
+        self.record([1, 2])
+        segment_path, index_path = segment_paths(self.folder, 0)
+        os.remove(segment_path)
+
+        self.assertEqual(recover_segment(segment_path, index_path), (0, None))
+        self.assertEqual(os.path.getsize(index_path), 0)
+
+    def test_recovered_recording_is_continued(self):
+        self.record([1, 2, 3])
+        segment_path, _ = segment_paths(self.folder, 0)
+        with open(segment_path, "r+b") as f:
+            f.truncate(250)
+
+        self.record([4, 5])
+        self.assertEqual(list_segments(self.folder), [0, 1])
+        self.assertEqual([timestamp for timestamp, _ in self.read()], [1, 2, 4, 5])
+
+    def test_rotation(self):
+        writer = self.record(range(10), max_segment_bytes=300)
+        self.assertEqual(writer.num_segments, 4)
+        self.assertEqual(list_segments(self.folder), [0, 1, 2, 3])
+        self.assertEqual(self.read(), [(index, frame(index)) for index in range(10)])
+
+    def test_rotation_by_time(self):
+        second = 1000000000
+        writer = self.record([0, second, 2 * second, 3 * second], max_segment_seconds=2)
+        self.assertEqual(writer.num_segments, 2)
+        with RecordingReader(self.folder) as reader:
+            self.assertEqual(len(reader), 4)
+            self.assertEqual(reader.start_time, 0)
+            self.assertEqual(reader.end_time, 3 * second)
+
+    def test_find_time_across_segments(self):
+        # Three frames per segment, the equal timestamps straddle the boundary
+        self.record([1, 2, 2, 2, 2, 3], max_segment_bytes=300)
+        self.assertEqual(list_segments(self.folder), [0, 1])
+        with RecordingReader(self.folder) as reader:
+            self.assertEqual(reader.find_time(0), 0)
+            self.assertEqual(reader.find_time(1), 0)
+            self.assertEqual(reader.find_time(2), 1)
+            self.assertEqual(reader.find_time(3), 5)
+            self.assertEqual(reader.find_time(4), 6)
+            self.assertEqual([recorded.timestamp_ns for recorded in reader.time_range(2, 3)], [2, 2, 2, 2])
+
+    def test_find_time_at_segment_start(self):
+        self.record([1, 1, 1, 2, 2, 2], max_segment_bytes=300)
+        with RecordingReader(self.folder) as reader:
+            self.assertEqual(reader.find_time(1), 0)
+            self.assertEqual(reader.find_time(2), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "device"))
+
+import paho.mqtt.client as mqtt
+
+from connection import BufferedPublish
+from spool import Spool
+
+
+class FakeConnection:
+    online = True
+
+
+class FakeBridge:
+    """
+    Records the publishes of the drain, acknowledged at once unless told otherwise
+    """
+
+    def __init__(self, ack=True, offline=False):
+        self.connection = FakeConnection()
+        self.ack = ack
+        self.offline = offline
+        self.published = []
+        self.unacknowledged = []
+
+    def publish(self, topic, message, qos=0):
+        if self.offline:
+            # The connection went offline between the check of the drain and the publish
+            return BufferedPublish()
+        info = mqtt.MQTTMessageInfo(len(self.published) + 1)
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        if self.ack:
+            info._set_as_published()
+        else:
+            self.unacknowledged.append(info)
+        self.published.append((topic, message, qos))
+        return info
+
+    def acknowledge(self):
+        for info in self.unacknowledged:
+            info._set_as_published()
+        self.unacknowledged = []
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        # Cleaned up after the spools, which are stopped first
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+
+    def spool(self):
+        spool = Spool(self.folder, drain_bytes_per_sec=None)
+        self.addCleanup(spool.stop)
+        return spool
+
+    def test_restart_round_trip(self):
+        spool = Spool(self.folder, drain_bytes_per_sec=None)
+        for index in range(3):
+            spool.append("/data/point_cloud", b"before %d" % index, qos=1)
+        spool.stop()
+
+        # The recovered segment is appended to after the restart
+        spool = Spool(self.folder, drain_bytes_per_sec=None)
+        for index in range(2):
+            spool.append("/data/point_cloud", b"after %d" % index, qos=1)
+        self.assertEqual(spool.pending, 5)
+        spool.stop()
+
+        spool = self.spool()
+        bridge = FakeBridge()
+        spool.register("/data/point_cloud", bridge)
+        self.assertTrue(wait_for(lambda: spool.pending == 0))
+        self.assertEqual(
+            [message for _, message, _ in bridge.published],
+            [b"before 0", b"before 1", b"before 2", b"after 0", b"after 1"],
+        )
+        self.assertEqual({qos for _, _, qos in bridge.published}, {1})
+
+    def test_buffered_publish_is_not_popped(self):
+        spool = self.spool()
+        spool.append("/data/img", b"image")
+        spool.register("/data/img", FakeBridge(offline=True))
+        time.sleep(3 * Spool.IDLE_INTERVAL)
+        self.assertEqual(spool.pending, 1)
+        self.assertEqual(spool.num_drained, 0)
+
+    def test_unacknowledged_publish_is_sent_again(self):
+        spool = self.spool()
+        spool.ACK_TIMEOUT = 0.05
+        spool.append("/data/img", b"image", qos=1)
+        bridge = FakeBridge(ack=False)
+        spool.register("/data/img", bridge)
+        self.assertTrue(wait_for(lambda: len(bridge.published) >= 2))
+        self.assertEqual(spool.pending, 1)
+
+        bridge.ack = True
+        self.assertTrue(wait_for(lambda: spool.pending == 0))
+        self.assertEqual(spool.num_drained, 1)
+
+    def test_window_of_records_in_flight(self):
+        spool = self.spool()
+        for index in range(Spool.DRAIN_WINDOW + 8):
+            spool.append("/data/img", b"image %d" % index, qos=1)
+        bridge = FakeBridge(ack=False)
+        spool.register("/data/img", bridge)
+        # A whole window is published before the first acknowledgement, and nothing more
+        self.assertTrue(wait_for(lambda: len(bridge.published) == Spool.DRAIN_WINDOW))
+        time.sleep(2 * Spool.IDLE_INTERVAL)
+        self.assertEqual(len(bridge.published), Spool.DRAIN_WINDOW)
+        self.assertEqual(spool.pending, Spool.DRAIN_WINDOW + 8)
+
+        bridge.ack = True
+        bridge.acknowledge()
+        self.assertTrue(wait_for(lambda: spool.pending == 0))
+        self.assertEqual(
+            [message for _, message, _ in bridge.published],
+            [b"image %d" % index for index in range(Spool.DRAIN_WINDOW + 8)],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()